@@ -0,0 +1,197 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Runs the frozen VAE and text encoder of a SD 1.x/2.x checkpoint over a dataset once.
+
+Reads `dataset_name` (`image_column`, `caption_column`) like the hf and tf input pipelines
+and writes ArrayRecord shards of VAE moments and text encoder hidden states, the records
+`ParseFeatures` reads for `dataset_type=grain`. Start it on every host, each host encodes
+every `process_count`-th shard on its local devices:
+
+  python src/maxdiffusion/cache_latents.py src/maxdiffusion/configs/base_2_base.yml \
+    dataset_name=diffusers/pokemon-gpt4-captions latents_cache_dir=/data/latents
+
+Shards land in `latents_cache_dir/<encoder hash>`, where the hash covers the VAE and text
+encoder weights, resolution and dataset, and `manifest.json` in `latents_cache_dir` lists
+the complete caches by hash. Finished shards are skipped when the job is restarted. Train
+with `dataset_type=grain grain_train_files=/data/latents/<encoder hash>/*.array_record`.
+"""
+
+import functools
+import hashlib
+import json
+import os
+from typing import Sequence
+
+from absl import app
+import numpy as np
+import jax
+import jax.numpy as jnp
+from jax.experimental import multihost_utils
+from jax.sharding import Mesh, NamedSharding, PartitionSpec as P
+from flax.traverse_util import flatten_dict
+from datasets import load_dataset
+
+from maxdiffusion import FlaxStableDiffusionPipeline, max_logging, pyconfig
+from maxdiffusion.input_pipeline._grain_data_processing import serialize_example
+from maxdiffusion.maxdiffusion_utils import encode, tokenize_captions, transform_images
+
+
+def encoder_hash(params, config):
+  """Hash of the frozen encoder weights and the settings that change the cached outputs."""
+  h = hashlib.sha256()
+  for name in ("vae", "text_encoder"):
+    for key, value in sorted(flatten_dict(params[name]).items()):
+      h.update("/".join((name,) + key).encode())
+      h.update(np.asarray(value).tobytes())
+  for setting in (config.resolution, config.dataset_name, config.train_split, config.hf_data_dir, config.hf_train_files):
+    h.update(str(setting).encode())
+  return h.hexdigest()[:16]
+
+
+def encode_batch(images, input_ids, vae, vae_params, text_encoder, text_encoder_params):
+  """(NCHW images, token ids) to (NHWC moments, encoder hidden states), as ParseFeatures returns them."""
+  posterior = vae.apply({"params": vae_params}, images, deterministic=True, method=vae.encode).latent_dist
+  moments = jnp.concatenate([posterior.mean, posterior.logvar], axis=-1)
+  encoder_hidden_states = encode(input_ids, text_encoder, text_encoder_params)
+  return moments.astype(jnp.float32), encoder_hidden_states.astype(jnp.float32)
+
+
+def _write_shard(shard_path, examples, p_encode_batch, batch_size):
+  """Encodes `examples` in batches of `batch_size` and writes them to `shard_path`."""
+  from array_record.python.array_record_module import ArrayRecordWriter  # pylint: disable=import-outside-toplevel
+
+  # Renamed into place once complete, a restarted job rewrites partial shards.
+  tmp_path = shard_path + ".tmp"
+  writer = ArrayRecordWriter(tmp_path, "group_size:1")
+  for start in range(0, len(examples), batch_size):
+    batch = examples[start : start + batch_size]
+    num_examples = len(batch["input_ids"])
+    images = np.asarray(batch["pixel_values"])
+    input_ids = np.asarray(batch["input_ids"])
+    # Pad the last batch so the encoders compile once.
+    pad = batch_size - num_examples
+    images = np.pad(images, [(0, pad)] + [(0, 0)] * (images.ndim - 1))
+    input_ids = np.pad(input_ids, [(0, pad), (0, 0)])
+    moments, encoder_hidden_states = jax.device_get(p_encode_batch(images, input_ids))
+    for i in range(num_examples):
+      writer.write(serialize_example(moments[i], encoder_hidden_states[i]))
+  writer.close()
+  os.replace(tmp_path, shard_path)
+
+
+def _update_manifest(manifest_path, key, entry):
+  manifest = {}
+  if os.path.exists(manifest_path):
+    with open(manifest_path, "r", encoding="utf-8") as f:
+      manifest = json.load(f)
+  manifest[key] = entry
+  with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+    json.dump(manifest, f, indent=2)
+  os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def run(config):
+  if not config.latents_cache_dir:
+    raise ValueError("cache_latents requires latents_cache_dir.")
+
+  pipeline, params = FlaxStableDiffusionPipeline.from_pretrained(
+      config.pretrained_model_name_or_path,
+      revision=config.revision,
+      dtype=config.activations_dtype,
+      safety_checker=None,
+      feature_extractor=None,
+      from_pt=config.from_pt,
+      split_head_dim=config.split_head_dim,
+      attention_kernel="dot_product",
+      flash_block_sizes=None,
+      mesh=None,
+  )
+  cache_key = encoder_hash(params, config)
+  cache_dir = os.path.join(config.latents_cache_dir, cache_key)
+  os.makedirs(cache_dir, exist_ok=True)
+
+  # Each host only runs on its own devices, hosts work through different shards.
+  local_mesh = Mesh(np.array(jax.local_devices()), ("data",))
+  data_sharding = NamedSharding(local_mesh, P("data"))
+  p_encode_batch = jax.jit(
+      functools.partial(
+          encode_batch,
+          vae=pipeline.vae,
+          vae_params=params["vae"],
+          text_encoder=pipeline.text_encoder,
+          text_encoder_params=params["text_encoder"],
+      ),
+      in_shardings=(data_sharding, data_sharding),
+  )
+  batch_size = config.per_device_batch_size * jax.local_device_count()
+
+  ds = load_dataset(
+      config.dataset_name,
+      split=config.train_split,
+      data_dir=config.hf_data_dir or None,
+      data_files=config.hf_train_files or None,
+      token=config.hf_access_token or None,
+  )
+  ds = ds.select_columns([config.caption_column, config.image_column])
+  records_per_shard = config.latents_cache_records_per_shard
+  num_shards = max(1, -(-len(ds) // records_per_shard))
+  shard_names = [f"latents-{i:05d}-of-{num_shards:05d}.array_record" for i in range(num_shards)]
+
+  for i in range(jax.process_index(), num_shards, jax.process_count()):
+    shard_path = os.path.join(cache_dir, shard_names[i])
+    if os.path.exists(shard_path):
+      max_logging.log(f"Skipping {shard_names[i]}, already written")
+      continue
+    examples = ds.select(range(i * records_per_shard, min((i + 1) * records_per_shard, len(ds))))
+    examples = examples.map(
+        functools.partial(tokenize_captions, caption_column=config.caption_column, tokenizer=pipeline.tokenizer),
+        batched=True,
+        remove_columns=[config.caption_column],
+    )
+    examples = examples.map(
+        functools.partial(transform_images, image_column=config.image_column, image_resolution=config.resolution),
+        batched=True,
+        remove_columns=[config.image_column],
+    )
+    _write_shard(shard_path, examples.with_format("numpy"), p_encode_batch, batch_size)
+    max_logging.log(f"Wrote {shard_names[i]}: {len(examples)} records")
+
+  multihost_utils.sync_global_devices("cache_latents")
+  if jax.process_index() == 0:
+    _update_manifest(
+        os.path.join(config.latents_cache_dir, "manifest.json"),
+        cache_key,
+        {
+            "pretrained_model_name_or_path": config.pretrained_model_name_or_path,
+            "revision": config.revision,
+            "dataset_name": config.dataset_name,
+            "train_split": config.train_split,
+            "resolution": config.resolution,
+            "num_records": len(ds),
+            "shards": shard_names,
+        },
+    )
+  max_logging.log(f"Latent cache complete, train with grain_train_files={os.path.join(cache_dir, '*.array_record')}")
+
+
+def main(argv: Sequence[str]) -> None:
+  pyconfig.initialize(argv)
+  run(pyconfig.config)
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -15,39 +15,58 @@
  """
 
 from abc import ABC
-from contextlib import nullcontext
-import os
-import json
+import dataclasses
 import functools
 import jax
+import jax.numpy as jnp
 from jax.sharding import Mesh
 import orbax.checkpoint as ocp
 import grain.python as grain
 from maxdiffusion import (
     max_utils,
-    FlaxStableDiffusionPipeline,
-    FlaxStableDiffusionXLPipeline,
-    FlaxUNet2DConditionModel,
-    FlaxAutoencoderKL,
     max_logging,
 )
-
-from transformers import (CLIPTokenizer, FlaxCLIPTextModel, CLIPTextConfig, FlaxCLIPTextModelWithProjection)
+from maxdiffusion.models.f5.transformers.transformer_f5_flax import F5TextEmbedding, F5Transformer2DModel, TimestepEmbedding
 
 from maxdiffusion.checkpointing.checkpointing_utils import (
+    CheckpointSaveTimer,
     create_orbax_checkpoint_manager,
-    load_stable_diffusion_configs,
+    load_f5_configs,
+    load_f5_params,
+    load_state_if_possible,
+    F5_CHECKPOINT,
 )
 
-STABLE_DIFFUSION_CHECKPOINT = "STABLE_DIFFUSION_CHECKPOINT"
-STABLE_DIFFUSION_XL_CHECKPOINT = "STABLE_DIFUSSION_XL_CHECKPOINT"
-_CHECKPOINT_FORMAT_DIFFUSERS = "CHECKPOINT_FORMAT_DIFFUSERS"
+_CHECKPOINT_FORMAT_PYTORCH = "CHECKPOINT_FORMAT_PYTORCH"
 _CHECKPOINT_FORMAT_ORBAX = "CHECKPOINT_FORMAT_ORBAX"
 
+# F5Transformer2DModel fields that define the architecture, saved as `f5_config`.
+F5_CONFIG_FIELDS = (
+    "text_num_embeds",
+    "text_dim",
+    "mel_dim",
+    "conv_layers",
+    "dim",
+    "dim_head",
+    "depth",
+    "heads",
+    "mlp_ratio",
+    "qkv_bias",
+    "guidance_embeds",
+)
+
+
+@dataclasses.dataclass
+class F5Pipeline:
+  """The F5 modules trained together: the DiT and the text embedding feeding it."""
+
+  transformer: F5Transformer2DModel
+  text_encoder: F5TextEmbedding
+
 
 class BaseF5Checkpointer(ABC):
 
-  def __init__(self, config, checkpoint_type):
+  def __init__(self, config, checkpoint_type=F5_CHECKPOINT):
     self.config = config
     self.checkpoint_type = checkpoint_type
     self.checkpoint_format = None
@@ -63,7 +82,9 @@ class BaseF5Checkpointer(ABC):
         save_interval_steps=1,
         checkpoint_type=checkpoint_type,
         dataset_type=config.dataset_type,
+        use_async=config.async_checkpointing,
     )
+    self.checkpoint_save_timer = CheckpointSaveTimer(self.checkpoint_manager)
 
   def _create_optimizer(self, config, learning_rate):
 
@@ -81,21 +102,69 @@ class BaseF5Checkpointer(ABC):
 
       tx, learning_rate_scheduler = self._create_optimizer(self.config, learning_rate)
 
-    weights_init_fn = functools.partial(pipeline.unet.init_weights, rng=self.rng)
-    unet_state, state_mesh_shardings = max_utils.setup_initial_state(
-        model=pipeline.unet,
+    weights_init_fn = functools.partial(
+        pipeline.transformer.init_weights, rngs=self.rng, max_sequence_length=self.config.max_sequence_length
+    )
+    dit_state, state_mesh_shardings = max_utils.setup_initial_state(
+        model=pipeline.transformer,
         tx=tx,
         config=self.config,
         mesh=self.mesh,
         weights_init_fn=weights_init_fn,
-        model_params=None if self.config.train_new_unet else params.get("unet", None),
+        model_params=None if self.config.train_new_unet else params.get("transformer", None),
         checkpoint_manager=self.checkpoint_manager,
         checkpoint_item=checkpoint_item_name,
         training=is_training,
+        offload_opt_state=self.config.offload_opt_state_to_host,
+    )
+    return dit_state, state_mesh_shardings, learning_rate_scheduler
+
+  def create_dit_ema(self, dit_state, dit_state_shardings, checkpoint_item_name):
+    """Returns (float32 EMA of the DiT params, its shardings), or (None, None) when ema_decay is 0.
+
+    The EMA has the params' sharding, in pinned host memory with ema_offload_to_host. It is
+    restored from the checkpoint or starts from the current DiT params.
+    """
+    if self.config.ema_decay <= 0:
+      return None, None
+    memory_kind = "pinned_host" if self.config.ema_offload_to_host else "device"
+    ema_shardings = max_utils.with_memory_kind(dit_state_shardings.params, memory_kind)
+    abstract_ema = jax.tree_util.tree_map(
+        lambda x, s: jax.ShapeDtypeStruct(x.shape, jnp.float32, sharding=s), dit_state.params, ema_shardings
+    )
+    ema = load_state_if_possible(
+        self.checkpoint_manager, abstract_ema, checkpoint_item_name, self.config.enable_single_replica_ckpt_restoring
     )
-    return unet_state, state_mesh_shardings, learning_rate_scheduler
-  
+    if ema:
+      return ema[checkpoint_item_name], ema_shardings
+    # A copy, the train step donates the params.
+    ema = jax.jit(
+        lambda params: jax.tree_util.tree_map(lambda x: x.astype(jnp.float32), params), out_shardings=ema_shardings
+    )(dit_state.params)
+    return ema, ema_shardings
+
+  def create_text_encoder_state(self, pipeline, params, checkpoint_item_name, is_training):
+
+    tx = None
+    if is_training:
+      learning_rate = self.config.text_encoder_learning_rate
+      tx, learning_rate_scheduler = self._create_optimizer(self.config, learning_rate)
+      self.text_encoder_learning_rate_scheduler = learning_rate_scheduler
 
+    weights_init_fn = functools.partial(
+        pipeline.text_encoder.init_weights, rngs=self.rng, max_sequence_length=self.config.max_sequence_length
+    )
+    return max_utils.setup_initial_state(
+        model=pipeline.text_encoder,
+        tx=tx,
+        config=self.config,
+        mesh=self.mesh,
+        weights_init_fn=weights_init_fn,
+        model_params=None if self.config.train_new_unet else params.get("text_encoder", None),
+        checkpoint_manager=self.checkpoint_manager,
+        checkpoint_item=checkpoint_item_name,
+        training=is_training,
+    )
 
   def restore_data_iterator_state(self, data_iterator):
     if (
@@ -113,168 +182,90 @@ class BaseF5Checkpointer(ABC):
       max_logging.log("data iterator checkpoint not found")
     return data_iterator
 
-  def _get_pipeline_class(self):
-    if self.checkpoint_type == STABLE_DIFFUSION_CHECKPOINT:
-      pipeline_class = FlaxStableDiffusionPipeline
-    else:
-      pipeline_class = FlaxStableDiffusionXLPipeline
-
-    return pipeline_class
-
   def _set_checkpoint_format(self, checkpoint_format):
     self.checkpoint_format = checkpoint_format
 
-  def load_diffusers_checkpoint(self):
-    pipeline_class = self._get_pipeline_class()
-
-    precision = max_utils.get_precision(self.config)
-    flash_block_sizes = max_utils.get_flash_block_sizes(self.config)
-
-    # Multiprocess computations aren't implemented on cpu backend.
-    if jax.device_count() == jax.local_device_count():
-      context = jax.default_device(jax.devices("cpu")[0])
-    else:
-      context = nullcontext()
-    with context:
-      pipeline, params = pipeline_class.from_pretrained(
-          self.config.pretrained_model_name_or_path,
-          revision=self.config.revision,
-          dtype=self.config.activations_dtype,
-          weights_dtype=self.config.weights_dtype,
-          safety_checker=None,
-          feature_extractor=None,
-          from_pt=self.config.from_pt,
-          split_head_dim=self.config.split_head_dim,
-          norm_num_groups=self.config.norm_num_groups,
-          attention_kernel=self.config.attention,
-          flash_block_sizes=flash_block_sizes,
-          mesh=self.mesh,
-          precision=precision,
-      )
-
-      if len(self.config.unet_checkpoint) > 0:
-        unet, unet_params = FlaxUNet2DConditionModel.from_pretrained(
-            self.config.unet_checkpoint,
-            split_head_dim=self.config.split_head_dim,
-            norm_num_groups=self.config.norm_num_groups,
-            attention_kernel=self.config.attention,
-            flash_block_sizes=flash_block_sizes,
-            dtype=self.activations_dtype,
-            weights_dtype=self.weights_dtype,
-            mesh=self.mesh,
-        )
-        params["unet"] = unet_params
-        pipeline.unet = unet
-      params = jax.tree_util.tree_map(lambda x: x.astype(self.config.weights_dtype), params)
-    return pipeline, params
+  def create_f5_pipeline(self, f5_config=None):
+    """Builds the F5 modules, with the architecture in `f5_config` if given."""
+    f5_config = f5_config or {}
+    transformer = F5Transformer2DModel(
+        mesh=self.mesh,
+        attention_kernel=self.config.attention,
+        flash_block_sizes=max_utils.get_flash_block_sizes(self.config),
+        dtype=self.config.activations_dtype,
+        weights_dtype=self.config.weights_dtype,
+        precision=max_utils.get_precision(self.config),
+        scan_layers=self.config.scan_layers,
+        remat_policy=self.config.remat_policy,
+        **f5_config,
+    )
+    text_encoder = F5TextEmbedding(
+        text_num_embeds=transformer.text_num_embeds,
+        text_dim=transformer.text_dim,
+        conv_layers=transformer.conv_layers,
+        dtype=self.config.activations_dtype,
+        weights_dtype=self.config.weights_dtype,
+        precision=max_utils.get_precision(self.config),
+    )
+    return F5Pipeline(transformer=transformer, text_encoder=text_encoder)
 
-  def save_checkpoint(self, train_step, pipeline, params, train_states, data_iterator=None):
-    def config_to_json(model_or_config):
-      return json.loads(model_or_config.to_json_string())
+  def load_pytorch_checkpoint(self):
+    """Loads the F5-TTS pytorch checkpoint or train_f5.py checkpoint at `pretrained_model_name_or_path`."""
+    transformer_params, text_encoder_params = load_f5_params(
+        self.config.pretrained_model_name_or_path, use_ema=self.config.use_ema, scan_layers=self.config.scan_layers
+    )
+    params = {"transformer": transformer_params, "text_encoder": text_encoder_params}
+    return jax.tree_util.tree_map(lambda x: x.astype(self.config.weights_dtype), params)
 
+  def checkpoint_items(self, pipeline, train_states, data_iterator):
+    """The orbax save args of every item in a checkpoint."""
+    f5_config = {field: getattr(pipeline.transformer, field) for field in F5_CONFIG_FIELDS}
     items = {
-        "unet_config": ocp.args.JsonSave(config_to_json(pipeline.unet)),
-        "vae_config": ocp.args.JsonSave(config_to_json(pipeline.vae)),
-        "text_encoder_config": ocp.args.JsonSave(config_to_json(pipeline.text_encoder.config)),
-        "scheduler_config": ocp.args.JsonSave(config_to_json(pipeline.scheduler)),
+        "f5_config": ocp.args.JsonSave(f5_config),
+        "dit_state": ocp.args.PyTreeSave(train_states["dit_state"]),
+        "text_encoder_state": ocp.args.PyTreeSave(train_states["text_encoder_state"]),
     }
-
-    items["unet_state"] = ocp.args.PyTreeSave(train_states["unet_state"])
-    items["vae_state"] = ocp.args.PyTreeSave(train_states["vae_state"])
-    items["text_encoder_state"] = ocp.args.PyTreeSave(train_states["text_encoder_state"])
-
-    if hasattr(pipeline, "text_encoder_2"):
-      items["text_encoder_2_state"] = ocp.args.PyTreeSave(train_states["text_encoder_2_state"])
-      items["text_encoder_2_config"] = ocp.args.JsonSave(config_to_json(pipeline.text_encoder_2.config))
-
-    tokenizer_config = {"path": self.config.tokenizer_model_name_or_path}
-    items["tokenizer_config"] = ocp.args.JsonSave(tokenizer_config)
+    if train_states.get("dit_ema") is not None:
+      items["dit_ema"] = ocp.args.PyTreeSave(train_states["dit_ema"])
     if self.config.dataset_type == "grain":
       items["iter"] = grain.PyGrainCheckpointSave(data_iterator.local_iterator)
-    self.checkpoint_manager.save(train_step, args=ocp.args.Composite(**items))
+    return items
 
-  def load_params(self, step=None):
+  def init_guidance_embed(self, transformer):
+    """Guidance embedding params for a checkpoint trained without one.
 
-    self.checkpoint_format = _CHECKPOINT_FORMAT_ORBAX
+    The output layer starts at zero, so the model initially ignores the guidance scale and
+    reproduces the checkpoint.
+    """
+    params = TimestepEmbedding(dim=transformer.dim, weights_dtype=self.config.weights_dtype).init(
+        self.rng, jnp.zeros((1,))
+    )["params"]
+    params["linear2"] = jax.tree_util.tree_map(jnp.zeros_like, params["linear2"])
+    return params
 
-  def load_checkpoint(self, step=None, scheduler_class=None):
+  def save_checkpoint(self, train_step, pipeline, params, train_states, data_iterator=None):
+    items = self.checkpoint_items(pipeline, train_states, data_iterator)
+    return self.checkpoint_save_timer.save(train_step, args=ocp.args.Composite(**items))
 
-    pipeline_class = self._get_pipeline_class()
+  def load_checkpoint(self, step=None):
+    """Returns (pipeline, params).
 
+    If this run already has an orbax checkpoint, params is empty and the states are
+    restored from it by `setup_initial_state`. Otherwise params holds the converted
+    pytorch weights, or nothing when training a new model.
+    """
     self.checkpoint_format = _CHECKPOINT_FORMAT_ORBAX
-
-    precision = max_utils.get_precision(self.config)
-    flash_block_sizes = max_utils.get_flash_block_sizes(self.config)
-    # try loading using orbax, if not, use diffusers loading
-    model_configs = load_stable_diffusion_configs(self.config, self.checkpoint_manager, self.checkpoint_type, step)
-
-    pipeline, params = None, {}
-
-    if model_configs:
-      unet = FlaxUNet2DConditionModel.from_config(
-          model_configs[0]["unet_config"],
-          dtype=self.config.activations_dtype,
-          weights_dtype=self.config.weights_dtype,
-          from_pt=self.config.from_pt,
-          split_head_dim=self.config.split_head_dim,
-          norm_num_groups=self.config.norm_num_groups,
-          attention_kernel=self.config.attention,
-          flash_block_sizes=flash_block_sizes,
-          mesh=self.mesh,
-          precision=precision,
-      )
-
-      # vae = FlaxAutoencoderKL.from_config(
-      #     model_configs[0]["vae_config"],
-      #     dtype=self.config.activations_dtype,
-      #     weights_dtype=self.config.weights_dtype,
-      #     from_pt=self.config.from_pt,
-      # )
-
-      tokenizer_path = model_configs[0]["tokenizer_config"]["path"]
-      if "gs://" in tokenizer_path:
-        if "tokenizer" not in tokenizer_path:
-          tokenizer_path = os.path.join(tokenizer_path, "tokenizer")
-        tokenizer_path = max_utils.download_blobs(tokenizer_path, "/tmp")
-      tokenizer = CLIPTokenizer.from_pretrained(
-          tokenizer_path,
-          subfolder="tokenizer",
-          dtype=self.config.activations_dtype,
-      )
-
-      te_pretrained_config = CLIPTextConfig(**model_configs[0]["text_encoder_config"])
-      text_encoder = FlaxCLIPTextModel(
-          te_pretrained_config,
-          seed=self.config.seed,
-          dtype=self.config.activations_dtype,
-          _do_init=False,
-      )
-
-      scheduler = None
-      if scheduler_class:
-        scheduler = scheduler_class.from_config(model_configs[0]["scheduler_config"])
-
-      pipeline_kwargs = {
-          "unet": unet,
-          "vae": vae,
-          "text_encoder": text_encoder,
-          "scheduler": scheduler,
-          "tokenizer": tokenizer,
-      }
-
-      if self.checkpoint_type == STABLE_DIFFUSION_XL_CHECKPOINT:
-        te_pretrained_2_config = CLIPTextConfig(**model_configs[0]["text_encoder_2_config"])
-        text_encoder_2 = FlaxCLIPTextModelWithProjection(
-            te_pretrained_2_config, seed=self.config.seed, dtype=self.config.activations_dtype, _do_init=False
-        )
-        pipeline_kwargs["text_encoder_2"] = text_encoder_2
-        # both tokenizers in sdxl are the same.
-        pipeline_kwargs["tokenizer_2"] = tokenizer
-
-      pipeline = pipeline_class(**pipeline_kwargs)
+    f5_config = load_f5_configs(self.config, self.checkpoint_manager, step)
+    params = {}
+    if f5_config:
+      pipeline = self.create_f5_pipeline(f5_config)
     else:
-      max_logging.log(f"loading checkpoint specified in config : {self.config.pretrained_model_name_or_path}")
-      self.checkpoint_format = _CHECKPOINT_FORMAT_DIFFUSERS
-      pipeline, params = self.load_diffusers_checkpoint()
+      pipeline = self.create_f5_pipeline({"guidance_embeds": self.config.f5_guidance_embeds})
+      if not self.config.train_new_unet:
+        max_logging.log(f"loading checkpoint specified in config : {self.config.pretrained_model_name_or_path}")
+        self.checkpoint_format = _CHECKPOINT_FORMAT_PYTORCH
+        params = self.load_pytorch_checkpoint()
+        if pipeline.transformer.guidance_embeds and "guidance_embed" not in params["transformer"]:
+          params["transformer"]["guidance_embed"] = self.init_guidance_embed(pipeline.transformer)
 
     return pipeline, params
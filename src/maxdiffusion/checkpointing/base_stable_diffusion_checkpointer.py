@@ -35,6 +35,7 @@ from maxdiffusion import (
 from transformers import (CLIPTokenizer, FlaxCLIPTextModel, CLIPTextConfig, FlaxCLIPTextModelWithProjection)
 
 from maxdiffusion.checkpointing.checkpointing_utils import (
+    CheckpointSaveTimer,
     create_orbax_checkpoint_manager,
     load_stable_diffusion_configs,
 )
@@ -63,7 +64,9 @@ class BaseStableDiffusionCheckpointer(ABC):
         save_interval_steps=1,
         checkpoint_type=checkpoint_type,
         dataset_type=config.dataset_type,
+        use_async=config.async_checkpointing,
     )
+    self.checkpoint_save_timer = CheckpointSaveTimer(self.checkpoint_manager)
 
   def _create_optimizer(self, config, learning_rate):
 
@@ -92,6 +95,7 @@ class BaseStableDiffusionCheckpointer(ABC):
         checkpoint_manager=self.checkpoint_manager,
         checkpoint_item=checkpoint_item_name,
         training=is_training,
+        offload_opt_state=self.config.offload_opt_state_to_host,
     )
     return unet_state, state_mesh_shardings, learning_rate_scheduler
 
@@ -257,7 +261,7 @@ class BaseStableDiffusionCheckpointer(ABC):
     items["tokenizer_config"] = ocp.args.JsonSave(tokenizer_config)
     if self.config.dataset_type == "grain":
       items["iter"] = grain.PyGrainCheckpointSave(data_iterator.local_iterator)
-    self.checkpoint_manager.save(train_step, args=ocp.args.Composite(**items))
+    return self.checkpoint_save_timer.save(train_step, args=ocp.args.Composite(**items))
 
   def load_params(self, step=None):
 
@@ -18,12 +18,19 @@
 """Create an Orbax CheckpointManager with specified (Async or not) Checkpointer."""
 
 from typing import Optional, Any
+import datetime
+import time
 import jax
 import numpy as np
 import os
 
 import orbax.checkpoint
 from maxdiffusion import max_logging
+from maxdiffusion.models.modeling_flax_pytorch_utils import (
+    convert_f5_state_dict_to_flax,
+    stack_f5_block_params,
+    unstack_f5_block_params,
+)
 from etils import epath
 from flax.training import train_state
 import orbax
@@ -33,6 +40,7 @@ from orbax.checkpoint.checkpoint_manager import CheckpointManager, CheckpointMan
 
 STABLE_DIFFUSION_CHECKPOINT = "STABLE_DIFFUSION_CHECKPOINT"
 STABLE_DIFFUSION_XL_CHECKPOINT = "STABLE_DIFUSSION_XL_CHECKPOINT"
+F5_CHECKPOINT = "F5_CHECKPOINT"
 
 
 def create_orbax_checkpoint_manager(
@@ -56,16 +64,25 @@ def create_orbax_checkpoint_manager(
   max_logging.log(f"checkpoint dir: {checkpoint_dir}")
   p = epath.Path(checkpoint_dir)
 
-  item_names = (
-      "unet_config",
-      "vae_config",
-      "text_encoder_config",
-      "scheduler_config",
-      "unet_state",
-      "vae_state",
-      "text_encoder_state",
-      "tokenizer_config",
-  )
+  if checkpoint_type == F5_CHECKPOINT:
+    item_names = (
+        "f5_config",
+        "dit_state",
+        "dit_ema",
+        "text_encoder_state",
+        "f5_sampling",
+    )
+  else:
+    item_names = (
+        "unet_config",
+        "vae_config",
+        "text_encoder_config",
+        "scheduler_config",
+        "unet_state",
+        "vae_state",
+        "text_encoder_state",
+        "tokenizer_config",
+    )
   if checkpoint_type == STABLE_DIFFUSION_XL_CHECKPOINT:
     item_names += (
         "text_encoder_2_state",
@@ -89,6 +106,36 @@ def create_orbax_checkpoint_manager(
   return mngr
 
 
+class CheckpointSaveTimer:
+  """Splits the time of async checkpoint saves into the part that blocks the train loop and the background write.
+
+  The checkpoint manager keeps one save in flight, a new save first waits for the
+  previous one and that wait is counted as blocking.
+  """
+
+  def __init__(self, checkpoint_manager: CheckpointManager):
+    self.checkpoint_manager = checkpoint_manager
+    self._blocking_seconds = None
+    self._save_start = None
+
+  def save(self, step, args):
+    """Starts the save and returns the time it stopped blocking, for the next step time to exclude it."""
+    start = time.perf_counter()
+    self.checkpoint_manager.save(step, args=args)
+    self._blocking_seconds = time.perf_counter() - start
+    self._save_start = start
+    return datetime.datetime.now()
+
+  def record_metrics(self, metrics):
+    """Adds the blocking time of the last save and, once written, its total time to `metrics`."""
+    if self._blocking_seconds is not None:
+      metrics["scalar"].update({"perf/checkpoint_blocking_seconds": self._blocking_seconds})
+      self._blocking_seconds = None
+    if self._save_start is not None and not self.checkpoint_manager.is_saving_in_progress():
+      metrics["scalar"].update({"perf/checkpoint_save_seconds": time.perf_counter() - self._save_start})
+      self._save_start = None
+
+
 def load_stable_diffusion_configs(
     config: dict,
     checkpoint_manager: CheckpointManager,
@@ -123,6 +170,114 @@ def load_stable_diffusion_configs(
   return (checkpoint_manager.restore(step, args=orbax.checkpoint.args.Composite(**restore_args)), None)
 
 
+def load_f5_configs(
+    config: dict,
+    checkpoint_manager: CheckpointManager,
+    step: Optional[int] = None,
+):
+  """
+  Loads the F5 transformer and text embedding configs saved with an F5 checkpoint.
+
+  Args:
+  checkpoint_manager (`orbax.checkpoint.checkpoint_manager`)
+  step (int) : step to restore, if None is passed, defaults to latest.
+  """
+  max_logging.log("Restoring f5 configs")
+  if step is None:
+    step = checkpoint_manager.latest_step()
+    if step is None:
+      return None
+
+  restore_args = {"f5_config": orbax.checkpoint.args.JsonRestore()}
+  return checkpoint_manager.restore(step, args=orbax.checkpoint.args.Composite(**restore_args))["f5_config"]
+
+
+def _f5_step_dir(path: str, step: Optional[int] = None):
+  """The step directory of a train_f5.py checkpoint directory, None for a pytorch checkpoint file."""
+  checkpoint_dir = epath.Path(path)
+  if not checkpoint_dir.is_dir():
+    return None
+  if step is None:
+    step = max(int(p.name) for p in checkpoint_dir.iterdir() if p.name.isdigit())
+  return checkpoint_dir / str(step)
+
+
+def load_f5_sampling_config(path: str, step: Optional[int] = None):
+  """
+  Loads the `f5_sampling` item saved by train_f5_distill.py, empty for other F5 checkpoints.
+
+  It holds `guidance_distilled`, whether the conditional pass alone gives the guided velocity,
+  and the `num_inference_steps` and `sway_sampling_coef` the checkpoint was distilled for.
+
+  Args:
+  path (`str`) : an F5-TTS pytorch checkpoint file or a train_f5.py checkpoint directory.
+  step (int) : step to restore from a checkpoint directory, if None is passed, defaults to latest.
+  """
+  step_dir = _f5_step_dir(path, step)
+  if step_dir is None or not (step_dir / "f5_sampling").exists():
+    return {}
+  return ocp.Checkpointer(ocp.JsonCheckpointHandler()).restore(step_dir / "f5_sampling", args=ocp.args.JsonRestore())
+
+
+def check_f5_sampling_config(sampling_config: dict, num_inference_steps: int, sway_sampling_coef: Optional[float]):
+  """
+  Raises a ValueError if a step distilled checkpoint would be sampled on another timestep grid than it was distilled for.
+
+  Args:
+  sampling_config (`dict`) : the `f5_sampling` item returned by `load_f5_sampling_config`.
+  num_inference_steps (int) : number of sampling steps.
+  sway_sampling_coef (float) : sway sampling coefficient of the timesteps, None without sway sampling.
+  """
+  distilled_steps = sampling_config.get("num_inference_steps")
+  if distilled_steps is None:
+    return
+  distilled_coef = sampling_config["sway_sampling_coef"]
+  if num_inference_steps != distilled_steps or sway_sampling_coef != distilled_coef:
+    raise ValueError(
+        f"The checkpoint was distilled for num_inference_steps={distilled_steps} with sway_sampling_coef={distilled_coef}, "
+        f"got num_inference_steps={num_inference_steps} with sway_sampling_coef={sway_sampling_coef}"
+    )
+
+
+def load_f5_params(path: str, use_ema: bool = True, scan_layers: bool = False, step: Optional[int] = None):
+  """
+  Loads (transformer params, text embedding params) for F5 inference.
+
+  Args:
+  path (`str`) : an F5-TTS pytorch checkpoint file or a train_f5.py checkpoint directory.
+  use_ema (`bool`) : use the EMA weights, `dit_ema` for train_f5.py checkpoints saved with ema_decay > 0.
+  scan_layers (`bool`) : return the transformer blocks stacked for `scan_layers`.
+  step (int) : step to restore from a checkpoint directory, if None is passed, defaults to latest.
+  """
+  step_dir = _f5_step_dir(path, step)
+  if step_dir is None:
+    return convert_f5_state_dict_to_flax(path, use_ema=use_ema, scan_layers=scan_layers)
+
+  max_logging.log(f"Restoring F5 params from {step_dir}")
+
+  ckptr = ocp.PyTreeCheckpointer()
+
+  def restore_on_host(item_dir):
+    metadata = ckptr.metadata(item_dir)
+    metadata = getattr(metadata, "tree", metadata)
+    restore_args = jax.tree_util.tree_map(lambda _: ocp.RestoreArgs(restore_type=np.ndarray), metadata)
+    return ckptr.restore(item_dir, args=ocp.args.PyTreeRestore(restore_args=restore_args))
+
+  if use_ema and (step_dir / "dit_ema").exists():
+    transformer_params = restore_on_host(step_dir / "dit_ema")
+  else:
+    if use_ema:
+      max_logging.log(f"{step_dir} has no dit_ema, using the trained params")
+    transformer_params = restore_on_host(step_dir / "dit_state")["params"]
+  text_encoder_params = restore_on_host(step_dir / "text_encoder_state")["params"]
+
+  if scan_layers and "blocks" not in transformer_params:
+    transformer_params = stack_f5_block_params(transformer_params)
+  elif not scan_layers and "blocks" in transformer_params:
+    transformer_params = unstack_f5_block_params(transformer_params)
+  return transformer_params, text_encoder_params
+
+
 def load_params_from_path(
     config,
     checkpoint_manager: CheckpointManager,
@@ -0,0 +1,109 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Encoding of synthesized F5 audio for HTTP responses, from mono 16 bit PCM.
+
+WAV is framed here, FLAC, Opus (in Ogg) and MP3 go through libsndfile, which needs version
+1.1 for MP3. `AudioEncoder` encodes a response incrementally, each call returns the bytes
+that are ready to send.
+"""
+
+import io
+import struct
+
+import numpy as np
+import soundfile as sf
+
+from maxdiffusion.f5_engine import TARGET_SR
+
+# format -> (content type, soundfile format and subtype)
+AUDIO_FORMATS = {
+    "wav": ("audio/wav", None),
+    "flac": ("audio/flac", ("FLAC", "PCM_16")),
+    "opus": ("audio/ogg", ("OGG", "OPUS")),
+    "mp3": ("audio/mpeg", ("MP3", "MPEG_LAYER_III")),
+}
+
+
+def available_audio_formats():
+  """The formats of AUDIO_FORMATS the installed libsndfile can write."""
+  return [
+      audio_format
+      for audio_format, (_, sf_format) in AUDIO_FORMATS.items()
+      if sf_format is None or sf.check_format(*sf_format)
+  ]
+
+
+def wav_header(num_samples=None, sample_rate=TARGET_SR):
+  """Mono 16 bit PCM header, without `num_samples` the sizes are left at their maximum for streaming."""
+  data_bytes = 0xFFFFFFFF - 36 if num_samples is None else 2 * num_samples
+  fmt = struct.pack("<IHHIIHH", 16, 1, 1, sample_rate, 2 * sample_rate, 2, 16)
+  return b"RIFF" + struct.pack("<I", 36 + data_bytes) + b"WAVEfmt " + fmt + b"data" + struct.pack("<I", data_bytes)
+
+
+def pcm16(audio):
+  return (np.clip(audio, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+
+
+class AudioEncoder:
+  """Encodes the 16 bit PCM of one response piece by piece."""
+
+  def __init__(self, audio_format, sample_rate=TARGET_SR):
+    self.audio_format = audio_format
+    self.sample_rate = sample_rate
+    self.buffer = io.BytesIO()
+    self.sent = 0
+    self.file = None
+    sf_format = AUDIO_FORMATS[audio_format][1]
+    if sf_format is None:
+      self.buffer.write(wav_header(sample_rate=sample_rate))
+    else:
+      self.file = sf.SoundFile(
+          self.buffer, mode="w", samplerate=sample_rate, channels=1, format=sf_format[0], subtype=sf_format[1]
+      )
+
+  def _take(self):
+    # libsndfile may seek back to finish a header on close, what was sent already keeps its
+    # streaming values (e.g. an unknown FLAC length).
+    with self.buffer.getbuffer() as view:
+      data = bytes(view[self.sent :])
+    self.sent += len(data)
+    return data
+
+  def encode(self, pcm):
+    """Returns the encoded bytes ready after `pcm`, possibly none while the encoder buffers."""
+    if self.file is None:
+      self.buffer.write(pcm)
+    else:
+      self.file.write(np.frombuffer(pcm, dtype="<i2"))
+      self.file.flush()
+    return self._take()
+
+  def close(self):
+    """Returns the remaining bytes."""
+    if self.file is not None:
+      self.file.close()
+    return self._take()
+
+
+def encode_audio(pcm, audio_format, sample_rate=TARGET_SR):
+  """A complete file of `pcm`, with its lengths filled in."""
+  if AUDIO_FORMATS[audio_format][1] is None:
+    return wav_header(len(pcm) // 2, sample_rate) + pcm
+  encoder = AudioEncoder(audio_format, sample_rate)
+  encoder.encode(pcm)
+  encoder.close()
+  return encoder.buffer.getvalue()
@@ -0,0 +1,617 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""F5 synthesis on the AOT executables of generate_f5_aot.py, without a UI.
+
+Synthesis is split in a host side `prepare`, which turns a request into text chunks (reference
+mel, token ids, duration estimate), and a device side `run_batch` over chunks of any number of
+requests. Chunks of different requests share a batch when they share the per batch inputs of
+`batch_key`: the timesteps and the guidance controls. The guidance scale is baked into the
+run_inference executables when generate_f5_aot.py lowers them.
+
+Each chunk has a content key, see `chunk_cache_key`. `prepare` looks the chunks up in a
+f5_result_cache.ResultCache before any device work, only the missing ones need `run_batch`.
+
+With serve_replicas > 1 the local devices are split into that many groups, see
+`replica_device_groups`, and each F5Engine holds its own copy of the weights on one group.
+generate_f5_aot.py then compiles every executable once per group, with an "_r{replica}" suffix.
+
+The executables take the weights as arguments, so a checkpoint of the same shapes can replace
+the served one without a recompile: `load_weights` puts it next to the served weights,
+`canary` checks it, and `swap_weights` serves it from the next batch on.
+
+`run_batch` is `dispatch_batch` then `finish_batch`. Dispatch builds the inputs on the host and
+enqueues the executables without waiting for them, finish waits for the audio. A server can
+dispatch the next batch while the devices still run the previous one, see f5_server.ChunkBatcher.
+"""
+
+import dataclasses
+import functools
+import hashlib
+import json
+import os
+import pickle
+import time
+import unicodedata
+
+import flax
+import jax
+import jax.numpy as jnp
+import numpy as np
+from jax.experimental.serialize_executable import deserialize_and_load
+from jax.sharding import Mesh, NamedSharding, PartitionSpec as P
+from jax_vocos import load_model as load_vocos_model
+
+from maxdiffusion import max_logging
+from maxdiffusion.checkpointing.checkpointing_utils import check_f5_sampling_config, load_f5_params, load_f5_sampling_config
+from maxdiffusion.f5_text_utils import chunk_text, convert_char_to_pinyin, get_tokenizer, lens_to_mask, list_str_to_idx
+from maxdiffusion.max_utils import create_device_mesh, get_flash_block_sizes, get_precision, setup_initial_state
+from maxdiffusion.models import quantizations
+from maxdiffusion.models.f5.transformers.transformer_f5_flax import F5Transformer2DModel
+from maxdiffusion.quantize_f5 import load_quantized_transformer_state
+from maxdiffusion.schedulers.flow_match_guidance import (
+    guidance_controls_from_config,
+    guidance_cost,
+    init_guidance_controls,
+)
+
+TARGET_SR = 24000
+HOP_LENGTH = 256  # get_mel's hop, audio samples per mel frame
+MAX_DURATION_SECS = 40  # reference + generation
+DEFAULT_BUCKET_SIZES = (4, 8, 16, 32, 64)
+
+
+class SynthesisError(ValueError):
+  """A request the engine cannot synthesize, e.g. empty text or too long a reference."""
+
+
+@dataclasses.dataclass
+class SynthesisRequest:
+  gen_text: str
+  ref_text: str
+  ref_audio: np.ndarray  # mono float32 at TARGET_SR
+  speed: float = 1.0
+  sway_sampling: bool = False
+  cfg_t_min: float = 0.0
+  cfg_t_max: float = 1.0
+  null_pred_every: int = 1
+  seed: int = 0
+
+
+@dataclasses.dataclass
+class Chunk:
+  """One batch row, a text chunk of a request with its reference.
+
+  A chunk found in the result cache has its `pcm` and no model inputs.
+  """
+
+  key: str  # content key, see F5Engine.chunk_cache_key
+  text_ids: np.ndarray = None  # (max_sequence_length,) int32
+  cond: np.ndarray = None  # (max_sequence_length, n_mels), reference mel, zero past ref_len
+  ref_len: int = 0  # reference frames
+  duration: int = 0  # estimated frames, reference included
+  seed: int = 0
+  pcm: bytes = None  # cached 16 bit audio
+
+
+@dataclasses.dataclass
+class PendingBatch:
+  """A dispatched batch, its outputs may still be computing."""
+
+  chunks: list
+  bucket: int
+  durations: np.ndarray  # frames of each row
+  audio: jax.Array  # (len(chunks), samples)
+  hit_rate: jax.Array
+  guidance_cost: float
+  dispatched_at: float
+
+
+def batch_key(request):
+  """Chunks with equal keys can share a batch."""
+  return (request.sway_sampling, request.cfg_t_min, request.cfg_t_max, request.null_pred_every)
+
+
+def sample_timesteps(num_inference_steps, sway_sampling_coef=None):
+  timesteps = np.linspace(0.0, 1.0, num_inference_steps + 1).astype(np.float32)
+  if sway_sampling_coef is not None:
+    timesteps = timesteps + sway_sampling_coef * (np.cos(np.pi / 2 * timesteps) - 1 + timesteps)
+    timesteps = np.clip(timesteps, 0.0, 1.0)
+  return timesteps
+
+
+def _path_signature(path):
+  """Identifies the contents of a file or directory, None when missing.
+
+  A file by its (size, modification time). A directory's own stat does not change when the files
+  in it do, so a directory by those of every file under it; for a train_f5.py checkpoint
+  directory, under its latest step, the one that gets loaded.
+  """
+  try:
+    if not os.path.isdir(path):
+      stat = os.stat(path)
+      return (stat.st_size, stat.st_mtime_ns)
+    steps = [name for name in os.listdir(path) if name.isdigit()]
+    root = os.path.join(path, max(steps, key=int)) if steps else path
+    files = []
+    for dirpath, _, filenames in os.walk(root):
+      for filename in filenames:
+        file_path = os.path.join(dirpath, filename)
+        stat = os.stat(file_path)
+        files.append((os.path.relpath(file_path, path), stat.st_size, stat.st_mtime_ns))
+    return sorted(files)
+  except (OSError, TypeError):
+    return None
+
+
+def replica_device_groups(num_replicas, devices=None):
+  """Splits the local devices, ordered by id, into `num_replicas` groups of neighbours."""
+  devices = sorted(devices or jax.local_devices(), key=lambda device: device.id)
+  if len(devices) % num_replicas:
+    raise ValueError(f"{len(devices)} devices cannot be split into {num_replicas} replicas.")
+  size = len(devices) // num_replicas
+  return [devices[i : i + size] for i in range(0, len(devices), size)]
+
+
+def executable_suffixes(config):
+  """File name suffix of the executables of each replica."""
+  if config.serve_replicas <= 1:
+    return [""]
+  return [f"_r{replica}" for replica in range(config.serve_replicas)]
+
+
+def _weights_signature(weights):
+  return jax.tree_util.tree_structure(weights), [
+      (np.shape(leaf), str(getattr(leaf, "dtype", type(leaf)))) for leaf in jax.tree_util.tree_leaves(weights)
+  ]
+
+
+def load_executable(path, shaped_args, num_outputs=1):
+  """Deserializes an executable of generate_f5_aot.py.
+
+  Its outputs are one array or a flat tuple of `num_outputs` arrays, so the output tree does
+  not need an `eval_shape` of the lowered function.
+  """
+  with open(path, "rb") as f:
+    serialized = pickle.load(f)
+  in_tree = jax.tree_util.tree_structure((shaped_args, {}))
+  out_tree = jax.tree_util.tree_structure(tuple(range(num_outputs)) if num_outputs > 1 else 0)
+  return deserialize_and_load(serialized, in_tree, out_tree)
+
+
+class F5Engine:
+  """Holds the weights and the per bucket executables of one mesh.
+
+  A replica engine builds its mesh from `devices`, one group of `replica_device_groups`.
+  """
+
+  def __init__(self, config, devices=None, replica=None):
+    self.config = config
+    self.devices = devices
+    self.replica = replica
+    self.suffix = "" if replica is None else executable_suffixes(config)[replica]
+    self.bucket_sizes = sorted(config.aot_bucket_sizes or DEFAULT_BUCKET_SIZES)
+    self.max_chunks = self.bucket_sizes[-1]
+    self.max_sequence_length = config.max_sequence_length
+    self.loaded = False
+    self.warm_buckets = set()
+    self.bucket_secs = {}  # bucket -> moving average of run_batch seconds, at full guidance cost
+    self.last_finished = 0.0
+
+  def _rngs(self, seed):
+    rng = jax.random.key(seed)
+    return {"params": rng, "dropout": rng}
+
+  def load_transformer_state(self, pretrained_model_name_or_path, quantized_params_path=None):
+    """The sharded transformer state of a checkpoint, see setup_models_and_state of the Gradio apps.
+
+    With quantization the transformer weights come from `quantized_params_path`, by default
+    config.quantized_params_path.
+    """
+    config = self.config
+    transformer = F5Transformer2DModel(
+        mesh=self.mesh,
+        attention_kernel=config.attention,
+        flash_block_sizes=get_flash_block_sizes(config),
+        dtype=config.activations_dtype,
+        weights_dtype=config.weights_dtype,
+        precision=get_precision(config),
+        scan_layers=config.scan_layers,
+        remat_policy=config.remat_policy,
+        quant=quantizations.configure_quantization(config, "serve"),
+    )
+    transformer_params, text_encoder_params = load_f5_params(
+        pretrained_model_name_or_path, use_ema=config.use_ema, scan_layers=config.scan_layers
+    )
+    if "guidance_embed" in transformer_params:
+      transformer = transformer.clone(guidance_embeds=True)
+    weights_init_fn = functools.partial(
+        transformer.init_weights,
+        rngs=jax.random.key(config.seed),
+        max_sequence_length=config.max_sequence_length,
+        eval_only=False,
+    )
+    state, state_shardings = setup_initial_state(
+        model=transformer,
+        tx=None,
+        config=config,
+        mesh=self.mesh,
+        weights_init_fn=weights_init_fn,
+        model_params=None,
+        training=False,
+    )
+    state = state.replace(params=transformer_params)
+    if config.quantization:
+      state, state_shardings = load_quantized_transformer_state(
+          transformer, config, self.mesh, state, state_shardings, quantized_params_path
+      )
+    return jax.device_put(state, state_shardings), text_encoder_params
+
+  def _replicate(self, params):
+    # Replicated on this engine's mesh, a replica's executables only run on its own devices.
+    replicated = None if self.replica is None else NamedSharding(self.mesh, P())
+    return jax.device_put(flax.core.frozen_dict.FrozenDict(params), replicated)
+
+  def load(self):
+    config = self.config
+    t_start = time.time()
+    if not config.mesh_axes:
+      raise ValueError("config.mesh_axes must be defined (e.g., ['data'])")
+    self.mesh = Mesh(create_device_mesh(config, self.devices), config.mesh_axes)
+    self.data_sharding = NamedSharding(self.mesh, P(config.data_sharding[0]))
+    seq_len = self.max_sequence_length
+
+    self.vocab_char_map, _ = get_tokenizer(config.vocab_name_or_path, "custom")
+    self.model_path = config.pretrained_model_name_or_path
+    self.quantized_params_path = config.quantized_params_path
+    sampling_config = load_f5_sampling_config(self.model_path)
+    check_f5_sampling_config(sampling_config, config.num_inference_steps, config.sway_sampling_coef)
+    # Baked into the executables by generate_f5_aot.py, swapped weights must match it.
+    self.guidance_distilled = sampling_config.get("guidance_distilled", False)
+    self.transformer_state, text_encoder_params = self.load_transformer_state(self.model_path)
+    self.text_encoder_params = self._replicate(text_encoder_params)
+    _, vocos_params = load_vocos_model(config.vocoder_model_path)
+    self.vocos_params = self._replicate(vocos_params)
+
+    def compiled(name):
+      return os.path.join(config.compiled_path, f"{name}{self.suffix}.pickle")
+
+    self.get_mel = load_executable(
+        compiled("get_mel_aot"), (jax.ShapeDtypeStruct((1, (seq_len + 1) * HOP_LENGTH), jnp.float32),)
+    )
+    rngs = self._rngs(config.seed)
+    controls = guidance_controls_from_config(config)
+    self.text_encode, self.vocos_apply, self.run_inference = {}, {}, {}
+    for bucket in self.bucket_sizes:
+      ids = jax.ShapeDtypeStruct((bucket, seq_len), jnp.int32)
+      latents = jax.ShapeDtypeStruct((bucket, seq_len, config.n_mels), jnp.float32)
+      text_embed = jax.ShapeDtypeStruct((bucket, seq_len, config.text_dim), jnp.float32)
+      ts = jax.ShapeDtypeStruct((config.num_inference_steps,), jnp.float32)
+      self.text_encode[bucket] = load_executable(
+          compiled(f"text_encode_aot_{bucket}"), (self.text_encoder_params, ids, ids, rngs)
+      )
+      self.vocos_apply[bucket] = load_executable(
+          compiled(f"vocos_apply_aot_{bucket}"), (self.vocos_params, latents, rngs)
+      )
+      self.run_inference[bucket] = load_executable(
+          compiled(f"run_inference_aot_{bucket}"),
+          (self.transformer_state, latents, latents, ids, text_embed, text_embed, ts, ts, controls),
+          num_outputs=2,
+      )
+    self.fingerprint = self.model_fingerprint(self.model_path, self.quantized_params_path)
+    self.loaded = True
+    max_logging.log(f"F5 engine{self.suffix} loaded buckets {self.bucket_sizes} in {time.time() - t_start:.2f}s")
+
+  def model_fingerprint(self, pretrained_model_name_or_path, quantized_params_path):
+    """Identifies everything besides the request that shapes the audio: the weights and executables
+    (whose guidance scale is baked in), by path and `_path_signature`, and the sampling config.
+    """
+    config = self.config
+    sampling_config = load_f5_sampling_config(pretrained_model_name_or_path)
+    paths = [pretrained_model_name_or_path, quantized_params_path]
+    paths += [config.vocoder_model_path, config.vocab_name_or_path]
+    # The executables of all replicas, so that replicas share result cache entries.
+    paths += [
+        os.path.join(config.compiled_path, f"run_inference_aot_{bucket}{suffix}.pickle")
+        for suffix in executable_suffixes(config)
+        for bucket in self.bucket_sizes
+    ]
+    items = [(path, _path_signature(path)) for path in paths]
+    items += [
+        config.num_inference_steps,
+        config.flow_solver,
+        config.sway_sampling_coef,
+        config.quantization,
+        config.max_sequence_length,
+        config.use_block_cache,
+        config.block_cache_max_reuse,
+        config.block_cache_threshold,
+        sampling_config.get("guidance_distilled", False),
+        sampling_config.get("num_inference_steps"),
+    ]
+    return hashlib.sha256(json.dumps(items, default=str).encode("utf-8")).hexdigest()[:16]
+
+  def chunk_cache_key(self, voice, text, request):
+    """Content key of the audio of a text chunk, `voice` hashes the reference audio and text."""
+    text = " ".join(unicodedata.normalize("NFKC", text).split())
+    items = [
+        self.fingerprint,
+        voice,
+        text,
+        request.speed,
+        request.sway_sampling,
+        request.cfg_t_min,
+        request.cfg_t_max,
+        request.null_pred_every,
+        request.seed,
+    ]
+    return hashlib.sha256(json.dumps(items).encode("utf-8")).hexdigest()
+
+  def load_weights(self, pretrained_model_name_or_path, quantized_params_path=None):
+    """Loads a checkpoint into new device buffers next to the served ones, for `canary` and `swap_weights`.
+
+    Does not touch the served weights, it can run on any thread while batches run. With quantization
+    the int8 weights of the checkpoint come from `quantized_params_path`, which is then required.
+    """
+    if self.config.quantization and not quantized_params_path:
+      raise ValueError(f"quantized_params_path is required to load {pretrained_model_name_or_path} with quantization.")
+    sampling_config = load_f5_sampling_config(pretrained_model_name_or_path)
+    if sampling_config.get("guidance_distilled", False) != self.guidance_distilled:
+      raise ValueError(
+          f"{pretrained_model_name_or_path} has guidance_distilled={not self.guidance_distilled} unlike the served "
+          "checkpoint, it needs a recompile."
+      )
+    check_f5_sampling_config(sampling_config, self.config.num_inference_steps, self.config.sway_sampling_coef)
+    t_start = time.time()
+    transformer_state, text_encoder_params = self.load_transformer_state(pretrained_model_name_or_path, quantized_params_path)
+    weights = (transformer_state, self._replicate(text_encoder_params))
+    if _weights_signature(weights) != _weights_signature((self.transformer_state, self.text_encoder_params)):
+      self.discard_weights(weights)
+      raise ValueError(f"{pretrained_model_name_or_path} does not match the compiled shapes, it needs a recompile.")
+    max_logging.log(f"F5 engine{self.suffix} loaded {pretrained_model_name_or_path} in {time.time() - t_start:.2f}s")
+    return weights
+
+  def canary(self, weights):
+    """Synthesizes the warmup batch with `weights`, raises ValueError when the audio is not finite."""
+    # Kept out of the batch time estimates: the canary does not queue behind served batches.
+    audio, _ = self.run_batch([self._dummy_chunk()], weights=weights, record_stats=False)
+    if not all(np.isfinite(chunk_audio).all() for chunk_audio in audio):
+      raise ValueError("Canary synthesis produced non finite audio.")
+
+  def swap_weights(self, weights, pretrained_model_name_or_path, quantized_params_path=None):
+    """Serves `weights` of `load_weights` from the next batch on and frees the previous ones.
+
+    Runs on the device thread with no batch in flight, see ChunkBatcher.exclusive, no batch holds
+    the previous weights any more.
+    """
+    previous = (self.transformer_state, self.text_encoder_params)
+    self.transformer_state, self.text_encoder_params = weights
+    self.model_path = pretrained_model_name_or_path
+    self.quantized_params_path = quantized_params_path
+    self.fingerprint = self.model_fingerprint(self.model_path, self.quantized_params_path)
+    self.discard_weights(previous)
+    max_logging.log(f"F5 engine{self.suffix} now serves {self.model_path}, fingerprint {self.fingerprint}")
+
+  def discard_weights(self, weights):
+    """Frees the device buffers of `weights` right away, instead of whenever the last reference goes."""
+    for leaf in jax.tree_util.tree_leaves(weights):
+      if isinstance(leaf, jax.Array):
+        leaf.delete()
+
+  def bucket_for(self, num_chunks):
+    return next(bucket for bucket in self.bucket_sizes if num_chunks <= bucket)
+
+  def guidance_cost(self, sway_sampling=False, cfg_t_min=0.0, cfg_t_max=1.0, null_pred_every=1):
+    """Relative model cost of a batch key's guidance controls, see flow_match_guidance.guidance_cost."""
+    config = self.config
+    timesteps = sample_timesteps(config.num_inference_steps, config.sway_sampling_coef if sway_sampling else None)
+    return guidance_cost(timesteps[:-1], cfg_t_min, cfg_t_max, null_pred_every)
+
+  def batch_secs(self, num_chunks, *key):
+    """Estimated `run_batch` seconds of `num_chunks` chunks of batch key `key`, from the measured
+    batches of their bucket. None before any batch of the bucket ran, e.g. before `warmup`.
+    """
+    secs = self.bucket_secs.get(self.bucket_for(min(num_chunks, self.max_chunks)))
+    return None if secs is None else secs * self.guidance_cost(*key)
+
+  def prepare(self, request, result_cache=None):
+    """Host side preprocessing, returns the request's chunks in order.
+
+    Chunks found in `result_cache` come back with their audio, the others with their model inputs.
+    """
+    seq_len = self.max_sequence_length
+    if not request.gen_text:
+      raise SynthesisError("Generation text cannot be empty.")
+    if not request.ref_text:
+      raise SynthesisError("Reference text cannot be empty.")
+    if request.speed <= 0:
+      raise SynthesisError("Speed must be positive.")
+    ref_audio = np.asarray(request.ref_audio, dtype=np.float32)
+    ref_text = request.ref_text
+    if len(ref_text[-1].encode("utf-8")) == 1:
+      ref_text = ref_text + " "
+    ref_duration_sec = len(ref_audio) / TARGET_SR
+    if ref_duration_sec < 0.1:
+      raise SynthesisError("Reference audio is too short (must be at least 0.1 seconds).")
+    max_gen_duration_sec = MAX_DURATION_SECS - ref_duration_sec
+    if max_gen_duration_sec <= 0:
+      raise SynthesisError(f"Reference audio ({ref_duration_sec:.1f}s) exceeds the {MAX_DURATION_SECS}s maximum.")
+
+    # Chunk size from the reference speech rate, with a 20% margin.
+    chars_per_sec_ref = len(ref_text.encode("utf-8")) / ref_duration_sec
+    gen_texts = chunk_text(request.gen_text, max_chars=max(10, int(chars_per_sec_ref * max_gen_duration_sec * 0.8)))
+    if not gen_texts:
+      raise SynthesisError("Text processing resulted in zero valid chunks.")
+
+    voice = hashlib.sha256(ref_audio.tobytes() + request.ref_text.encode("utf-8")).hexdigest()
+    chunks = [Chunk(key=self.chunk_cache_key(voice, gen_text, request)) for gen_text in gen_texts]
+    if result_cache is not None:
+      for chunk in chunks:
+        chunk.pcm = result_cache.get(chunk.key)
+    misses = [(chunk, gen_text) for chunk, gen_text in zip(chunks, gen_texts) if chunk.pcm is None]
+    if not misses:
+      return chunks
+
+    ref_len = ref_audio.shape[-1] // HOP_LENGTH + 1
+    max_ref_frames = int(seq_len * 0.6)
+    if ref_len > max_ref_frames:
+      # Truncate the reference, and its text proportionally.
+      ref_text = ref_text[: int(len(ref_text) * max_ref_frames / ref_len)]
+      ref_len = max_ref_frames
+      ref_audio = ref_audio[: ref_len * HOP_LENGTH]
+      if ref_text and len(ref_text[-1].encode("utf-8")) == 1:
+        ref_text += " "
+
+    ref_audio_padded = np.pad(ref_audio, (0, max(0, (seq_len + 1) * HOP_LENGTH - ref_audio.shape[0])))
+    cond = np.asarray(self.get_mel(ref_audio_padded[np.newaxis, : (seq_len + 1) * HOP_LENGTH]))[0, :seq_len]
+    cond = np.pad(cond, ((0, seq_len - cond.shape[0]), (0, 0)))
+    cond = np.where(lens_to_mask(np.asarray(ref_len), seq_len)[0, :, np.newaxis], cond, 0.0).astype(np.float32)
+
+    ref_text_bytes = len(ref_text.encode("utf-8"))
+    text_list = convert_char_to_pinyin([ref_text + gen_text for _, gen_text in misses])
+    text_ids = list_str_to_idx(text_list, self.vocab_char_map, max_length=seq_len)
+    for (chunk, gen_text), chunk_text_ids in zip(misses, text_ids):
+      gen_frames = max(0, int(ref_len / ref_text_bytes * len(gen_text.encode("utf-8")) / request.speed))
+      chunk.text_ids = chunk_text_ids
+      chunk.cond = cond
+      chunk.ref_len = ref_len
+      chunk.duration = max(ref_len + 1, min(seq_len, ref_len + gen_frames))
+      # The noise depends on the request seed only, a chunk's audio does not depend on its position.
+      chunk.seed = request.seed
+    return chunks
+
+  def run_batch(self, chunks, *key, weights=None, record_stats=True):
+    """Synthesizes up to `max_chunks` chunks, returns (audio of each chunk, batch stats)."""
+    return self.finish_batch(self.dispatch_batch(chunks, *key, weights=weights), record_stats=record_stats)
+
+  def dispatch_batch(
+      self, chunks, sway_sampling=False, cfg_t_min=0.0, cfg_t_max=1.0, null_pred_every=1, weights=None
+  ):
+    """Enqueues the synthesis of up to `max_chunks` chunks, returns a PendingBatch for `finish_batch`.
+
+    Does not wait for the devices. `weights` of `load_weights` replace the served ones for this batch.
+    """
+    config = self.config
+    transformer_state, text_encoder_params = weights or (self.transformer_state, self.text_encoder_params)
+    seq_len = self.max_sequence_length
+    t_start = time.time()
+    bucket = self.bucket_for(len(chunks))
+    # Padding rows repeat the first reference with an empty text, as in the Gradio apps.
+    first = chunks[0]
+    pad = Chunk(
+        key="",
+        text_ids=np.zeros_like(first.text_ids),
+        cond=first.cond,
+        ref_len=first.ref_len,
+        duration=first.ref_len + 1,
+    )
+    rows = chunks + [pad] * (bucket - len(chunks))
+
+    text_ids = np.stack([row.text_ids for row in rows])
+    cond = np.stack([row.cond for row in rows])
+    ref_lens = np.array([row.ref_len for row in rows], dtype=np.int32)
+    durations = np.maximum(np.minimum([row.duration for row in rows], seq_len), ref_lens + 1)
+    text_lens = np.minimum((text_ids != 0).sum(axis=-1), seq_len)
+    durations = np.minimum(np.maximum(np.maximum(text_lens, ref_lens) + 1, durations), seq_len)
+    latents = np.stack(
+        [np.random.default_rng(row.seed).standard_normal((seq_len, config.n_mels), dtype=np.float32) for row in rows]
+    )
+    timesteps = sample_timesteps(config.num_inference_steps, config.sway_sampling_coef if sway_sampling else None)
+
+    put = functools.partial(jax.device_put, device=self.data_sharding)
+    text_segment_ids = put((text_ids != 0).astype(np.int32))
+    text_ids, null_text_ids, cond = put(text_ids), put(np.zeros_like(text_ids)), put(cond)
+    decoder_segment_ids = put(lens_to_mask(durations, seq_len).astype(np.int32))
+    cond_mask = put(lens_to_mask(ref_lens, seq_len))
+
+    rngs = self._rngs(config.seed + 1)
+    text_embed_cond = self.text_encode[bucket](text_encoder_params, text_ids, text_segment_ids, rngs)
+    text_embed_uncond = self.text_encode[bucket](text_encoder_params, null_text_ids, text_segment_ids, rngs)
+    latents, hit_rate = self.run_inference[bucket](
+        transformer_state,
+        put(latents),
+        cond,
+        decoder_segment_ids,
+        text_embed_cond,
+        text_embed_uncond,
+        timesteps[:-1],
+        timesteps[1:],
+        init_guidance_controls(cfg_t_min, cfg_t_max, null_pred_every),
+    )
+    out_latents = jnp.where(cond_mask[..., jnp.newaxis], cond, latents)
+    audio = self.vocos_apply[bucket](self.vocos_params, out_latents, self._rngs(config.seed + 3))
+    audio = audio[: len(chunks)]
+    # The transfer starts when the audio is ready, not when `finish_batch` asks for it.
+    audio.copy_to_host_async()
+    return PendingBatch(
+        chunks=chunks,
+        bucket=bucket,
+        durations=durations,
+        audio=audio,
+        hit_rate=hit_rate,
+        guidance_cost=self.guidance_cost(sway_sampling, cfg_t_min, cfg_t_max, null_pred_every),
+        dispatched_at=t_start,
+    )
+
+  def finish_batch(self, pending, record_stats=True):
+    """Waits for a PendingBatch, returns (audio of each chunk, batch stats).
+
+    Batches must finish in the order they were dispatched. Without `record_stats` the batch does
+    not update `bucket_secs`, which the admission estimates of served batches are based on.
+    """
+    audio = np.asarray(pending.audio)
+    t_done = time.time()
+    # A batch dispatched before the previous one finished queued behind it on the devices.
+    device_secs = t_done - max(pending.dispatched_at, self.last_finished)
+    # Each row's generated part, between its reference and its duration.
+    chunk_audio = [
+        row_audio[row.ref_len * HOP_LENGTH : duration * HOP_LENGTH]
+        for row_audio, row, duration in zip(audio, pending.chunks, pending.durations)
+    ]
+
+    if record_stats:
+      self.last_finished = t_done
+      # Normalized to full guidance, the guidance controls of the next batch may differ.
+      secs = device_secs / pending.guidance_cost
+      previous = self.bucket_secs.get(pending.bucket)
+      self.bucket_secs[pending.bucket] = secs if previous is None else 0.8 * previous + 0.2 * secs
+    stats = {
+        "bucket": pending.bucket,
+        "rows": len(pending.chunks),
+        "device_secs": device_secs,
+        "block_cache_hit_rate": float(pending.hit_rate),
+    }
+    return chunk_audio, stats
+
+  def _dummy_chunk(self):
+    seq_len = self.max_sequence_length
+    return Chunk(
+        key="",
+        text_ids=np.ones((seq_len,), np.int32),
+        cond=np.zeros((seq_len, self.config.n_mels), np.float32),
+        ref_len=1,
+        duration=2,
+        seed=0,
+    )
+
+  def warmup(self):
+    """Runs every bucket once, the first requests then do not pay for the executables' first run."""
+    dummy = self._dummy_chunk()
+    for bucket in self.bucket_sizes:
+      t_start = time.time()
+      self.run_batch([dummy] * bucket)
+      self.warm_buckets.add(bucket)
+      max_logging.log(f"Warmed up bucket {bucket} in {time.time() - t_start:.2f}s")
@@ -15,9 +15,6 @@ from chex import Array
 from einops import rearrange
 from flax.linen import partitioning as nn_partitioning
 import flax
-import re
-from pypinyin import lazy_pinyin, Style
-import jieba
 from maxdiffusion import pyconfig, max_logging
 from maxdiffusion.models.f5.transformers.transformer_f5_flax import F5TextEmbedding, F5Transformer2DModel
 from maxdiffusion.max_utils import (
@@ -29,9 +26,13 @@ from maxdiffusion.max_utils import (
     setup_initial_state,
 )
 import time
-from maxdiffusion.models.modeling_flax_pytorch_utils import convert_f5_state_dict_to_flax
-import os
-from importlib.resources import files
+from maxdiffusion.checkpointing.checkpointing_utils import check_f5_sampling_config, load_f5_params, load_f5_sampling_config
+from maxdiffusion.models.block_cache import block_cache_bytes, block_cache_from_config, block_cache_hit_rate
+from maxdiffusion.schedulers.flow_match_guidance import guidance_controls_from_config, init_guidance_controls, guided_velocity, init_guidance_cache
+from maxdiffusion.schedulers.flow_match_solvers import FLOW_SOLVERS, init_solver_state, solver_step
+from maxdiffusion.models import quantizations
+from maxdiffusion.quantize_f5 import load_quantized_transformer_state
+from maxdiffusion.f5_text_utils import chunk_text, convert_char_to_pinyin, get_tokenizer, lens_to_mask, list_str_to_idx
 import librosa
 import audax.core.functional
 import jax.experimental.compilation_cache
@@ -69,6 +70,7 @@ global_vocab_size = None
 global_p_run_inference = None
 global_data_sharding = None
 global_max_sequence_length = None # Will be set during setup
+global_sampling_config = None # f5_sampling item of the checkpoint, see load_f5_sampling_config
 #global_batch_size = None # Will be set during setup
 
 # --- Utility Functions (Mostly unchanged, slight modifications) ---
@@ -100,174 +102,6 @@ def get_mel(y, n_mels=100, n_fft=1024, win_size=1024, hop_length=256, fmin=0, fm
 # JIT get_mel for performance
 #jitted_get_mel = jax.jit(get_mel, static_argnums=(1, 2, 3, 4, 5, 6, 8))
 
-def convert_char_to_pinyin(text_list, polyphone=True):
-    if jieba.dt.initialized is False:
-        jieba.default_logger.setLevel(50)  # CRITICAL
-        jieba.initialize()
-
-    final_text_list = []
-    custom_trans = str.maketrans(
-        {";": ",", "“": '"', "”": '"', "‘": "'", "’": "'"}
-    )  # add custom trans here, to address oov
-
-    def is_chinese(c):
-        return (
-            "\u3100" <= c <= "\u9fff"  # common chinese characters
-        )
-
-    for text in text_list:
-        char_list = []
-        text = text.translate(custom_trans)
-        for seg in jieba.cut(text):
-            seg_byte_len = len(bytes(seg, "UTF-8"))
-            if seg_byte_len == len(seg):  # if pure alphabets and symbols
-                if char_list and seg_byte_len > 1 and char_list[-1] not in " :'\"":
-                    char_list.append(" ")
-                char_list.extend(seg)
-            elif polyphone and seg_byte_len == 3 * len(seg):  # if pure east asian characters
-                seg_ = lazy_pinyin(seg, style=Style.TONE3, tone_sandhi=True)
-                for i, c in enumerate(seg):
-                    if is_chinese(c):
-                        char_list.append(" ")
-                    char_list.append(seg_[i])
-            else:  # if mixed characters, alphabets and symbols
-                for c in seg:
-                    if ord(c) < 256:
-                        char_list.extend(c)
-                    elif is_chinese(c):
-                        char_list.append(" ")
-                        char_list.extend(lazy_pinyin(c, style=Style.TONE3, tone_sandhi=True))
-                    else:
-                        char_list.append(c)
-        final_text_list.append(char_list)
-
-    return final_text_list
-
-
-def get_tokenizer(dataset_name, tokenizer: str = "custom"):
-    """
-    tokenizer   - "pinyin" do g2p for only chinese characters, need .txt vocab_file
-                - "char" for char-wise tokenizer, need .txt vocab_file
-                - "byte" for utf-8 tokenizer
-                - "custom" if you're directly passing in a path to the vocab.txt you want to use
-    vocab_size  - if use "pinyin", all available pinyin types, common alphabets (also those with accent) and symbols
-                - if use "char", derived from unfiltered character & symbol counts of custom dataset
-                - if use "byte", set to 256 (unicode byte range)
-    """
-    if tokenizer in ["pinyin", "char"]:
-        tokenizer_path = os.path.join(files("f5_tts").joinpath("../../data"), f"{dataset_name}_{tokenizer}/vocab.txt")
-        with open(tokenizer_path, "r", encoding="utf-8") as f:
-            vocab_char_map = {}
-            for i, char in enumerate(f):
-                vocab_char_map[char[:-1]] = i
-        vocab_size = len(vocab_char_map)
-        assert vocab_char_map[" "] == 0, "make sure space is of idx 0 in vocab.txt, cuz 0 is used for unknown char"
-
-    elif tokenizer == "byte":
-        vocab_char_map = None
-        vocab_size = 256
-
-    elif tokenizer == "custom":
-        with open(dataset_name, "r", encoding="utf-8") as f:
-            vocab_char_map = {}
-            for i, char in enumerate(f):
-                vocab_char_map[char[:-1]] = i
-        vocab_size = len(vocab_char_map)
-
-    return vocab_char_map, vocab_size
-
-def list_str_to_idx(
-    text: list[list[str]], # Expects list of lists of chars/pinyin
-    vocab_char_map: dict[str, int],
-    max_length: int,
-    padding_value=0, # Use 0 for padding index (which maps to space or unknown)
-):
-    outs = []
-    #unk_idx = vocab_char_map.get('<unk>', vocab_char_map.get(' ', 0)) # Use space if <unk> not present
-
-    for t in text:
-        # Map characters/pinyin, using unk_idx for unknown ones
-        list_idx_tensors = [vocab_char_map.get(c, 0) for c in t]
-        text_ids = np.asarray(list_idx_tensors, dtype=np.int32)
-
-        # Add 1 to all indices (making padding 1, original indices shifted)
-        text_ids = text_ids + 1 # Let's reconsider this, maybe padding with 0 is better if space is 0
-
-        # Pad sequence
-        pad_len = max_length - text_ids.shape[-1]
-        if pad_len < 0:
-            print(f"Warning: Truncating text sequence from {text_ids.shape[-1]} to {max_length}")
-            text_ids = text_ids[:max_length]
-            pad_len = 0
-
-        # Pad with the designated padding_value (e.g., 0)
-        text_ids = np.pad(text_ids, ((0, pad_len)), constant_values=padding_value)
-        outs.append(text_ids)
-
-    if not outs:
-      return np.array([], dtype=np.int32).reshape(0, max_length)
-
-    stacked_text_ids = np.stack(outs)
-    return stacked_text_ids
-
-
-def chunk_text(text, max_chars=135):
-    """
-    Splits the input text into chunks based on estimated character count,
-    respecting sentence boundaries where possible.
-    Max_chars is an estimate, actual byte length might vary.
-    """
-    chunks = []
-    current_chunk = ""
-    # More robust sentence splitting for English and Chinese
-    sentences = re.split(r'(?<=[.?!;；。？！])\s*', text)
-    # Filter out empty strings that can result from splitting
-    sentences = [s for s in sentences if s]
-
-    if not sentences:
-        if text: # Handle case where text has no sentence-ending punctuation
-            sentences = [text]
-        else:
-            return [] # No text, no chunks
-
-    for sentence in sentences:
-        sentence = sentence.strip()
-        if not sentence:
-            continue
-
-        # Estimate length (simple char count, pinyin will expand this later)
-        if len(current_chunk) + len(sentence) < max_chars:
-            current_chunk += sentence + " " # Add space between sentences
-        else:
-            # If adding the sentence exceeds max_chars
-            if current_chunk: # Add the previous chunk if it exists
-                chunks.append(current_chunk.strip())
-                current_chunk = sentence + " " # Start new chunk with current sentence
-            else: # Sentence itself is longer than max_chars
-                # Simple split for very long sentences (could be improved)
-                parts = [sentence[i:i+max_chars] for i in range(0, len(sentence), max_chars)]
-                chunks.extend(p.strip() + (" " if i < len(parts)-1 else "") for i, p in enumerate(parts))
-                current_chunk = "" # Reset current chunk
-
-    if current_chunk: # Add the last chunk
-        chunks.append(current_chunk.strip())
-
-    # Filter out any potential empty chunks again
-    chunks = [c for c in chunks if c]
-    return chunks
-
-
-def lens_to_mask(t: np.ndarray, length: int) -> np.ndarray:
-    # t: array of lengths, shape (b,)
-    # length: maximum sequence length
-    # returns: mask of shape (b, length)
-    if t.ndim == 0: # Handle single length input
-        t = t.reshape(1)
-    seq = np.arange(length)
-    mask = seq < t[:, None]  # Shape: (b, length)
-    return mask
-
-
 # --- Core Diffusion Loop Logic (Unchanged) ---
 
 def loop_body(
@@ -278,49 +112,89 @@ def loop_body(
     decoder_segment_ids,
     text_embed_cond,
     text_embed_uncond,
+    rotary_cos_sin,
+    guidance_controls,
+    solver,
+    guidance_distilled,
 ):
-    latents, state, c_ts, p_ts = args
-    latents_dtype = latents.dtype
-    t_curr = c_ts[step]
-    t_prev = p_ts[step]
-    t_vec = jnp.full((latents.shape[0],), t_curr, dtype=latents.dtype)
+    latents, state, c_ts, p_ts, solver_state, guidance_cache, block_caches = args
+    variables = {"params": state.params} if state.aqt is None else {"params": state.params, "aqt": state.aqt}
+
+    def apply(x, t, cond, text_embed, block_cache, guidance=None):
+        """Returns (prediction, block cache), the cache is None without use_block_cache."""
+        kwargs = {} if block_cache is None else {"block_cache": block_cache}
+        out = transformer.apply(
+            variables,
+            x=x,
+            cond=cond,
+            decoder_segment_ids=decoder_segment_ids,
+            text_embed=text_embed,
+            timestep=jnp.full((x.shape[0],), t, dtype=x.dtype),
+            rotary_cos_sin=rotary_cos_sin,
+            guidance=guidance,
+            **kwargs,
+        )
+        return out if block_cache is not None else (out, None)
 
     # Conditional prediction
-    pred = transformer.apply(
-        {"params": state.params},
-        x=latents,
-        cond=cond,
-        decoder_segment_ids=decoder_segment_ids,
-        text_embed=text_embed_cond,
-        timestep=t_vec,
-    )
+    def pred_fn(x, t):
+        nonlocal block_caches
+        # Guidance embeddings take generate_f5's scale, pred + (pred - null_pred) * scale.
+        guidance = jnp.full((x.shape[0],), cfg_strength - 1, dtype=x.dtype) if transformer.guidance_embeds else None
+        pred, cond_cache = apply(x, t, cond, text_embed_cond, None if block_caches is None else block_caches["cond"], guidance)
+        if block_caches is not None:
+            block_caches = {**block_caches, "cond": cond_cache}
+        return pred
 
     # Unconditional prediction
-    null_pred = transformer.apply(
-        {"params": state.params},
-        x=latents,
-        cond=jnp.zeros_like(cond),
-        decoder_segment_ids=decoder_segment_ids,
-        text_embed=text_embed_uncond,
-        timestep=t_vec,
-        #drop_audio_cond=True,
-    )
-
-    # Classifier-Free Guidance
-    guidance_scale = cfg_strength # Use global or Gradio input
-    pred = null_pred + guidance_scale * (pred - null_pred)
+    def null_pred_fn(x, t, block_cache):
+        #drop_audio_cond=True
+        return apply(x, t, jnp.zeros_like(cond), text_embed_uncond, block_cache)
+
+    def velocity(x, t):
+        nonlocal guidance_cache, block_caches
+        if guidance_distilled:
+            return pred_fn(x, t)
+        # Classifier-Free Guidance inside the guidance interval, the unconditional prediction
+        # is reused between recomputes. The solver's evaluations are traced in order, the
+        # caches thread through them.
+        guidance_scale = cfg_strength # Use global or Gradio input
+        pred, guidance_cache, null_cache = guided_velocity(
+            pred_fn,
+            null_pred_fn,
+            lambda pred, null_pred: null_pred + guidance_scale * (pred - null_pred),
+            x,
+            t,
+            guidance_controls,
+            guidance_cache,
+            None if block_caches is None else block_caches["null"],
+        )
+        if block_caches is not None:
+            block_caches = {**block_caches, "null": null_cache}
+        return pred
 
-    # DDIM-like step (simplified Euler)
-    latents = latents + (t_prev - t_curr) * pred # This matches the original Euler step
-    latents = jnp.array(latents, dtype=latents_dtype) # Recast JAX tracer
+    # Flow matching ODE step from t_curr to t_prev (Euler by default, see flow_match_solvers)
+    latents, solver_state = solver_step(solver, velocity, latents, c_ts[step], p_ts[step], solver_state)
 
-    return latents, state, c_ts, p_ts
+    return latents, state, c_ts, p_ts, solver_state, guidance_cache, block_caches
 
 
 def run_inference(
-    states, latents, cond, decoder_segment_ids, text_embed_cond, text_embed_uncond, c_ts, p_ts, transformer, config, mesh
+    states, latents, cond, decoder_segment_ids, text_embed_cond, text_embed_uncond, c_ts, p_ts, guidance_controls, transformer, config, mesh, solver=None, guidance_distilled=False
 ):
     transformer_state = states # Assuming states only contain transformer state now
+    solver = solver or config.flow_solver # static, one compiled loop per solver
+    if config.use_block_cache:
+        transformer = transformer.clone(block_cache_start=config.block_cache_start)
+
+    # Rotary tables depend only on the sequence length and mask, so build them once
+    # here instead of in every block of every diffusion step.
+    rotary_cos_sin = transformer.apply(
+        {"params": transformer_state.params},
+        latents.shape[1],
+        decoder_segment_ids,
+        method=F5Transformer2DModel.rotary_cos_sin,
+    )
 
     loop_body_p = functools.partial(
         loop_body,
@@ -329,14 +203,37 @@ def run_inference(
         decoder_segment_ids=decoder_segment_ids,
         text_embed_cond=text_embed_cond,
         text_embed_uncond=text_embed_uncond,
+        rotary_cos_sin=rotary_cos_sin,
+        guidance_controls=guidance_controls,
+        solver=solver,
+        guidance_distilled=guidance_distilled,
     )
 
-    # Removed partitioning axis rules context, assume handled by sharding annotations or global context
-    # with mesh, nn_partitioning.axis_rules(config.logical_axis_rules):
-    # We need the state back if it were being updated (e.g., BatchNorm), but it's not here.
-    latents_final, _, _, _ = jax.lax.fori_loop(0, len(c_ts), loop_body_p, (latents, transformer_state, c_ts, p_ts))
+    # Axis rules are opt-in: with them the flash shard_map shards the batch over data/fsdp,
+    # which the default (batch replicated) buckets are not sized for.
+    with ExitStack() as stack:
+        if config.shard_f5_activations:
+            stack.enter_context(mesh)
+            stack.enter_context(nn_partitioning.axis_rules(config.logical_axis_rules))
+        # We need the state back if it were being updated (e.g., BatchNorm), but it's not here.
+        solver_state = init_solver_state(solver, latents)
+        guidance_cache = init_guidance_cache(latents)
+        # Block caches of the conditional and unconditional passes, see models/block_cache.py.
+        block_caches = None
+        if config.use_block_cache:
+            block_cache_shape = (latents.shape[0], latents.shape[1], transformer.dim)
+            block_caches = {
+                "cond": block_cache_from_config(config, block_cache_shape),
+                "null": block_cache_from_config(config, block_cache_shape),
+            }
+            max_logging.log(f"Block cache: {block_cache_bytes(block_caches) / 2**20:.1f} MiB")
+        latents_final, _, _, _, _, _, block_caches = jax.lax.fori_loop(
+            0, len(c_ts), loop_body_p, (latents, transformer_state, c_ts, p_ts, solver_state, guidance_cache, block_caches)
+        )
 
-    return latents_final
+    # Fraction of model calls that reused the cached block residual, reported per request.
+    hit_rate = block_cache_hit_rate(*block_caches.values()) if block_caches is not None else jnp.zeros(())
+    return latents_final, hit_rate
 
 # --- Gradio Inference Function ---
 
@@ -348,6 +245,10 @@ def generate_audio(
     guidance_scale: float = 2.0,
     speed_factor: float = 1.0, # <-- Add speed factor parameter
     use_sway_sampling: bool = False, # <-- Add sway sampling parameter
+    solver: str = "euler", # flow matching ODE solver, see flow_match_solvers
+    cfg_t_min: float = 0.0, # guidance interval, see flow_match_guidance
+    cfg_t_max: float = 1.0,
+    null_pred_every: int = 1, # unconditional pass every k model evaluations, reused in between
     progress=gr.Progress(track_tqdm=True)
 ) -> Tuple[int, np.ndarray]:
     """
@@ -357,9 +258,14 @@ def generate_audio(
     cfg_strength = guidance_scale # Update global cfg strength from Gradio input
 
     t_start_total = time.time()
-    max_logging.log(f"Starting audio generation... Steps: {num_inference_steps}, CFG: {guidance_scale}, Speed: {speed_factor}, Sway: {use_sway_sampling}")
+    max_logging.log(f"Starting audio generation... Steps: {num_inference_steps}, CFG: {guidance_scale}, Speed: {speed_factor}, Sway: {use_sway_sampling}, Solver: {solver}")
+    max_logging.log(f"Guidance interval: [{cfg_t_min}, {cfg_t_max}], unconditional pass every {null_pred_every} evaluations")
 
     # --- Input Validation and Loading ---
+    try:
+        check_f5_sampling_config(global_sampling_config, num_inference_steps, global_config.sway_sampling_coef if use_sway_sampling else None)
+    except ValueError as e:
+        raise gr.Error(str(e))
     if not ref_text:
         ref_text = DEFAULT_REF_TEXT
         max_logging.log(f"Using default reference text: '{ref_text}'")
@@ -629,7 +535,7 @@ def generate_audio(
     # === End of Modified Timestep Calculation ===
 
     # Run inference loop (using pre-compiled partial function)
-    y_final_latents = global_p_run_inference_funcs[target_batch_size](
+    y_final_latents, hit_rate = global_p_run_inference_funcs[target_batch_size](
         global_transformer_state, # Pass state
         latents,
         step_cond,
@@ -637,11 +543,15 @@ def generate_audio(
         text_embed_cond,
         text_embed_uncond,
         c_ts,
-        p_ts
+        p_ts,
+        init_guidance_controls(cfg_t_min, cfg_t_max, null_pred_every),
+        solver=solver,
     )
 
     # Ensure computation happens
     y_final_latents.block_until_ready()
+    if global_config.use_block_cache:
+        max_logging.log(f"Block cache hit rate: {float(hit_rate):.2f}")
     t_end_diffusion = time.time()
     max_logging.log(f"Diffusion sampling finished in {t_end_diffusion - t_start_diffusion:.2f}s.")
     #get_memory_allocations()
@@ -729,6 +639,8 @@ def setup_models_and_state(config):
     global global_jitted_vocos_apply_funcs, global_vocab_char_map, global_vocab_size
     global global_p_run_inference_funcs, global_data_sharding, global_max_sequence_length
     global jitted_get_mel
+    global BUCKET_SIZES, MAX_CHUNKS
+    global global_sampling_config
 
 
 
@@ -736,6 +648,10 @@ def setup_models_and_state(config):
     t_start_setup = time.time()
     max_logging.log("Starting one-time setup...")
     global_config = config # Store config globally
+    if config.aot_bucket_sizes:
+        BUCKET_SIZES = sorted(config.aot_bucket_sizes)
+        MAX_CHUNKS = BUCKET_SIZES[-1]
+        max_logging.log(f"Using batch buckets {BUCKET_SIZES} from config.")
 
     flash_block_sizes = get_flash_block_sizes(config)
     # Store max sequence length from config
@@ -828,14 +744,25 @@ def setup_models_and_state(config):
         dtype=config.activations_dtype,
         weights_dtype=config.weights_dtype,
         precision=get_precision(config),
+        scan_layers=config.scan_layers,
+        remat_policy=config.remat_policy,
+        quant=quantizations.configure_quantization(config, "serve"),
         #max_seq_len=global_max_sequence_length # Pass max length here
     )
     transformer = global_transformer # Local var
 
     # Load weights
-    transformer_params, text_encoder_params_loaded = convert_f5_state_dict_to_flax(
-        config.pretrained_model_name_or_path, use_ema=config.use_ema
+    transformer_params, text_encoder_params_loaded = load_f5_params(
+        config.pretrained_model_name_or_path, use_ema=config.use_ema, scan_layers=config.scan_layers
     )
+    sampling_config = load_f5_sampling_config(config.pretrained_model_name_or_path)
+    global_sampling_config = sampling_config
+    guidance_distilled = sampling_config.get("guidance_distilled", False)
+    if guidance_distilled:
+        max_logging.log(f"Guidance distilled checkpoint (num_inference_steps: {sampling_config['num_inference_steps']}), skipping the unconditional pass")
+    if "guidance_embed" in transformer_params:
+        global_transformer = global_transformer.clone(guidance_embeds=True)
+        transformer = global_transformer
     global_text_encoder_params = flax.core.frozen_dict.FrozenDict(text_encoder_params_loaded) # Store globally
 
     weights_init_fn = functools.partial(transformer.init_weights, rngs=rng, max_sequence_length=config.max_sequence_length, eval_only=False)
@@ -849,6 +776,10 @@ def setup_models_and_state(config):
         training=False,
     )
     global_transformer_state = global_transformer_state.replace(params=transformer_params)
+    if config.quantization:
+        global_transformer_state, global_transformer_state_shardings = load_quantized_transformer_state(
+            transformer, config, mesh, global_transformer_state, global_transformer_state_shardings
+        )
     global_transformer_state = jax.device_put(global_transformer_state, global_transformer_state_shardings)
     # --- Load Text Encoder ---
     max_logging.log("Loading Text Encoder model...")
@@ -984,6 +915,7 @@ def setup_models_and_state(config):
         transformer=transformer, # Pass model def
         config=config,
         mesh=mesh,
+        guidance_distilled=guidance_distilled,
         # Other args (latents, cond, etc.) will be provided at call time
     )
 
@@ -996,10 +928,11 @@ def setup_models_and_state(config):
         text_embed_sharding,             # text_embed_cond
         text_embed_sharding,             # text_embed_uncond
         ts_sharding,                     # c_ts
-        ts_sharding                      # p_ts
+        ts_sharding,                     # p_ts
+        None,                            # guidance_controls, replicated
     )
     # Output sharding (final latents) - should match data sharding probably
-    out_shardings_inf = latents_sharding
+    out_shardings_inf = (latents_sharding, None) # final latents, block cache hit rate
 
 
 
@@ -1010,6 +943,7 @@ def setup_models_and_state(config):
             global_p_run_inference_funcs[bucket] = jax.jit(
                 partial_run_inference,
                 static_argnums=(), # No static args in the partial itself anymore
+                static_argnames=("solver",), # one compiled loop per ODE solver
                 in_shardings=in_shardings_inf,
                 out_shardings=out_shardings_inf,
             )
@@ -1030,7 +964,9 @@ def setup_models_and_state(config):
                 dummy_text_embed,
                 dummy_text_embed,
                 dummy_c_ts,
-                dummy_p_ts
+                dummy_p_ts,
+                guidance_controls_from_config(config),
+                solver=config.flow_solver,
             )
 
         max_logging.log("Inference loop JIT compiled.")
@@ -1077,6 +1013,10 @@ def main(argv: Sequence[str]) -> None:
                     speed_slider = gr.Slider(minimum=0.5, maximum=2.0, value=1.0, step=0.1, label="Speed Factor", info="Adjust speech rate (1.0 = reference speed).")
                     # === Add Sway Sampling Switch ===
                     sway_sampling_switch = gr.Checkbox(label="Enable Sway Sampling", value=False, info="Modifies timestep schedule (requires sway_sampling_coef > 0 in config).")
+                    cfg_t_min_slider = gr.Slider(minimum=0.0, maximum=1.0, value=global_config.cfg_interval_min, step=0.05, label="Guidance From t", info="Classifier-free guidance only between these times, 0 is noise and 1 is data.")
+                    cfg_t_max_slider = gr.Slider(minimum=0.0, maximum=1.0, value=global_config.cfg_interval_max, step=0.05, label="Guidance Until t")
+                    null_pred_every_slider = gr.Slider(minimum=1, maximum=8, value=global_config.cfg_null_pred_every, step=1, label="Unconditional Pass Every", info="Reuses the unconditional prediction in between, each skipped pass saves a full forward.")
+                    solver_dropdown = gr.Dropdown(choices=list(FLOW_SOLVERS), value=global_config.flow_solver, label="ODE Solver", info="midpoint and heun run the model twice per step, adams2 once.")
                     # ==============================
                 submit_btn = gr.Button("Generate Audio", variant="primary")
 
@@ -1122,7 +1062,7 @@ def main(argv: Sequence[str]) -> None:
         # Update button click inputs list order
         submit_btn.click(
             fn=generate_audio,
-            inputs=[ref_text_input, gen_text_input, ref_audio_input, steps_slider, cfg_slider, speed_slider, sway_sampling_switch],
+            inputs=[ref_text_input, gen_text_input, ref_audio_input, steps_slider, cfg_slider, speed_slider, sway_sampling_switch, solver_dropdown, cfg_t_min_slider, cfg_t_max_slider, null_pred_every_slider],
             outputs=[audio_output],
         )
 
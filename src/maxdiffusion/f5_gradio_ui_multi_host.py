@@ -29,7 +29,12 @@ from maxdiffusion.max_utils import (
     setup_initial_state,
 )
 import time
-from maxdiffusion.models.modeling_flax_pytorch_utils import convert_f5_state_dict_to_flax
+from maxdiffusion.checkpointing.checkpointing_utils import check_f5_sampling_config, load_f5_params, load_f5_sampling_config
+from maxdiffusion.models.block_cache import block_cache_bytes, block_cache_from_config, block_cache_hit_rate
+from maxdiffusion.schedulers.flow_match_guidance import guidance_controls_from_config, init_guidance_controls, guided_velocity, init_guidance_cache
+from maxdiffusion.schedulers.flow_match_solvers import FLOW_SOLVERS, init_solver_state, solver_step
+from maxdiffusion.models import quantizations
+from maxdiffusion.quantize_f5 import load_quantized_transformer_state
 import os
 from importlib.resources import files
 import librosa
@@ -69,6 +74,7 @@ global_vocab_size = None
 global_p_run_inference = None
 global_data_sharding = None
 global_max_sequence_length = None # Will be set during setup
+global_sampling_config = None # f5_sampling item of the checkpoint, see load_f5_sampling_config
 #global_batch_size = None # Will be set during setup
 
 # --- Utility Functions (Mostly unchanged, slight modifications) ---
@@ -278,49 +284,89 @@ def loop_body(
     decoder_segment_ids,
     text_embed_cond,
     text_embed_uncond,
+    rotary_cos_sin,
+    guidance_controls,
+    solver,
+    guidance_distilled,
 ):
-    latents, state, c_ts, p_ts = args
-    latents_dtype = latents.dtype
-    t_curr = c_ts[step]
-    t_prev = p_ts[step]
-    t_vec = jnp.full((latents.shape[0],), t_curr, dtype=latents.dtype)
+    latents, state, c_ts, p_ts, solver_state, guidance_cache, block_caches = args
+    variables = {"params": state.params} if state.aqt is None else {"params": state.params, "aqt": state.aqt}
+
+    def apply(x, t, cond, text_embed, block_cache, guidance=None):
+        """Returns (prediction, block cache), the cache is None without use_block_cache."""
+        kwargs = {} if block_cache is None else {"block_cache": block_cache}
+        out = transformer.apply(
+            variables,
+            x=x,
+            cond=cond,
+            decoder_segment_ids=decoder_segment_ids,
+            text_embed=text_embed,
+            timestep=jnp.full((x.shape[0],), t, dtype=x.dtype),
+            rotary_cos_sin=rotary_cos_sin,
+            guidance=guidance,
+            **kwargs,
+        )
+        return out if block_cache is not None else (out, None)
 
     # Conditional prediction
-    pred = transformer.apply(
-        {"params": state.params},
-        x=latents,
-        cond=cond,
-        decoder_segment_ids=decoder_segment_ids,
-        text_embed=text_embed_cond,
-        timestep=t_vec,
-    )
+    def pred_fn(x, t):
+        nonlocal block_caches
+        # Guidance embeddings take generate_f5's scale, pred + (pred - null_pred) * scale.
+        guidance = jnp.full((x.shape[0],), cfg_strength - 1, dtype=x.dtype) if transformer.guidance_embeds else None
+        pred, cond_cache = apply(x, t, cond, text_embed_cond, None if block_caches is None else block_caches["cond"], guidance)
+        if block_caches is not None:
+            block_caches = {**block_caches, "cond": cond_cache}
+        return pred
 
     # Unconditional prediction
-    null_pred = transformer.apply(
-        {"params": state.params},
-        x=latents,
-        cond=jnp.zeros_like(cond),
-        decoder_segment_ids=decoder_segment_ids,
-        text_embed=text_embed_uncond,
-        timestep=t_vec,
-        #drop_audio_cond=True,
-    )
-
-    # Classifier-Free Guidance
-    guidance_scale = cfg_strength # Use global or Gradio input
-    pred = null_pred + guidance_scale * (pred - null_pred)
+    def null_pred_fn(x, t, block_cache):
+        #drop_audio_cond=True
+        return apply(x, t, jnp.zeros_like(cond), text_embed_uncond, block_cache)
+
+    def velocity(x, t):
+        nonlocal guidance_cache, block_caches
+        if guidance_distilled:
+            return pred_fn(x, t)
+        # Classifier-Free Guidance inside the guidance interval, the unconditional prediction
+        # is reused between recomputes. The solver's evaluations are traced in order, the
+        # caches thread through them.
+        guidance_scale = cfg_strength # Use global or Gradio input
+        pred, guidance_cache, null_cache = guided_velocity(
+            pred_fn,
+            null_pred_fn,
+            lambda pred, null_pred: null_pred + guidance_scale * (pred - null_pred),
+            x,
+            t,
+            guidance_controls,
+            guidance_cache,
+            None if block_caches is None else block_caches["null"],
+        )
+        if block_caches is not None:
+            block_caches = {**block_caches, "null": null_cache}
+        return pred
 
-    # DDIM-like step (simplified Euler)
-    latents = latents + (t_prev - t_curr) * pred # This matches the original Euler step
-    latents = jnp.array(latents, dtype=latents_dtype) # Recast JAX tracer
+    # Flow matching ODE step from t_curr to t_prev (Euler by default, see flow_match_solvers)
+    latents, solver_state = solver_step(solver, velocity, latents, c_ts[step], p_ts[step], solver_state)
 
-    return latents, state, c_ts, p_ts
+    return latents, state, c_ts, p_ts, solver_state, guidance_cache, block_caches
 
 
 def run_inference(
-    states, latents, cond, decoder_segment_ids, text_embed_cond, text_embed_uncond, c_ts, p_ts, transformer, config, mesh
+    states, latents, cond, decoder_segment_ids, text_embed_cond, text_embed_uncond, c_ts, p_ts, guidance_controls, transformer, config, mesh, solver=None, guidance_distilled=False
 ):
     transformer_state = states # Assuming states only contain transformer state now
+    solver = solver or config.flow_solver # static, one compiled loop per solver
+    if config.use_block_cache:
+        transformer = transformer.clone(block_cache_start=config.block_cache_start)
+
+    # Rotary tables depend only on the sequence length and mask, so build them once
+    # here instead of in every block of every diffusion step.
+    rotary_cos_sin = transformer.apply(
+        {"params": transformer_state.params},
+        latents.shape[1],
+        decoder_segment_ids,
+        method=F5Transformer2DModel.rotary_cos_sin,
+    )
 
     loop_body_p = functools.partial(
         loop_body,
@@ -329,14 +375,37 @@ def run_inference(
         decoder_segment_ids=decoder_segment_ids,
         text_embed_cond=text_embed_cond,
         text_embed_uncond=text_embed_uncond,
+        rotary_cos_sin=rotary_cos_sin,
+        guidance_controls=guidance_controls,
+        solver=solver,
+        guidance_distilled=guidance_distilled,
     )
 
-    # Removed partitioning axis rules context, assume handled by sharding annotations or global context
-    # with mesh, nn_partitioning.axis_rules(config.logical_axis_rules):
-    # We need the state back if it were being updated (e.g., BatchNorm), but it's not here.
-    latents_final, _, _, _ = jax.lax.fori_loop(0, len(c_ts), loop_body_p, (latents, transformer_state, c_ts, p_ts))
+    # Axis rules are opt-in: with them the flash shard_map shards the batch over data/fsdp,
+    # which the default (batch replicated) buckets are not sized for.
+    with ExitStack() as stack:
+        if config.shard_f5_activations:
+            stack.enter_context(mesh)
+            stack.enter_context(nn_partitioning.axis_rules(config.logical_axis_rules))
+        # We need the state back if it were being updated (e.g., BatchNorm), but it's not here.
+        solver_state = init_solver_state(solver, latents)
+        guidance_cache = init_guidance_cache(latents)
+        # Block caches of the conditional and unconditional passes, see models/block_cache.py.
+        block_caches = None
+        if config.use_block_cache:
+            block_cache_shape = (latents.shape[0], latents.shape[1], transformer.dim)
+            block_caches = {
+                "cond": block_cache_from_config(config, block_cache_shape),
+                "null": block_cache_from_config(config, block_cache_shape),
+            }
+            max_logging.log(f"Block cache: {block_cache_bytes(block_caches) / 2**20:.1f} MiB")
+        latents_final, _, _, _, _, _, block_caches = jax.lax.fori_loop(
+            0, len(c_ts), loop_body_p, (latents, transformer_state, c_ts, p_ts, solver_state, guidance_cache, block_caches)
+        )
 
-    return latents_final
+    # Fraction of model calls that reused the cached block residual, reported per request.
+    hit_rate = block_cache_hit_rate(*block_caches.values()) if block_caches is not None else jnp.zeros(())
+    return latents_final, hit_rate
 
 # --- Gradio Inference Function ---
 
@@ -348,6 +417,10 @@ def generate_audio(
     guidance_scale: float = 2.0,
     speed_factor: float = 1.0, # <-- Add speed factor parameter
     use_sway_sampling: bool = False, # <-- Add sway sampling parameter
+    solver: str = "euler", # flow matching ODE solver, see flow_match_solvers
+    cfg_t_min: float = 0.0, # guidance interval, see flow_match_guidance
+    cfg_t_max: float = 1.0,
+    null_pred_every: int = 1, # unconditional pass every k model evaluations, reused in between
     progress=gr.Progress(track_tqdm=True)
 ) -> Tuple[int, np.ndarray]:
     """
@@ -357,9 +430,14 @@ def generate_audio(
     cfg_strength = guidance_scale # Update global cfg strength from Gradio input
 
     t_start_total = time.time()
-    max_logging.log(f"Starting audio generation... Steps: {num_inference_steps}, CFG: {guidance_scale}, Speed: {speed_factor}, Sway: {use_sway_sampling}")
+    max_logging.log(f"Starting audio generation... Steps: {num_inference_steps}, CFG: {guidance_scale}, Speed: {speed_factor}, Sway: {use_sway_sampling}, Solver: {solver}")
+    max_logging.log(f"Guidance interval: [{cfg_t_min}, {cfg_t_max}], unconditional pass every {null_pred_every} evaluations")
 
     # --- Input Validation and Loading ---
+    try:
+        check_f5_sampling_config(global_sampling_config, num_inference_steps, global_config.sway_sampling_coef if use_sway_sampling else None)
+    except ValueError as e:
+        raise gr.Error(str(e))
     if not ref_text:
         ref_text = DEFAULT_REF_TEXT
         max_logging.log(f"Using default reference text: '{ref_text}'")
@@ -629,7 +707,7 @@ def generate_audio(
     # === End of Modified Timestep Calculation ===
 
     # Run inference loop (using pre-compiled partial function)
-    y_final_latents = global_p_run_inference_funcs[target_batch_size](
+    y_final_latents, hit_rate = global_p_run_inference_funcs[target_batch_size](
         global_transformer_state, # Pass state
         latents,
         step_cond,
@@ -637,11 +715,15 @@ def generate_audio(
         text_embed_cond,
         text_embed_uncond,
         c_ts,
-        p_ts
+        p_ts,
+        init_guidance_controls(cfg_t_min, cfg_t_max, null_pred_every),
+        solver=solver,
     )
 
     # Ensure computation happens
     y_final_latents.block_until_ready()
+    if global_config.use_block_cache:
+        max_logging.log(f"Block cache hit rate: {float(hit_rate):.2f}")
     t_end_diffusion = time.time()
     max_logging.log(f"Diffusion sampling finished in {t_end_diffusion - t_start_diffusion:.2f}s.")
     #get_memory_allocations()
@@ -729,6 +811,8 @@ def setup_models_and_state(config):
     global global_jitted_vocos_apply_funcs, global_vocab_char_map, global_vocab_size
     global global_p_run_inference_funcs, global_data_sharding, global_max_sequence_length
     global jitted_get_mel
+    global BUCKET_SIZES, MAX_CHUNKS
+    global global_sampling_config
 
 
 
@@ -736,6 +820,10 @@ def setup_models_and_state(config):
     t_start_setup = time.time()
     max_logging.log("Starting one-time setup...")
     global_config = config # Store config globally
+    if config.aot_bucket_sizes:
+        BUCKET_SIZES = sorted(config.aot_bucket_sizes)
+        MAX_CHUNKS = BUCKET_SIZES[-1]
+        max_logging.log(f"Using batch buckets {BUCKET_SIZES} from config.")
 
     flash_block_sizes = get_flash_block_sizes(config)
     # Store max sequence length from config
@@ -828,14 +916,25 @@ def setup_models_and_state(config):
         dtype=config.activations_dtype,
         weights_dtype=config.weights_dtype,
         precision=get_precision(config),
+        scan_layers=config.scan_layers,
+        remat_policy=config.remat_policy,
+        quant=quantizations.configure_quantization(config, "serve"),
         #max_seq_len=global_max_sequence_length # Pass max length here
     )
     transformer = global_transformer # Local var
 
     # Load weights
-    transformer_params, text_encoder_params_loaded = convert_f5_state_dict_to_flax(
-        config.pretrained_model_name_or_path, use_ema=config.use_ema
+    transformer_params, text_encoder_params_loaded = load_f5_params(
+        config.pretrained_model_name_or_path, use_ema=config.use_ema, scan_layers=config.scan_layers
     )
+    sampling_config = load_f5_sampling_config(config.pretrained_model_name_or_path)
+    global_sampling_config = sampling_config
+    guidance_distilled = sampling_config.get("guidance_distilled", False)
+    if guidance_distilled:
+        max_logging.log(f"Guidance distilled checkpoint (num_inference_steps: {sampling_config['num_inference_steps']}), skipping the unconditional pass")
+    if "guidance_embed" in transformer_params:
+        global_transformer = global_transformer.clone(guidance_embeds=True)
+        transformer = global_transformer
     global_text_encoder_params = flax.core.frozen_dict.FrozenDict(text_encoder_params_loaded) # Store globally
 
     weights_init_fn = functools.partial(transformer.init_weights, rngs=rng, max_sequence_length=config.max_sequence_length, eval_only=False)
@@ -849,6 +948,10 @@ def setup_models_and_state(config):
         training=False,
     )
     global_transformer_state = global_transformer_state.replace(params=transformer_params)
+    if config.quantization:
+        global_transformer_state, global_transformer_state_shardings = load_quantized_transformer_state(
+            config, mesh, global_transformer_state, global_transformer_state_shardings
+        )
     global_transformer_state = jax.device_put(global_transformer_state, global_transformer_state_shardings)
     # --- Load Text Encoder ---
     max_logging.log("Loading Text Encoder model...")
@@ -984,6 +1087,7 @@ def setup_models_and_state(config):
         transformer=transformer, # Pass model def
         config=config,
         mesh=mesh,
+        guidance_distilled=guidance_distilled,
         # Other args (latents, cond, etc.) will be provided at call time
     )
 
@@ -996,10 +1100,11 @@ def setup_models_and_state(config):
         text_embed_sharding,             # text_embed_cond
         text_embed_sharding,             # text_embed_uncond
         ts_sharding,                     # c_ts
-        ts_sharding                      # p_ts
+        ts_sharding,                     # p_ts
+        None,                            # guidance_controls, replicated
     )
     # Output sharding (final latents) - should match data sharding probably
-    out_shardings_inf = latents_sharding
+    out_shardings_inf = (latents_sharding, None) # final latents, block cache hit rate
 
 
 
@@ -1010,6 +1115,7 @@ def setup_models_and_state(config):
             global_p_run_inference_funcs[bucket] = jax.jit(
                 partial_run_inference,
                 static_argnums=(), # No static args in the partial itself anymore
+                static_argnames=("solver",), # one compiled loop per ODE solver
                 in_shardings=in_shardings_inf,
                 out_shardings=out_shardings_inf,
             )
@@ -1030,7 +1136,9 @@ def setup_models_and_state(config):
                 dummy_text_embed,
                 dummy_text_embed,
                 dummy_c_ts,
-                dummy_p_ts
+                dummy_p_ts,
+                guidance_controls_from_config(config),
+                solver=config.flow_solver,
             )
 
         max_logging.log("Inference loop JIT compiled.")
@@ -1077,6 +1185,10 @@ def main(argv: Sequence[str]) -> None:
                         speed_slider = gr.Slider(minimum=0.5, maximum=2.0, value=1.0, step=0.1, label="Speed Factor", info="Adjust speech rate (1.0 = reference speed).")
                         # === Add Sway Sampling Switch ===
                         sway_sampling_switch = gr.Checkbox(label="Enable Sway Sampling", value=False, info="Modifies timestep schedule (requires sway_sampling_coef > 0 in config).")
+                        cfg_t_min_slider = gr.Slider(minimum=0.0, maximum=1.0, value=global_config.cfg_interval_min, step=0.05, label="Guidance From t", info="Classifier-free guidance only between these times, 0 is noise and 1 is data.")
+                        cfg_t_max_slider = gr.Slider(minimum=0.0, maximum=1.0, value=global_config.cfg_interval_max, step=0.05, label="Guidance Until t")
+                        null_pred_every_slider = gr.Slider(minimum=1, maximum=8, value=global_config.cfg_null_pred_every, step=1, label="Unconditional Pass Every", info="Reuses the unconditional prediction in between, each skipped pass saves a full forward.")
+                        solver_dropdown = gr.Dropdown(choices=list(FLOW_SOLVERS), value=global_config.flow_solver, label="ODE Solver", info="midpoint and heun run the model twice per step, adams2 once.")
                         # ==============================
                     submit_btn = gr.Button("Generate Audio", variant="primary")
 
@@ -1086,7 +1198,7 @@ def main(argv: Sequence[str]) -> None:
             # Update button click inputs list order
             submit_btn.click(
                 fn=generate_audio,
-                inputs=[ref_text_input, gen_text_input, ref_audio_input, steps_slider, cfg_slider, speed_slider, sway_sampling_switch],
+                inputs=[ref_text_input, gen_text_input, ref_audio_input, steps_slider, cfg_slider, speed_slider, sway_sampling_switch, solver_dropdown, cfg_t_min_slider, cfg_t_max_slider, null_pred_every_slider],
                 outputs=[audio_output],
             )
 
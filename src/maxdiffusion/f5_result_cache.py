@@ -0,0 +1,124 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Content addressed cache of synthesized F5 text chunks.
+
+Entries are the 16 bit PCM of one text chunk, keyed by F5Engine.chunk_cache_key: the voice,
+the normalized chunk text, the sampling parameters of the request and the model fingerprint.
+A memory LRU sits in front of an optional disk LRU, both bounded in bytes. The disk level
+survives restarts, its recency is the files' modification time.
+"""
+
+import collections
+import os
+import threading
+
+
+class ResultCache:
+  """Thread safe two level LRU from hex keys to bytes."""
+
+  def __init__(self, memory_bytes, disk_dir="", disk_bytes=0):
+    self.memory_bytes = memory_bytes
+    self.disk_dir = disk_dir
+    self.disk_bytes = disk_bytes
+    self.memory = collections.OrderedDict()  # key -> data
+    self.memory_used = 0
+    self.disk = collections.OrderedDict()  # key -> size
+    self.disk_used = 0
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+    if disk_dir:
+      os.makedirs(disk_dir, exist_ok=True)
+      entries = []
+      for entry in os.scandir(disk_dir):
+        if entry.name.endswith(".pcm"):
+          stat = entry.stat()
+          entries.append((stat.st_mtime_ns, entry.name[: -len(".pcm")], stat.st_size))
+      for _, key, size in sorted(entries):
+        self.disk[key] = size
+        self.disk_used += size
+      self._evict_disk()
+
+  @classmethod
+  def from_config(cls, config):
+    """None when both levels are disabled."""
+    if config.result_cache_memory_mb <= 0 and not config.result_cache_dir:
+      return None
+    return cls(
+        memory_bytes=config.result_cache_memory_mb * 2**20,
+        disk_dir=config.result_cache_dir,
+        disk_bytes=config.result_cache_disk_mb * 2**20,
+    )
+
+  def _path(self, key):
+    return os.path.join(self.disk_dir, f"{key}.pcm")
+
+  def _put_memory(self, key, data):
+    if len(data) > self.memory_bytes:
+      return
+    if key in self.memory:
+      self.memory_used -= len(self.memory.pop(key))
+    self.memory[key] = data
+    self.memory_used += len(data)
+    while self.memory_used > self.memory_bytes:
+      _, evicted = self.memory.popitem(last=False)
+      self.memory_used -= len(evicted)
+
+  def _evict_disk(self):
+    while self.disk_used > self.disk_bytes and self.disk:
+      key, size = self.disk.popitem(last=False)
+      self.disk_used -= size
+      try:
+        os.remove(self._path(key))
+      except OSError:
+        pass
+
+  def get(self, key):
+    with self.lock:
+      data = self.memory.get(key)
+      if data is not None:
+        self.memory.move_to_end(key)
+        if key in self.disk:
+          self.disk.move_to_end(key)
+      elif key in self.disk:
+        try:
+          with open(self._path(key), "rb") as f:
+            data = f.read()
+          os.utime(self._path(key))
+          self.disk.move_to_end(key)
+          self._put_memory(key, data)
+        except OSError:
+          self.disk_used -= self.disk.pop(key)
+      if data is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+      return data
+
+  def put(self, key, data):
+    with self.lock:
+      self._put_memory(key, data)
+      if not self.disk_dir or key in self.disk or len(data) > self.disk_bytes:
+        return
+      # Write then rename, readers never see a partial entry.
+      tmp_path = f"{self._path(key)}.tmp"
+      with open(tmp_path, "wb") as f:
+        f.write(data)
+      os.replace(tmp_path, self._path(key))
+      self.disk[key] = len(data)
+      self.disk_used += len(data)
+      self._evict_disk()
@@ -0,0 +1,641 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""HTTP server for F5 TTS on the AOT executables of generate_f5_aot.py, needs no Gradio.
+
+  POST /v1/synthesize  JSON request, see `parse_synthesis_request`. Returns WAV, FLAC, Opus or MP3,
+                       with "stream": true sent chunked as the text chunks finish.
+  GET  /healthz        200 while the server runs.
+  GET  /readyz         200 once every batch bucket of every replica ran once, lists the warm buckets.
+  POST /admin/weights  {"pretrained_model_name_or_path": ..., "quantized_params_path": ...} swaps the
+                       served weights without downtime, see `swap_weights`. quantized_params_path is
+                       required with quantization. Needs the bearer token serve_admin_token, disabled
+                       while it is empty.
+
+The text chunks of all queued requests are batched together on a single device thread, a
+request with more chunks than the largest bucket spans several batches. Batches are pipelined:
+the device thread only builds a batch's inputs and enqueues its executables, a fetch thread
+waits for its audio, so the next batch is dispatched while the devices run the previous one.
+At most serve_pipeline_depth batches are in flight, each holds its inputs and outputs in device
+memory. Requests are parsed and prepared on other threads meanwhile. With serve_replicas > 1
+the local devices are split into that many sub-meshes, each with its own weights, executables,
+queue and device thread, and each request goes to the replica with the fewest chunks queued or
+running, so that small requests run side by side instead of one after the other. The queue is bounded
+by serve_max_queued_chunks, past it requests get a 503 with Retry-After. Chunks already in the
+result cache (result_cache_memory_mb, result_cache_dir) skip the queue and the devices. Audio
+is encoded on a pool of serve_encode_workers threads, overlapping the device work of the next
+batch. The stage timings of a request are logged, and sent as Server-Timing when not streamed.
+
+With serve_latency_targets_ms, requests name a priority class with a latency target and are
+admitted against it, see `F5Server.admit`. Queued chunks are batched by class, most urgent
+first, and a request is estimated from the measured seconds of each bucket.
+
+  python src/maxdiffusion/f5_server.py src/maxdiffusion/configs/f5.yml compiled_path=...
+"""
+
+import asyncio
+import base64
+import collections
+import contextlib
+import dataclasses
+import hmac
+import http
+import io
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Sequence
+
+import librosa
+import numpy as np
+import soundfile as sf
+from absl import app
+
+from maxdiffusion import pyconfig, max_logging
+from maxdiffusion.f5_audio_encoding import AUDIO_FORMATS, AudioEncoder, available_audio_formats, encode_audio, pcm16
+from maxdiffusion.f5_engine import (
+    F5Engine,
+    SynthesisError,
+    SynthesisRequest,
+    TARGET_SR,
+    batch_key,
+    replica_device_groups,
+)
+from maxdiffusion.f5_result_cache import ResultCache
+
+# Unconditional prediction reuse of degraded requests, as factors of the requested
+# null_pred_every, cheapest last. The steps and the sequence buckets are compiled in.
+DEGRADED_NULL_PRED_EVERY = (2, 4, 8)
+
+
+class HttpError(Exception):
+
+  def __init__(self, status, message, headers=None):
+    super().__init__(message)
+    self.status = status
+    self.headers = headers or {}
+
+
+def parse_synthesis_request(body, default_seed=0, audio_formats=("wav",), priorities=(), default_priority=""):
+  """Returns (SynthesisRequest, response options) of a JSON body.
+
+  gen_text and ref_text are strings, ref_audio the base64 of an audio file soundfile reads.
+  Optional: speed, sway_sampling, cfg_t_min, cfg_t_max, null_pred_every, seed, and the
+  response options stream, format, one of `audio_formats`, and priority, one of `priorities`.
+  """
+  try:
+    payload = json.loads(body)
+  except ValueError as e:
+    raise SynthesisError(f"Body is not JSON: {e}") from e
+  if not isinstance(payload, dict):
+    raise SynthesisError("Body must be a JSON object.")
+  try:
+    audio, sr = sf.read(io.BytesIO(base64.b64decode(payload["ref_audio"])), dtype="float32")
+    if audio.ndim > 1:
+      audio = np.mean(audio, axis=1)
+    if sr != TARGET_SR:
+      audio = librosa.resample(audio, orig_sr=sr, target_sr=TARGET_SR)
+    request = SynthesisRequest(
+        gen_text=str(payload["gen_text"]),
+        ref_text=str(payload["ref_text"]),
+        ref_audio=audio,
+        speed=float(payload.get("speed", 1.0)),
+        sway_sampling=bool(payload.get("sway_sampling", False)),
+        cfg_t_min=float(payload.get("cfg_t_min", 0.0)),
+        cfg_t_max=float(payload.get("cfg_t_max", 1.0)),
+        null_pred_every=max(int(payload.get("null_pred_every", 1)), 1),
+        seed=int(payload.get("seed", default_seed)),
+    )
+  except KeyError as e:
+    raise SynthesisError(f"Missing field {e}.") from e
+  except (TypeError, ValueError, RuntimeError) as e:
+    raise SynthesisError(f"Invalid request: {e}") from e
+  options = {
+      "stream": bool(payload.get("stream", False)),
+      "format": payload.get("format", "wav"),
+      "priority": payload.get("priority", default_priority),
+  }
+  if options["format"] not in audio_formats:
+    raise SynthesisError(f"Unsupported format {options['format']!r}, available: {', '.join(audio_formats)}.")
+  if priorities and options["priority"] not in priorities:
+    raise SynthesisError(f"Unknown priority {options['priority']!r}, available: {', '.join(priorities)}.")
+  return request, options
+
+
+def degraded_requests(request):
+  """The request, then cheaper variants that reuse the unconditional prediction for longer."""
+  yield request
+  for factor in DEGRADED_NULL_PRED_EVERY:
+    yield dataclasses.replace(request, null_pred_every=request.null_pred_every * factor)
+
+
+class ChunkBatcher:
+  """Batches the queued text chunks of all requests.
+
+  Each chunk has a rank, its priority class, lower is more urgent. A batch takes the chunks of
+  the batch key of the most urgent chunk, by rank then FIFO.
+  """
+
+  def __init__(self, engine, max_queued_chunks, batch_wait_secs, pipeline_depth=2):
+    self.engine = engine
+    self.max_queued_chunks = max_queued_chunks
+    self.batch_wait_secs = batch_wait_secs
+    self.pipeline_depth = pipeline_depth
+    self.pending = collections.deque()  # (batch key, chunk, future, rank)
+    self.wakeup = asyncio.Event()
+    # Batches dispatched and not yet finished.
+    self.slots = asyncio.Semaphore(pipeline_depth)
+    # All device work is dispatched from this thread, one batch at a time.
+    self.device_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="f5_device")
+    # Waits for the batches' audio, in dispatch order.
+    self.fetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="f5_fetch")
+    self.finishing = set()  # tasks of `_finish`
+    self.batch_secs = None  # moving average, for Retry-After
+    self.running_chunks = 0
+    self.running_until = 0.0  # estimated end of the last batch in flight
+
+  @property
+  def queued_chunks(self):
+    return len(self.pending)
+
+  @property
+  def load(self):
+    """Chunks queued or on the devices, what a new request waits for."""
+    return self.queued_chunks + self.running_chunks
+
+  def retry_after(self):
+    batches = self.queued_chunks / self.engine.max_chunks + 1
+    return max(1, math.ceil(batches * (self.batch_secs or 1.0)))
+
+  def check_capacity(self, num_chunks=1):
+    if self.queued_chunks + num_chunks > self.max_queued_chunks:
+      raise HttpError(503, "Synthesis queue is full.", {"Retry-After": str(self.retry_after())})
+
+  def submit(self, request, chunks, rank=0):
+    """Queues the chunks of a request, returns a future for each chunk's audio."""
+    self.check_capacity(len(chunks))
+    loop = asyncio.get_running_loop()
+    key = batch_key(request)
+    futures = [loop.create_future() for _ in chunks]
+    self.pending.extend((key, chunk, future, rank) for chunk, future in zip(chunks, futures))
+    self.wakeup.set()
+    return futures
+
+  def estimate_secs(self, num_chunks, key, rank):
+    """Estimated seconds until `num_chunks` new chunks of batch key `key` and `rank` finish.
+
+    Counts the rest of the running batch and the queued chunks of the same or more urgent ranks,
+    batched per key. None while a bucket has no measurement.
+    """
+    queued = collections.Counter(
+        item_key for item_key, _, future, item_rank in self.pending if item_rank <= rank and not future.cancelled()
+    )
+    queued[key] += num_chunks
+    secs = max(0.0, self.running_until - time.time()) if self.running_chunks else 0.0
+    for item_key, chunks in queued.items():
+      full_batches, rest = divmod(chunks, self.engine.max_chunks)
+      for batch_chunks, count in ((self.engine.max_chunks, full_batches), (rest, 1 if rest else 0)):
+        if count:
+          batch_secs = self.engine.batch_secs(batch_chunks, *item_key)
+          if batch_secs is None:
+            return None
+          secs += count * batch_secs
+    return secs
+
+  def _take_batch(self):
+    """Removes up to `max_chunks` chunks of the most urgent chunk's key, drops cancelled ones."""
+    live = [item for item in self.pending if not item[2].cancelled()]
+    if not live:
+      self.pending = collections.deque()
+      return None, []
+    # sorted is stable, FIFO within a rank.
+    by_rank = sorted(live, key=lambda item: item[3])
+    key = by_rank[0][0]
+    batch = [item for item in by_rank if item[0] == key][: self.engine.max_chunks]
+    taken = {id(item) for item in batch}
+    self.pending = collections.deque(item for item in live if id(item) not in taken)
+    return key, batch
+
+  @contextlib.asynccontextmanager
+  async def exclusive(self):
+    """Holds every pipeline slot, no batch is in flight inside, e.g. to swap the weights."""
+    for _ in range(self.pipeline_depth):
+      await self.slots.acquire()
+    try:
+      yield
+    finally:
+      for _ in range(self.pipeline_depth):
+        self.slots.release()
+
+  async def run_exclusive(self, fn, *args):
+    """Runs `fn` on the device thread with no batch in flight."""
+    async with self.exclusive():
+      return await asyncio.get_running_loop().run_in_executor(self.device_executor, fn, *args)
+
+  def _fail(self, batch, error):
+    max_logging.log(f"Batch of {len(batch)} chunks failed: {error}")
+    for _, _, future, _ in batch:
+      if not future.done():
+        future.set_exception(error)
+
+  async def run(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      while not self.pending:
+        self.wakeup.clear()
+        await self.wakeup.wait()
+      await self.slots.acquire()
+      # Let concurrent requests join a batch that is not full yet.
+      if self.queued_chunks < self.engine.max_chunks:
+        await asyncio.sleep(self.batch_wait_secs)
+      key, batch = self._take_batch()
+      if not batch:
+        self.slots.release()
+        continue
+      self.running_chunks += len(batch)
+      batch_secs = self.engine.batch_secs(len(batch), *key) or 0.0
+      self.running_until = max(self.running_until, time.time()) + batch_secs
+      try:
+        pending = await loop.run_in_executor(
+            self.device_executor, self.engine.dispatch_batch, [chunk for _, chunk, _, _ in batch], *key
+        )
+      except Exception as e:  # pylint: disable=broad-except
+        self._fail(batch, e)
+        self.running_chunks -= len(batch)
+        self.slots.release()
+        continue
+      task = asyncio.create_task(self._finish(batch, pending))
+      self.finishing.add(task)
+      task.add_done_callback(self.finishing.discard)
+
+  async def _finish(self, batch, pending):
+    """Hands a dispatched batch's audio to its futures, frees its pipeline slot."""
+    try:
+      audio, stats = await asyncio.get_running_loop().run_in_executor(
+          self.fetch_executor, self.engine.finish_batch, pending
+      )
+    except Exception as e:  # pylint: disable=broad-except
+      self._fail(batch, e)
+      return
+    finally:
+      self.running_chunks -= len(batch)
+      self.slots.release()
+    device_secs = stats["device_secs"]
+    self.batch_secs = device_secs if self.batch_secs is None else 0.8 * self.batch_secs + 0.2 * device_secs
+    max_logging.log(
+        f"Batch of {stats['rows']} chunks in bucket {stats['bucket']}: {stats['device_secs']:.2f}s, "
+        f"{self.queued_chunks} chunks queued"
+    )
+    for (_, _, future, _), chunk_audio in zip(batch, audio):
+      if not future.done():
+        future.set_result(chunk_audio)
+
+
+class F5Server:
+  """The HTTP front of one F5Engine per replica, one request per connection."""
+
+  def __init__(self, engines, config):
+    self.config = config
+    self.batchers = [
+        ChunkBatcher(
+            engine, config.serve_max_queued_chunks, config.serve_batch_wait_ms / 1000, config.serve_pipeline_depth
+        )
+        for engine in engines
+    ]
+    self.result_cache = ResultCache.from_config(config)
+    self.audio_formats = available_audio_formats()
+    self.swap_lock = asyncio.Lock()
+    # Priority classes by latency target, most urgent first. Delayed requests rank after all.
+    self.latency_targets = {
+        priority: target_ms / 1000 for priority, target_ms in (config.serve_latency_targets_ms or {}).items()
+    }
+    self.priority_ranks = {
+        priority: rank for rank, priority in enumerate(sorted(self.latency_targets, key=self.latency_targets.get))
+    }
+    self.encode_executor = ThreadPoolExecutor(max_workers=config.serve_encode_workers, thread_name_prefix="f5_encode")
+
+  async def serve(self):
+    loop = asyncio.get_running_loop()
+    server = await asyncio.start_server(self.handle, self.config.serve_host, self.config.serve_port)
+    max_logging.log(f"F5 server listening on {self.config.serve_host}:{self.config.serve_port}")
+    batchers = [asyncio.create_task(batcher.run()) for batcher in self.batchers]
+    async with server:
+      # Each replica loads and warms up on its own device thread, side by side.
+      await asyncio.gather(
+          *(loop.run_in_executor(batcher.device_executor, batcher.engine.load) for batcher in self.batchers)
+      )
+      await asyncio.gather(
+          *(loop.run_in_executor(batcher.device_executor, batcher.engine.warmup) for batcher in self.batchers)
+      )
+      await asyncio.gather(server.serve_forever(), *batchers)
+
+  def dispatch(self):
+    """The loaded replica with the fewest chunks queued or running, first one on ties."""
+    loaded = [batcher for batcher in self.batchers if batcher.engine.loaded]
+    if not loaded:
+      raise HttpError(503, "Model is loading.", {"Retry-After": "30"})
+    return min(loaded, key=lambda batcher: batcher.load)
+
+  async def handle(self, reader, writer):
+    try:
+      method, path, headers, body = await self.read_request(reader)
+      if path == "/healthz" and method == "GET":
+        await self.send_json(writer, 200, {"status": "ok"})
+      elif path == "/readyz" and method == "GET":
+        engines = [batcher.engine for batcher in self.batchers]
+        ready = all(engine.warm_buckets.issuperset(engine.bucket_sizes) for engine in engines)
+        await self.send_json(
+            writer,
+            200 if ready else 503,
+            {
+                "ready": ready,
+                "loaded": all(engine.loaded for engine in engines),
+                "buckets": engines[0].bucket_sizes,
+                "replicas": [
+                    {
+                        "warm_buckets": sorted(batcher.engine.warm_buckets),
+                        "bucket_secs": {bucket: round(secs, 3) for bucket, secs in batcher.engine.bucket_secs.items()},
+                        "queued_chunks": batcher.queued_chunks,
+                        "running_chunks": batcher.running_chunks,
+                    }
+                    for batcher in self.batchers
+                ],
+            },
+        )
+      elif path == "/v1/synthesize" and method == "POST":
+        await self.synthesize(body, writer)
+      elif path == "/admin/weights" and method == "POST" and self.config.serve_admin_token:
+        expected = f"Bearer {self.config.serve_admin_token}"
+        if not hmac.compare_digest(headers.get("authorization", "").encode(), expected.encode()):
+          raise HttpError(401, "Missing or wrong admin token.")
+        await self.send_json(writer, 200, await self.swap_weights(body))
+      elif path in ("/healthz", "/readyz", "/v1/synthesize"):
+        raise HttpError(405, f"{method} is not allowed on {path}.")
+      else:
+        raise HttpError(404, f"No route {path}.")
+    except HttpError as e:
+      await self.send_json(writer, e.status, {"error": str(e)}, e.headers)
+    except SynthesisError as e:
+      await self.send_json(writer, 400, {"error": str(e)})
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    except Exception as e:  # pylint: disable=broad-except
+      max_logging.log(f"Request failed: {e}")
+      await self.send_json(writer, 500, {"error": str(e)})
+    finally:
+      writer.close()
+
+  async def read_request(self, reader):
+    request_line = (await reader.readline()).decode("latin-1").split()
+    if len(request_line) != 3:
+      raise HttpError(400, "Malformed request line.")
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+      name, _, value = line.decode("latin-1").partition(":")
+      headers[name.strip().lower()] = value.strip()
+    try:
+      length = int(headers.get("content-length", 0))
+    except ValueError as e:
+      raise HttpError(400, "Malformed Content-Length.") from e
+    if length > self.config.serve_max_request_bytes:
+      raise HttpError(413, f"Request body over {self.config.serve_max_request_bytes} bytes.")
+    body = await reader.readexactly(length) if length else b""
+    return request_line[0], request_line[1].split("?", 1)[0], headers, body
+
+  def write_head(self, writer, status, headers):
+    lines = [f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    writer.write(("\r\n".join(lines + ["Connection: close", "", ""])).encode("latin-1"))
+
+  async def write_chunk(self, writer, data):
+    if not data:
+      return  # an empty chunk would end the response
+    writer.write(f"{len(data):X}\r\n".encode("latin-1") + data + b"\r\n")
+    await writer.drain()
+
+  async def send_json(self, writer, status, payload, headers=None):
+    body = json.dumps(payload).encode("utf-8")
+    headers = {"Content-Type": "application/json", "Content-Length": len(body), **(headers or {})}
+    self.write_head(writer, status, headers)
+    writer.write(body)
+    await writer.drain()
+
+  async def swap_weights(self, body):
+    """Swaps the weights of every replica for a checkpoint of the same shapes, without a recompile.
+
+    Each replica loads the checkpoint into new device buffers while it keeps serving, then runs
+    a canary batch with them between two of its batches. Only when every replica passed, each
+    replica swaps, again with no batch in flight, and frees the previous buffers. Otherwise the
+    new buffers are freed and the served weights stay.
+    """
+    try:
+      payload = json.loads(body)
+      path = str(payload["pretrained_model_name_or_path"])
+      quantized_params_path = payload.get("quantized_params_path")
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+      raise HttpError(400, f"Expected a JSON object with pretrained_model_name_or_path: {e}") from e
+    if self.config.quantization and not quantized_params_path:
+      # The served int8 weights were converted from the served checkpoint, not from `path`.
+      raise HttpError(400, "quantized_params_path is required with quantization.")
+    if self.swap_lock.locked():
+      raise HttpError(409, "A weight swap is already running.")
+    async with self.swap_lock:
+      if not all(batcher.engine.loaded for batcher in self.batchers):
+        raise HttpError(503, "Model is loading.", {"Retry-After": "30"})
+      loop = asyncio.get_running_loop()
+      t_start = time.time()
+      loaded = await asyncio.gather(
+          *(
+              loop.run_in_executor(None, batcher.engine.load_weights, path, quantized_params_path)
+              for batcher in self.batchers
+          ),
+          return_exceptions=True,
+      )
+      t_loaded = time.time()
+      errors = [result for result in loaded if isinstance(result, BaseException)]
+      if not errors:
+        errors = [
+            result
+            for result in await asyncio.gather(
+                *(
+                    batcher.run_exclusive(batcher.engine.canary, weights)
+                    for batcher, weights in zip(self.batchers, loaded)
+                ),
+                return_exceptions=True,
+            )
+            if isinstance(result, BaseException)
+        ]
+      if errors:
+        for batcher, weights in zip(self.batchers, loaded):
+          if not isinstance(weights, BaseException):
+            batcher.engine.discard_weights(weights)
+        max_logging.log(f"Weight swap to {path} failed: {errors[0]}")
+        raise HttpError(400, f"Weights of {path} rejected: {errors[0]}")
+      await asyncio.gather(
+          *(
+              batcher.run_exclusive(batcher.engine.swap_weights, weights, path, quantized_params_path)
+              for batcher, weights in zip(self.batchers, loaded)
+          )
+      )
+    return {
+        "pretrained_model_name_or_path": path,
+        "fingerprint": self.batchers[0].engine.fingerprint,
+        "load_secs": round(t_loaded - t_start, 3),
+        "total_secs": round(time.time() - t_start, 3),
+    }
+
+  def admit(self, batcher, request, priority, num_chunks, elapsed_secs):
+    """Returns (request to queue, its rank, admission) for `num_chunks` chunks to synthesize.
+
+    Admitted: the estimated latency meets the target of the priority class, possibly only
+    "degraded" to cheaper guidance, see `degraded_requests`. "delayed": it does not, but the
+    cheapest variant behind all other classes stays within serve_slo_delay_factor times the
+    target. Otherwise rejected with a 503. Without targets or measurements, admits as is.
+    """
+    if not self.latency_targets or not num_chunks:
+      return request, 0, "admitted"
+    target = self.latency_targets[priority]
+    rank = self.priority_ranks[priority]
+    candidates = list(degraded_requests(request))
+    for candidate in candidates:
+      estimate = batcher.estimate_secs(num_chunks, batch_key(candidate), rank)
+      if estimate is None or elapsed_secs + estimate <= target:
+        return candidate, rank, "admitted" if candidate is request else "degraded"
+    delayed_rank = len(self.priority_ranks)
+    estimate = batcher.estimate_secs(num_chunks, batch_key(candidates[-1]), delayed_rank)
+    if estimate is None or elapsed_secs + estimate <= target * self.config.serve_slo_delay_factor:
+      return candidates[-1], delayed_rank, "delayed"
+    raise HttpError(
+        503,
+        f"Estimated latency {elapsed_secs + estimate:.1f}s misses the {priority} target of {target:.1f}s.",
+        {"Retry-After": str(max(1, math.ceil(estimate)))},
+    )
+
+  async def synthesize(self, body, writer):
+    t_start = time.time()
+    batcher = self.dispatch()
+    # Reject before the host side preprocessing when the queue is already full.
+    batcher.check_capacity()
+    loop = asyncio.get_running_loop()
+    timings = collections.defaultdict(float)  # stage -> seconds
+    request, options = await loop.run_in_executor(
+        None,
+        parse_synthesis_request,
+        body,
+        self.config.seed,
+        self.audio_formats,
+        tuple(self.latency_targets),
+        self.config.serve_default_priority,
+    )
+    timings["parse"] = time.time() - t_start
+    t_prepare = time.time()
+    # The chunk keys name the weights of the time of `prepare`.
+    fingerprint = batcher.engine.fingerprint
+    chunks = await loop.run_in_executor(None, batcher.engine.prepare, request, self.result_cache)
+    timings["prepare"] = time.time() - t_prepare
+    misses = [chunk for chunk in chunks if chunk.pcm is None]
+    if len(misses) > batcher.max_queued_chunks:
+      raise SynthesisError(f"Too many text chunks ({len(misses)}), the maximum is {batcher.max_queued_chunks}.")
+    queued, rank, admission = self.admit(batcher, request, options["priority"], len(misses), time.time() - t_start)
+    if queued is not request:
+      # The chunk keys name the requested guidance, degraded audio is not cached under them.
+      fingerprint = None
+    futures = batcher.submit(queued, misses, rank)
+    content_type = AUDIO_FORMATS[options["format"]][0]
+    try:
+      if options["stream"]:
+        # Chunked transfer, each text chunk's audio is encoded and sent once it and the ones
+        # before it finish.
+        encoder = AudioEncoder(options["format"])
+        self.write_head(
+            writer, 200, {"Content-Type": content_type, "Transfer-Encoding": "chunked", "X-Admission": admission}
+        )
+        try:
+          async for data in self.chunk_pcm(chunks, futures, timings, batcher.engine, fingerprint):
+            await self.write_chunk(writer, await self.encode(timings, encoder.encode, data))
+          await self.write_chunk(writer, await self.encode(timings, encoder.close))
+        except Exception as e:  # pylint: disable=broad-except
+          # The status is already sent, the missing last chunk tells the client the stream failed.
+          max_logging.log(f"Streamed request failed: {e}")
+          return
+        writer.write(b"0\r\n\r\n")
+      else:
+        pcm = b"".join([data async for data in self.chunk_pcm(chunks, futures, timings, batcher.engine, fingerprint)])
+        data = await self.encode(timings, encode_audio, pcm, options["format"])
+        server_timing = ", ".join(f"{stage};dur={secs * 1000:.1f}" for stage, secs in timings.items())
+        self.write_head(
+            writer,
+            200,
+            {
+                "Content-Type": content_type,
+                "Content-Length": len(data),
+                "Server-Timing": server_timing,
+                "X-Admission": admission,
+            },
+        )
+        writer.write(data)
+      await writer.drain()
+    finally:
+      # Chunks of a client that went away leave the queue.
+      for future in futures:
+        future.cancel()
+    cached = len(chunks) - len(misses)
+    stages = ", ".join(f"{stage} {secs:.2f}s" for stage, secs in timings.items())
+    max_logging.log(
+        f"Synthesized {len(chunks)} chunks ({cached} cached, {admission}) in {time.time() - t_start:.2f}s: {stages}"
+    )
+
+  async def chunk_pcm(self, chunks, futures, timings, engine, fingerprint):
+    """Yields the audio of each chunk in order, from the result cache or the batcher.
+
+    The audio is cached only while `engine` still serves the weights of `fingerprint`, a chunk
+    synthesized after a weight swap does not belong under its key.
+    """
+    futures = iter(futures)
+    for chunk in chunks:
+      if chunk.pcm is not None:
+        yield chunk.pcm
+        continue
+      t_start = time.time()
+      data = pcm16(await next(futures))
+      timings["synthesis"] += time.time() - t_start
+      if self.result_cache is not None and engine.fingerprint == fingerprint:
+        asyncio.get_running_loop().run_in_executor(None, self.result_cache.put, chunk.key, data)
+      yield data
+
+  async def encode(self, timings, encode_fn, *args):
+    """Runs `encode_fn` on the encoding pool, the device thread meanwhile runs the next batch."""
+    t_start = time.time()
+    data = await asyncio.get_running_loop().run_in_executor(self.encode_executor, encode_fn, *args)
+    timings["encode"] += time.time() - t_start
+    return data
+
+
+def main(argv: Sequence[str]) -> None:
+  pyconfig.initialize(argv)
+  config = pyconfig.config
+  if config.serve_replicas > 1:
+    groups = replica_device_groups(config.serve_replicas)
+    engines = [F5Engine(config, devices, replica) for replica, devices in enumerate(groups)]
+  else:
+    engines = [F5Engine(config)]
+  server = F5Server(engines, config)
+  asyncio.run(server.serve())
+
+
+if __name__ == "__main__":
+  app.run(main)
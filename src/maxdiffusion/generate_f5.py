@@ -44,7 +44,12 @@ from maxdiffusion.max_utils import (
     setup_initial_state,
 )
 import time
-from maxdiffusion.models.modeling_flax_pytorch_utils import convert_f5_state_dict_to_flax
+from maxdiffusion.checkpointing.checkpointing_utils import check_f5_sampling_config, load_f5_params, load_f5_sampling_config
+from maxdiffusion.models.block_cache import block_cache_bytes, block_cache_from_config, block_cache_hit_rate
+from maxdiffusion.schedulers.flow_match_guidance import guidance_controls_from_config, guided_velocity, init_guidance_cache
+from maxdiffusion.schedulers.flow_match_solvers import init_solver_state, solver_step
+from maxdiffusion.models import quantizations
+from maxdiffusion.quantize_f5 import load_quantized_transformer_state
 import os
 from importlib.resources import files
 import librosa
@@ -60,40 +65,80 @@ def loop_body(
     decoder_segment_ids,
     text_embed_cond,
     text_embed_uncond,
+    rotary_cos_sin,
+    guidance_controls,
+    solver,
+    guidance_distilled,
 ):
-    latents,state, c_ts, p_ts = args
-    latents_dtype = latents.dtype
-    t_curr = c_ts[step]
-    t_prev = p_ts[step]
-    t_vec = jnp.full((latents.shape[0],), t_curr, dtype=latents.dtype)
-    pred = transformer.apply(
-        {"params": state.params},
-        x=latents,
-        cond=cond,
-        decoder_segment_ids=decoder_segment_ids,
-        text_embed=text_embed_cond,
-        timestep=t_vec,
-    )
-    null_pred = transformer.apply(
-        {"params": state.params},
-        x=latents,
-        cond=jnp.zeros_like(cond),
-        decoder_segment_ids=decoder_segment_ids,
-        text_embed=text_embed_uncond,
-        timestep=t_vec,
-        #drop_audio_cond=True,
-    )
-    pred = pred + (pred - null_pred) * cfg_strength
-    latents = latents + (t_prev - t_curr) * pred
-    latents = jnp.array(latents, dtype=latents_dtype)
-    return latents, state, c_ts, p_ts
+    latents,state, c_ts, p_ts, solver_state, guidance_cache, block_caches = args
+    variables = {"params": state.params} if state.aqt is None else {"params": state.params, "aqt": state.aqt}
+
+    def apply(x, t, cond, text_embed, block_cache, guidance=None):
+        """Returns (prediction, block cache), the cache is None without use_block_cache."""
+        kwargs = {} if block_cache is None else {"block_cache": block_cache}
+        out = transformer.apply(
+            variables,
+            x=x,
+            cond=cond,
+            decoder_segment_ids=decoder_segment_ids,
+            text_embed=text_embed,
+            timestep=jnp.full((x.shape[0],), t, dtype=x.dtype),
+            rotary_cos_sin=rotary_cos_sin,
+            guidance=guidance,
+            **kwargs,
+        )
+        return out if block_cache is not None else (out, None)
+
+    def pred_fn(x, t):
+        nonlocal block_caches
+        guidance = jnp.full((x.shape[0],), cfg_strength, dtype=x.dtype) if transformer.guidance_embeds else None
+        pred, cond_cache = apply(x, t, cond, text_embed_cond, None if block_caches is None else block_caches["cond"], guidance)
+        if block_caches is not None:
+            block_caches = {**block_caches, "cond": cond_cache}
+        return pred
+
+    def null_pred_fn(x, t, block_cache):
+        #drop_audio_cond=True
+        return apply(x, t, jnp.zeros_like(cond), text_embed_uncond, block_cache)
+
+    def velocity(x, t):
+        nonlocal guidance_cache, block_caches
+        if guidance_distilled:
+            return pred_fn(x, t)
+        # The solver's evaluations are traced in order, the caches thread through them.
+        pred, guidance_cache, null_cache = guided_velocity(
+            pred_fn,
+            null_pred_fn,
+            lambda pred, null_pred: pred + (pred - null_pred) * cfg_strength,
+            x,
+            t,
+            guidance_controls,
+            guidance_cache,
+            None if block_caches is None else block_caches["null"],
+        )
+        if block_caches is not None:
+            block_caches = {**block_caches, "null": null_cache}
+        return pred
+
+    latents, solver_state = solver_step(solver, velocity, latents, c_ts[step], p_ts[step], solver_state)
+    return latents, state, c_ts, p_ts, solver_state, guidance_cache, block_caches
 
 def run_inference(
-    states, transformer, config, mesh, latents, cond, decoder_segment_ids,text_embed_cond,text_embed_uncond, c_ts, p_ts
+    states, transformer, config, mesh, latents, cond, decoder_segment_ids,text_embed_cond,text_embed_uncond, c_ts, p_ts, guidance_distilled=False
 ):
 
   transformer_state = states
-
+  if config.use_block_cache:
+    transformer = transformer.clone(block_cache_start=config.block_cache_start)
+
+  # Rotary tables depend only on the sequence length and mask, so build them once
+  # here instead of in every block of every diffusion step.
+  rotary_cos_sin = transformer.apply(
+      {"params": transformer_state.params},
+      latents.shape[1],
+      decoder_segment_ids,
+      method=F5Transformer2DModel.rotary_cos_sin,
+  )
 
   loop_body_p = functools.partial(
       loop_body,
@@ -102,12 +147,30 @@ def run_inference(
       decoder_segment_ids=decoder_segment_ids,
       text_embed_cond=text_embed_cond,
       text_embed_uncond=text_embed_uncond,
+      rotary_cos_sin=rotary_cos_sin,
+      guidance_controls=guidance_controls_from_config(config),
+      solver=config.flow_solver,
+      guidance_distilled=guidance_distilled,
   )
 
   with mesh, nn_partitioning.axis_rules(config.logical_axis_rules):
-    latents, _, _, _ = jax.lax.fori_loop(0, len(c_ts), loop_body_p, (latents, transformer_state, c_ts, p_ts))
+    solver_state = init_solver_state(config.flow_solver, latents)
+    guidance_cache = init_guidance_cache(latents)
+    # Block caches of the conditional and unconditional passes, see models/block_cache.py.
+    block_caches = None
+    if config.use_block_cache:
+      block_cache_shape = (latents.shape[0], latents.shape[1], transformer.dim)
+      block_caches = {
+          "cond": block_cache_from_config(config, block_cache_shape),
+          "null": block_cache_from_config(config, block_cache_shape),
+      }
+      max_logging.log(f"Block cache: {block_cache_bytes(block_caches) / 2**20:.1f} MiB")
+    latents, _, _, _, _, _, block_caches = jax.lax.fori_loop(
+        0, len(c_ts), loop_body_p, (latents, transformer_state, c_ts, p_ts, solver_state, guidance_cache, block_caches)
+    )
 
-  return latents
+  hit_rate = block_cache_hit_rate(*block_caches.values()) if block_caches is not None else jnp.zeros(())
+  return latents, hit_rate
 
 def run(config):
   
@@ -129,8 +192,18 @@ def run(config):
         dtype=config.activations_dtype,
         weights_dtype=config.weights_dtype,
         precision=get_precision(config),
+        scan_layers=config.scan_layers,
+        remat_policy=config.remat_policy,
+        quant=quantizations.configure_quantization(config, "serve"),
     )
-    transformer_params,text_encoder_params = convert_f5_state_dict_to_flax(config.pretrained_model_name_or_path,use_ema=config.use_ema)
+    transformer_params,text_encoder_params = load_f5_params(config.pretrained_model_name_or_path,use_ema=config.use_ema, scan_layers=config.scan_layers)
+    sampling_config = load_f5_sampling_config(config.pretrained_model_name_or_path)
+    check_f5_sampling_config(sampling_config, config.num_inference_steps, config.sway_sampling_coef)
+    guidance_distilled = sampling_config.get("guidance_distilled", False)
+    if guidance_distilled:
+        max_logging.log(f"Guidance distilled checkpoint (num_inference_steps: {sampling_config['num_inference_steps']}), skipping the unconditional pass")
+    if "guidance_embed" in transformer_params:
+        transformer = transformer.clone(guidance_embeds=True)
     weights_init_fn = functools.partial(transformer.init_weights, rngs=rng, max_sequence_length=config.max_sequence_length, eval_only=False)
     transformer_state, transformer_state_shardings = setup_initial_state(
         model=transformer,
@@ -142,6 +215,10 @@ def run(config):
         training=False,
     )
     transformer_state = transformer_state.replace(params=transformer_params)
+    if config.quantization:
+        transformer_state, transformer_state_shardings = load_quantized_transformer_state(
+            transformer, config, mesh, transformer_state, transformer_state_shardings
+        )
     transformer_state = jax.device_put(transformer_state, transformer_state_shardings)
     get_memory_allocations()
     def dynamic_range_compression_jax(x, C=1, clip_val=1e-7):
@@ -393,12 +470,15 @@ def run(config):
         text_embed_uncond=text_embed_uncond,
         c_ts=c_ts,
         p_ts=p_ts,
+        guidance_distilled=guidance_distilled,
     ),
     in_shardings=(transformer_state_shardings,),
     out_shardings=None,
     )
 
-    y_final = p_run_inference(transformer_state)
+    y_final, hit_rate = p_run_inference(transformer_state)
+    if config.use_block_cache:
+        max_logging.log(f"Block cache hit rate: {float(hit_rate):.2f}")
     out = y_final
     out = jnp.where(cond_mask[...,jnp.newaxis], cond, out)
     from jax_vocos import load_model
@@ -30,7 +30,13 @@ from maxdiffusion.max_utils import (
     setup_initial_state,
 )
 import time
-from maxdiffusion.models.modeling_flax_pytorch_utils import convert_f5_state_dict_to_flax
+from maxdiffusion.checkpointing.checkpointing_utils import check_f5_sampling_config, load_f5_params, load_f5_sampling_config
+from maxdiffusion.models.block_cache import block_cache_bytes, block_cache_from_config, block_cache_hit_rate
+from maxdiffusion.schedulers.flow_match_guidance import guidance_controls_from_config, guided_velocity, init_guidance_cache
+from maxdiffusion.schedulers.flow_match_solvers import init_solver_state, solver_step
+from maxdiffusion.models import quantizations
+from maxdiffusion.quantize_f5 import load_quantized_transformer_state
+from maxdiffusion.f5_engine import executable_suffixes, replica_device_groups
 import os
 from importlib.resources import files
 import librosa
@@ -285,49 +291,89 @@ def loop_body(
     decoder_segment_ids,
     text_embed_cond,
     text_embed_uncond,
+    rotary_cos_sin,
+    guidance_controls,
+    solver,
+    guidance_distilled,
 ):
-    latents, state, c_ts, p_ts = args
-    latents_dtype = latents.dtype
-    t_curr = c_ts[step]
-    t_prev = p_ts[step]
-    t_vec = jnp.full((latents.shape[0],), t_curr, dtype=latents.dtype)
+    latents, state, c_ts, p_ts, solver_state, guidance_cache, block_caches = args
+    variables = {"params": state.params} if state.aqt is None else {"params": state.params, "aqt": state.aqt}
+
+    def apply(x, t, cond, text_embed, block_cache, guidance=None):
+        """Returns (prediction, block cache), the cache is None without use_block_cache."""
+        kwargs = {} if block_cache is None else {"block_cache": block_cache}
+        out = transformer.apply(
+            variables,
+            x=x,
+            cond=cond,
+            decoder_segment_ids=decoder_segment_ids,
+            text_embed=text_embed,
+            timestep=jnp.full((x.shape[0],), t, dtype=x.dtype),
+            rotary_cos_sin=rotary_cos_sin,
+            guidance=guidance,
+            **kwargs,
+        )
+        return out if block_cache is not None else (out, None)
 
     # Conditional prediction
-    pred = transformer.apply(
-        {"params": state.params},
-        x=latents,
-        cond=cond,
-        decoder_segment_ids=decoder_segment_ids,
-        text_embed=text_embed_cond,
-        timestep=t_vec,
-    )
+    def pred_fn(x, t):
+        nonlocal block_caches
+        # Guidance embeddings take generate_f5's scale, pred + (pred - null_pred) * scale.
+        guidance = jnp.full((x.shape[0],), cfg_strength - 1, dtype=x.dtype) if transformer.guidance_embeds else None
+        pred, cond_cache = apply(x, t, cond, text_embed_cond, None if block_caches is None else block_caches["cond"], guidance)
+        if block_caches is not None:
+            block_caches = {**block_caches, "cond": cond_cache}
+        return pred
 
     # Unconditional prediction
-    null_pred = transformer.apply(
-        {"params": state.params},
-        x=latents,
-        cond=jnp.zeros_like(cond),
-        decoder_segment_ids=decoder_segment_ids,
-        text_embed=text_embed_uncond,
-        timestep=t_vec,
-        #drop_audio_cond=True,
-    )
-
-    # Classifier-Free Guidance
-    guidance_scale = cfg_strength # Use global or Gradio input
-    pred = null_pred + guidance_scale * (pred - null_pred)
+    def null_pred_fn(x, t, block_cache):
+        #drop_audio_cond=True
+        return apply(x, t, jnp.zeros_like(cond), text_embed_uncond, block_cache)
+
+    def velocity(x, t):
+        nonlocal guidance_cache, block_caches
+        if guidance_distilled:
+            return pred_fn(x, t)
+        # Classifier-Free Guidance inside the guidance interval, the unconditional prediction
+        # is reused between recomputes. The solver's evaluations are traced in order, the
+        # caches thread through them.
+        guidance_scale = cfg_strength # Use global or Gradio input
+        pred, guidance_cache, null_cache = guided_velocity(
+            pred_fn,
+            null_pred_fn,
+            lambda pred, null_pred: null_pred + guidance_scale * (pred - null_pred),
+            x,
+            t,
+            guidance_controls,
+            guidance_cache,
+            None if block_caches is None else block_caches["null"],
+        )
+        if block_caches is not None:
+            block_caches = {**block_caches, "null": null_cache}
+        return pred
 
-    # DDIM-like step (simplified Euler)
-    latents = latents + (t_prev - t_curr) * pred # This matches the original Euler step
-    latents = jnp.array(latents, dtype=latents_dtype) # Recast JAX tracer
+    # Flow matching ODE step from t_curr to t_prev (Euler by default, see flow_match_solvers)
+    latents, solver_state = solver_step(solver, velocity, latents, c_ts[step], p_ts[step], solver_state)
 
-    return latents, state, c_ts, p_ts
+    return latents, state, c_ts, p_ts, solver_state, guidance_cache, block_caches
 
 
 def run_inference(
-    states, latents, cond, decoder_segment_ids, text_embed_cond, text_embed_uncond, c_ts, p_ts, transformer, config, mesh
+    states, latents, cond, decoder_segment_ids, text_embed_cond, text_embed_uncond, c_ts, p_ts, guidance_controls, transformer, config, mesh, solver=None, guidance_distilled=False
 ):
     transformer_state = states # Assuming states only contain transformer state now
+    solver = solver or config.flow_solver # static, one compiled loop per solver
+    if config.use_block_cache:
+        transformer = transformer.clone(block_cache_start=config.block_cache_start)
+
+    # Rotary tables depend only on the sequence length and mask, so build them once
+    # here instead of in every block of every diffusion step.
+    rotary_cos_sin = transformer.apply(
+        {"params": transformer_state.params},
+        latents.shape[1],
+        decoder_segment_ids,
+        method=F5Transformer2DModel.rotary_cos_sin,
+    )
 
     loop_body_p = functools.partial(
         loop_body,
@@ -336,22 +382,47 @@ def run_inference(
         decoder_segment_ids=decoder_segment_ids,
         text_embed_cond=text_embed_cond,
         text_embed_uncond=text_embed_uncond,
+        rotary_cos_sin=rotary_cos_sin,
+        guidance_controls=guidance_controls,
+        solver=solver,
+        guidance_distilled=guidance_distilled,
     )
 
-    # Removed partitioning axis rules context, assume handled by sharding annotations or global context
-    # with mesh, nn_partitioning.axis_rules(config.logical_axis_rules):
-    # We need the state back if it were being updated (e.g., BatchNorm), but it's not here.
-    latents_final, _, _, _ = jax.lax.fori_loop(0, len(c_ts), loop_body_p, (latents, transformer_state, c_ts, p_ts))
+    # Axis rules are opt-in: with them the flash shard_map shards the batch over data/fsdp,
+    # which the default (batch replicated) buckets are not sized for.
+    with ExitStack() as stack:
+        if config.shard_f5_activations:
+            stack.enter_context(mesh)
+            stack.enter_context(nn_partitioning.axis_rules(config.logical_axis_rules))
+        # We need the state back if it were being updated (e.g., BatchNorm), but it's not here.
+        solver_state = init_solver_state(solver, latents)
+        guidance_cache = init_guidance_cache(latents)
+        # Block caches of the conditional and unconditional passes, see models/block_cache.py.
+        block_caches = None
+        if config.use_block_cache:
+            block_cache_shape = (latents.shape[0], latents.shape[1], transformer.dim)
+            block_caches = {
+                "cond": block_cache_from_config(config, block_cache_shape),
+                "null": block_cache_from_config(config, block_cache_shape),
+            }
+            max_logging.log(f"Block cache: {block_cache_bytes(block_caches) / 2**20:.1f} MiB")
+        latents_final, _, _, _, _, _, block_caches = jax.lax.fori_loop(
+            0, len(c_ts), loop_body_p, (latents, transformer_state, c_ts, p_ts, solver_state, guidance_cache, block_caches)
+        )
 
-    return latents_final
+    # Fraction of model calls that reused the cached block residual, reported per request.
+    hit_rate = block_cache_hit_rate(*block_caches.values()) if block_caches is not None else jnp.zeros(())
+    return latents_final, hit_rate
 
 
 
 # --- Setup Function ---
-def setup_models_and_state(config):
+def setup_models_and_state(config, devices=None, suffix=""):
     """
     Initializes models, states, JIT compiles functions, etc.
     Called once when the Gradio app starts.
+    With `devices`, compiles for a mesh of those devices only and saves the executables
+    with `suffix`, see replica_device_groups in f5_engine.py.
     """
     global global_config, global_mesh, global_transformer, global_transformer_state
     global global_transformer_state_shardings, global_text_encoder, global_text_encoder_params
@@ -359,6 +430,7 @@ def setup_models_and_state(config):
     global global_jitted_vocos_apply_funcs, global_vocab_char_map, global_vocab_size
     global global_p_run_inference_funcs, global_data_sharding, global_max_sequence_length
     global jitted_get_mel
+    global BUCKET_SIZES, MAX_CHUNKS
 
 
 
@@ -366,6 +438,10 @@ def setup_models_and_state(config):
     t_start_setup = time.time()
     max_logging.log("Starting one-time setup...")
     global_config = config # Store config globally
+    if config.aot_bucket_sizes:
+        BUCKET_SIZES = sorted(config.aot_bucket_sizes)
+        MAX_CHUNKS = BUCKET_SIZES[-1]
+        max_logging.log(f"Using batch buckets {BUCKET_SIZES} from config.")
 
     flash_block_sizes = get_flash_block_sizes(config)
     # Store max sequence length from config
@@ -373,7 +449,7 @@ def setup_models_and_state(config):
     max_logging.log(f"Model configured for max sequence length: {global_max_sequence_length}")
 
     rng = jax.random.key(config.seed)
-    devices_array = create_device_mesh(config)
+    devices_array = create_device_mesh(config, devices)
     global_mesh = Mesh(devices_array, config.mesh_axes)
     mesh = global_mesh # Use local variable for clarity in setup
 
@@ -430,7 +506,7 @@ def setup_models_and_state(config):
 
         max_logging.log(f"Warming up jitted_get_mel with dummy shape {dummy_audio_shape} sharded as {sharding_spec_get_mel_input}...")
         compiled_get_mel = jitted_get_mel.lower(dummy_audio_sharded).compile()
-        save_compiled(compiled_get_mel, "get_mel_aot.pickle")
+        save_compiled(compiled_get_mel, f"get_mel_aot{suffix}.pickle")
         max_logging.log("jitted_get_mel successfully AOT compiled.")
         # You could inspect the shape and sharding of the output here if needed
         # test_output = jitted_get_mel(dummy_audio_sharded)
@@ -459,14 +535,25 @@ def setup_models_and_state(config):
         dtype=config.activations_dtype,
         weights_dtype=config.weights_dtype,
         precision=get_precision(config),
+        scan_layers=config.scan_layers,
+        remat_policy=config.remat_policy,
+        quant=quantizations.configure_quantization(config, "serve"),
         #max_seq_len=global_max_sequence_length # Pass max length here
     )
     transformer = global_transformer # Local var
 
     # Load weights
-    transformer_params, text_encoder_params_loaded = convert_f5_state_dict_to_flax(
-        config.pretrained_model_name_or_path, use_ema=config.use_ema
+    transformer_params, text_encoder_params_loaded = load_f5_params(
+        config.pretrained_model_name_or_path, use_ema=config.use_ema, scan_layers=config.scan_layers
     )
+    sampling_config = load_f5_sampling_config(config.pretrained_model_name_or_path)
+    check_f5_sampling_config(sampling_config, config.num_inference_steps, config.sway_sampling_coef)
+    guidance_distilled = sampling_config.get("guidance_distilled", False)
+    if guidance_distilled:
+        max_logging.log(f"Guidance distilled checkpoint (num_inference_steps: {sampling_config['num_inference_steps']}), skipping the unconditional pass")
+    if "guidance_embed" in transformer_params:
+        global_transformer = global_transformer.clone(guidance_embeds=True)
+        transformer = global_transformer
     global_text_encoder_params = flax.core.frozen_dict.FrozenDict(text_encoder_params_loaded) # Store globally
 
     weights_init_fn = functools.partial(transformer.init_weights, rngs=rng, max_sequence_length=config.max_sequence_length, eval_only=False)
@@ -480,6 +567,10 @@ def setup_models_and_state(config):
         training=False,
     )
     global_transformer_state = global_transformer_state.replace(params=transformer_params)
+    if config.quantization:
+        global_transformer_state, global_transformer_state_shardings = load_quantized_transformer_state(
+            transformer, config, mesh, global_transformer_state, global_transformer_state_shardings
+        )
     global_transformer_state = jax.device_put(global_transformer_state, global_transformer_state_shardings)
     # --- Load Text Encoder ---
     max_logging.log("Loading Text Encoder model...")
@@ -541,7 +632,7 @@ def setup_models_and_state(config):
                                     dummy_text_ids,
                                     dummy_text_seg_ids,
                                     rngs_init).compile()
-        save_compiled(text_encode_compiled, f"text_encode_aot_{bucket}.pickle")
+        save_compiled(text_encode_compiled, f"text_encode_aot_{bucket}{suffix}.pickle")
     max_logging.log("Text Encoder AOT compiled.")
 
 
@@ -586,7 +677,7 @@ def setup_models_and_state(config):
         dummy_latents_shape = (bucket, global_max_sequence_length, config.n_mels)
         dummy_latents_vocoder = jnp.zeros(dummy_latents_shape, dtype=jnp.float32)
         vocos_apply_compiled = global_jitted_vocos_apply_funcs[bucket].lower({"params": global_vocos_params}, dummy_latents_vocoder, rngs_voc_init).compile()
-        save_compiled(vocos_apply_compiled, f"vocos_apply_aot_{bucket}.pickle")
+        save_compiled(vocos_apply_compiled, f"vocos_apply_aot_{bucket}{suffix}.pickle")
         max_logging.log(f"Batch Size {bucket} Vocos Cost analysis: {vocos_apply_compiled.cost_analysis()}")
         max_logging.log(f"Batch Size {bucket} Vocos Memory analysis: {vocos_apply_compiled.memory_analysis()}")
     max_logging.log("Vocoder AOT compiled.")
@@ -619,6 +710,7 @@ def setup_models_and_state(config):
         transformer=transformer, # Pass model def
         config=config,
         mesh=mesh,
+        guidance_distilled=guidance_distilled,
         # Other args (latents, cond, etc.) will be provided at call time
     )
 
@@ -631,10 +723,11 @@ def setup_models_and_state(config):
         text_embed_sharding,             # text_embed_cond
         text_embed_sharding,             # text_embed_uncond
         ts_sharding,                     # c_ts
-        ts_sharding                      # p_ts
+        ts_sharding,                     # p_ts
+        None,                            # guidance_controls, replicated
     )
     # Output sharding (final latents) - should match data sharding probably
-    out_shardings_inf = latents_sharding
+    out_shardings_inf = (latents_sharding, None) # final latents, block cache hit rate
 
 
 
@@ -665,9 +758,10 @@ def setup_models_and_state(config):
                 dummy_text_embed,
                 dummy_text_embed,
                 dummy_c_ts,
-                dummy_p_ts
+                dummy_p_ts,
+                guidance_controls_from_config(config),
             ).compile()
-            save_compiled(run_inference_compiled, f"run_inference_aot_{bucket}.pickle")
+            save_compiled(run_inference_compiled, f"run_inference_aot_{bucket}{suffix}.pickle")
             max_logging.log(f"Batch Size {bucket} Inference Cost analysis: {run_inference_compiled.cost_analysis()}")
             max_logging.log(f"Batch Size {bucket} Inference Memory analysis: {run_inference_compiled.memory_analysis()}")
 
@@ -687,7 +781,14 @@ def main(argv: Sequence[str]) -> None:
 
     # Perform one-time setup
     try:
-        setup_models_and_state(config)
+        if config.serve_replicas > 1:
+            # One set of executables per sub-mesh, for the replicas of f5_server.py.
+            groups = replica_device_groups(config.serve_replicas)
+            for devices, suffix in zip(groups, executable_suffixes(config)):
+                max_logging.log(f"Compiling replica{suffix} on devices {[device.id for device in devices]}")
+                setup_models_and_state(config, devices, suffix)
+        else:
+            setup_models_and_state(config)
     except Exception as e:
         max_logging.error(f"Fatal error during setup: {e}", exc_info=True)
         print(f"\n\nERROR DURING SETUP: {e}\nCannot launch Gradio app.")
@@ -33,6 +33,8 @@ from transformers import (CLIPTokenizer, FlaxCLIPTextModel, T5EncoderModel, Flax
 
 from maxdiffusion import FlaxAutoencoderKL, pyconfig, max_logging
 from maxdiffusion.models.flux.transformers.transformer_flux_flax import FluxTransformer2DModel
+from maxdiffusion.models.block_cache import block_cache_from_config, block_cache_hit_rate
+from maxdiffusion.schedulers.flow_match_solvers import init_solver_state, solver_step
 from maxdiffusion.max_utils import (
     device_put_replicated,
     get_memory_allocations,
@@ -92,25 +94,32 @@ def loop_body(
     txt_ids,
     vec,
     guidance_vec,
+    solver,
 ):
-  latents, state, c_ts, p_ts = args
-  latents_dtype = latents.dtype
-  t_curr = c_ts[step]
-  t_prev = p_ts[step]
-  t_vec = jnp.full((latents.shape[0],), t_curr, dtype=latents.dtype)
-  pred = transformer.apply(
-      {"params": state.params},
-      hidden_states=latents,
-      img_ids=latent_image_ids,
-      encoder_hidden_states=prompt_embeds,
-      txt_ids=txt_ids,
-      timestep=t_vec,
-      guidance=guidance_vec,
-      pooled_projections=vec,
-  ).sample
-  latents = latents + (t_prev - t_curr) * pred
-  latents = jnp.array(latents, dtype=latents_dtype)
-  return latents, state, c_ts, p_ts
+  latents, state, c_ts, p_ts, solver_state, block_cache = args
+
+  def velocity(x, t):
+    nonlocal block_cache
+    t_vec = jnp.full((x.shape[0],), t, dtype=x.dtype)
+    kwargs = {} if block_cache is None else {"block_cache": block_cache}
+    out = transformer.apply(
+        {"params": state.params},
+        hidden_states=x,
+        img_ids=latent_image_ids,
+        encoder_hidden_states=prompt_embeds,
+        txt_ids=txt_ids,
+        timestep=t_vec,
+        guidance=guidance_vec,
+        pooled_projections=vec,
+        **kwargs,
+    )
+    # The solver's evaluations are traced in order, the block cache threads through them.
+    if block_cache is not None:
+      out, block_cache = out
+    return out.sample
+
+  latents, solver_state = solver_step(solver, velocity, latents, c_ts[step], p_ts[step], solver_state)
+  return latents, state, c_ts, p_ts, solver_state, block_cache
 
 
 def prepare_latent_image_ids(height, width):
@@ -149,13 +158,23 @@ def run_inference(
       txt_ids=txt_ids,
       vec=vec,
       guidance_vec=guidance_vec,
+      solver=config.flow_solver,
   )
   vae_decode_p = functools.partial(vae_decode, vae=vae, state=vae_state, config=config)
 
+  block_cache = None
+  if config.use_block_cache:
+    hidden_dim = transformer.num_attention_heads * transformer.attention_head_dim
+    block_cache = block_cache_from_config(config, (latents.shape[0], prompt_embeds.shape[1] + latents.shape[1], hidden_dim))
+
   with mesh, nn_partitioning.axis_rules(config.logical_axis_rules):
-    latents, _, _, _ = jax.lax.fori_loop(0, len(c_ts), loop_body_p, (latents, transformer_state, c_ts, p_ts))
+    solver_state = init_solver_state(config.flow_solver, latents)
+    latents, _, _, _, _, block_cache = jax.lax.fori_loop(
+        0, len(c_ts), loop_body_p, (latents, transformer_state, c_ts, p_ts, solver_state, block_cache)
+    )
   image = vae_decode_p(latents)
-  return image
+  hit_rate = block_cache_hit_rate(block_cache) if block_cache is not None else jnp.zeros(())
+  return image, hit_rate
 
 
 def pack_latents(
@@ -319,6 +338,7 @@ def run(config):
       dtype=config.activations_dtype,
       weights_dtype=config.weights_dtype,
       precision=get_precision(config),
+      block_cache_start=config.block_cache_start,
   )
 
   num_channels_latents = transformer.in_channels // 4
@@ -464,24 +484,26 @@ def run(config):
   t0 = time.perf_counter()
   with ExitStack() as stack:
     _ = [stack.enter_context(nn.intercept_methods(interceptor)) for interceptor in lora_interceptors]
-    p_run_inference(states).block_until_ready()
+    jax.block_until_ready(p_run_inference(states))
   t1 = time.perf_counter()
   max_logging.log(f"Compile time: {t1 - t0:.1f}s.")
 
   t0 = time.perf_counter()
   with ExitStack() as stack, jax.profiler.trace("/tmp/trace/"):
     _ = [stack.enter_context(nn.intercept_methods(interceptor)) for interceptor in lora_interceptors]
-    imgs = p_run_inference(states).block_until_ready()
+    imgs, hit_rate = jax.block_until_ready(p_run_inference(states))
   t1 = time.perf_counter()
   max_logging.log(f"Inference time: {t1 - t0:.1f}s.")
 
   t0 = time.perf_counter()
   with ExitStack() as stack:
     _ = [stack.enter_context(nn.intercept_methods(interceptor)) for interceptor in lora_interceptors]
-    imgs = p_run_inference(states).block_until_ready()
+    imgs, hit_rate = jax.block_until_ready(p_run_inference(states))
   imgs = jax.experimental.multihost_utils.process_allgather(imgs, tiled=True)
   t1 = time.perf_counter()
   max_logging.log(f"Inference time: {t1 - t0:.1f}s.")
+  if config.use_block_cache:
+    max_logging.log(f"Block cache hit rate: {float(hit_rate):.2f}")
   imgs = np.array(imgs)
   imgs = (imgs * 0.5 + 0.5).clip(0, 1)
   imgs = np.transpose(imgs, (0, 2, 3, 1))
@@ -14,13 +14,17 @@
  limitations under the License.
  """
 
+import bisect
 import dataclasses
 import glob
+import io
+import os
 import tensorflow as tf
 import numpy as np
 import grain.python as grain
+import jax
 
-from maxdiffusion import multihost_dataloading
+from maxdiffusion import multihost_dataloading, max_logging
 
 
 def make_grain_iterator(
@@ -55,7 +59,7 @@ def make_grain_iterator(
       worker_count=config.grain_worker_count,
   )
 
-  data_iter = multihost_dataloading.MultiHostDataLoadIterator(dataloader, mesh)
+  data_iter = multihost_dataloading.MultiHostDataLoadIterator(dataloader, mesh, config.data_prefetch_depth)
   return data_iter
 
 
@@ -77,3 +81,180 @@ class ParseFeatures(grain.MapTransform):
       return {"pixel_values": moments, "input_ids": clip_embeddings}
 
     return _parse(example)
+
+
+def serialize_example(moments, clip_embeddings):
+  """VAE moments and text encoder hidden states to the record ParseFeatures reads."""
+  feature = {
+      "moments": tf.train.Feature(bytes_list=tf.train.BytesList(value=[tf.io.serialize_tensor(moments).numpy()])),
+      "clip_embeddings": tf.train.Feature(
+          bytes_list=tf.train.BytesList(value=[tf.io.serialize_tensor(clip_embeddings).numpy()])
+      ),
+  }
+  return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+
+def make_f5_grain_iterator(
+    config,
+    dataloading_host_index,
+    dataloading_host_count,
+    mesh,
+):
+  """Grain pipeline for F5 training: mel/text records packed into length-bucketed rows.
+
+  Each batch holds rows of a single length from `f5_length_buckets` with
+  `f5_frames_per_device // length` rows per device, so every batch carries the same
+  number of frames and the trainer compiles one step per bucket. The batches are planned
+  from the duration index next to the shards (`frames.npy` from preprocess_f5.py) with the
+  same seed on every host; each host loads its own rows of every global batch.
+  """
+  rows_per_host = {}
+  for length in sorted(config.f5_length_buckets):
+    rows_per_device = config.f5_frames_per_device // length
+    if rows_per_device < 1:
+      raise ValueError(f"f5_length_buckets entry {length} is larger than f5_frames_per_device.")
+    rows_per_host[length] = rows_per_device * jax.local_device_count()
+
+  # Sorted so record indices line up with the duration index written by preprocess_f5.py.
+  data_files = sorted(glob.glob(config.grain_train_files))
+  data_source = grain.ArrayRecordDataSource(data_files)
+  frames = load_f5_frames_index(config.grain_train_files)
+  if len(frames) != len(data_source):
+    raise ValueError(f"Duration index has {len(frames)} records, {config.grain_train_files} has {len(data_source)}.")
+
+  batches = plan_f5_batches(
+      frames,
+      {length: rows * dataloading_host_count for length, rows in rows_per_host.items()},
+      max_segments_per_row=config.f5_max_segments_per_row,
+      seed=config.seed,
+  )
+  max_logging.log(f"Planned {len(batches)} packed F5 batches from {len(frames)} records")
+  batch_source = PackedF5BatchSource(data_source, batches, dataloading_host_index, rows_per_host, config.n_mels)
+
+  # Every host walks the batches in the same order.
+  index_sampler = grain.IndexSampler(
+      num_records=len(batch_source),
+      num_epochs=None,
+      shard_options=grain.ShardOptions(shard_index=0, shard_count=1, drop_remainder=True),
+      shuffle=True,
+      seed=config.seed,
+  )
+
+  dataloader = grain.DataLoader(
+      data_source=batch_source,
+      operations=[],
+      sampler=index_sampler,
+      worker_count=config.grain_worker_count,
+  )
+
+  data_iter = multihost_dataloading.MultiHostDataLoadIterator(dataloader, mesh, config.data_prefetch_depth)
+  return data_iter
+
+
+def load_f5_frames_index(grain_train_files):
+  """Mel length of every record, from the `frames.npy` preprocess_f5.py writes next to the shards."""
+  index_path = os.path.join(os.path.dirname(grain_train_files), "frames.npy")
+  if not os.path.exists(index_path):
+    raise ValueError(f"{index_path} not found, F5 shards must be written by preprocess_f5.py.")
+  return np.load(index_path)
+
+
+def plan_f5_batches(frames, rows_per_batch, max_segments_per_row, seed):
+  """First-fit packs shuffled records into global batches of equal length rows.
+
+  Every record goes to the smallest length in `rows_per_batch` that holds it; records
+  longer than all of them are dropped. A length's batch is closed once a record no longer
+  fits any of its `rows_per_batch[length]` rows, so every batch has exactly that many
+  rows. The plan only depends on its arguments, which keeps hosts in agreement.
+
+  Returns a list of (length, rows) with rows a list of record index lists.
+  """
+  lengths = sorted(rows_per_batch)
+  rows = {length: [] for length in lengths}
+  # Free frames of each row, -1 for rows that are closed or not yet opened.
+  free = {length: np.full(rows_per_batch[length], -1, dtype=np.int64) for length in lengths}
+  batches = []
+  for index in np.random.default_rng(seed).permutation(len(frames)):
+    num_frames = int(frames[index])
+    bucket_idx = bisect.bisect_left(lengths, num_frames)
+    if bucket_idx == len(lengths):
+      continue
+    length = lengths[bucket_idx]
+    fits = np.flatnonzero(free[length] >= num_frames)
+    if len(fits):
+      row = fits[0]
+      rows[length][row].append(int(index))
+      free[length][row] -= num_frames
+    else:
+      if len(rows[length]) == rows_per_batch[length]:
+        batches.append((length, rows[length]))
+        rows[length] = []
+        free[length][:] = -1
+      row = len(rows[length])
+      rows[length].append([int(index)])
+      free[length][row] = length - num_frames
+    if len(rows[length][row]) == max_segments_per_row:
+      free[length][row] = -1
+  return batches
+
+
+def serialize_f5_example(mel, text_ids):
+  """Serializes a (frames, n_mels) float32 log-mel and its int32 vocab ids (+1 shifted, 0 is filler)."""
+  buffer = io.BytesIO()
+  np.savez(buffer, mel=mel.astype(np.float32), text_ids=text_ids.astype(np.int32))
+  return buffer.getvalue()
+
+
+@dataclasses.dataclass
+class ParseF5Features(grain.MapTransform):
+  """Parse an example written by `serialize_f5_example`, numpy only."""
+
+  def map(self, example):
+    with np.load(io.BytesIO(example)) as features:
+      return {"mel": features["mel"], "text_ids": features["text_ids"]}
+
+
+class PackedF5BatchSource:
+  """Random access over one host's rows of the planned global batches.
+
+  Utterances are numbered 1..n within a row in `decoder_segment_ids` (0 is padding) and
+  `decoder_positions` restarts at 0 for each of them. Attention is restricted to the
+  segment, and the trainers pass `mask_conv_segments=True` so the convolutional
+  position embeddings do not see neighbouring utterances either.
+  """
+
+  def __init__(self, data_source, batches, host_index, rows_per_host, n_mels):
+    self._data_source = data_source
+    self._batches = batches
+    self._host_index = host_index
+    self._rows_per_host = rows_per_host
+    self._n_mels = n_mels
+    self._parse = ParseF5Features()
+
+  def __len__(self):
+    return len(self._batches)
+
+  def __getitem__(self, batch_index):
+    length, rows = self._batches[batch_index]
+    num_rows = self._rows_per_host[length]
+    host_rows = rows[self._host_index * num_rows : (self._host_index + 1) * num_rows]
+    batch = {
+        "mel": np.zeros((num_rows, length, self._n_mels), dtype=np.float32),
+        "text_ids": np.zeros((num_rows, length), dtype=np.int32),
+        "decoder_segment_ids": np.zeros((num_rows, length), dtype=np.int32),
+        "decoder_positions": np.zeros((num_rows, length), dtype=np.int32),
+    }
+    for i, row in enumerate(host_rows):
+      start = 0
+      for segment_id, record_index in enumerate(row, start=1):
+        example = self._parse.map(self._data_source[record_index])
+        num_frames = example["mel"].shape[0]
+        end = start + num_frames
+        # F5 aligns the text with the first frames of its utterance and cuts it at the mel length.
+        text_ids = example["text_ids"][:num_frames]
+        batch["mel"][i, start:end] = example["mel"]
+        batch["text_ids"][i, start : start + len(text_ids)] = text_ids
+        batch["decoder_segment_ids"][i, start:end] = segment_id
+        batch["decoder_positions"][i, start:end] = np.arange(num_frames)
+        start = end
+    return batch
@@ -87,7 +87,7 @@ def make_hf_streaming_iterator(
       worker_buffer_size=1,
       read_options=grain.ReadOptions(num_threads=1, prefetch_buffer_size=hf_batch_factor * config.total_train_batch_size),
   )
-  train_iter = multihost_dataloading.MultiHostDataLoadIterator(dataloader, mesh)
+  train_iter = multihost_dataloading.MultiHostDataLoadIterator(dataloader, mesh, config.data_prefetch_depth)
   return train_iter
 
 
@@ -70,7 +70,7 @@ def make_tf_iterator(
   train_ds = load_as_tf_dataset(train_ds, global_batch_size, True, dataloading_host_count)
   train_ds = train_ds.shard(num_shards=dataloading_host_count, index=dataloading_host_index)
 
-  train_iter = multihost_dataloading.MultiHostDataLoadIterator(train_ds, mesh)
+  train_iter = multihost_dataloading.MultiHostDataLoadIterator(train_ds, mesh, config.data_prefetch_depth)
   return train_iter
 
 
@@ -111,5 +111,5 @@ def make_tfrecord_iterator(
       .prefetch(AUTOTUNE)
   )
 
-  train_iter = multihost_dataloading.MultiHostDataLoadIterator(train_ds, mesh)
+  train_iter = multihost_dataloading.MultiHostDataLoadIterator(train_ds, mesh, config.data_prefetch_depth)
   return train_iter
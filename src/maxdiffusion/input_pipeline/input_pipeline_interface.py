@@ -92,6 +92,24 @@ def make_data_iterator(
     assert False, f"Unknown dataset_type {config.dataset_type}, dataset_type must be in (tf, tfrecord, hf, grain)"
 
 
+def make_f5_data_iterator(
+    config,
+    dataloading_host_index,
+    dataloading_host_count,
+    mesh,
+):
+  """Make the packed mel/text data iterator for F5 training, dataset_type must be grain"""
+  if config.dataset_type == "grain":
+    return _grain_data_processing.make_f5_grain_iterator(
+        config,
+        dataloading_host_index,
+        dataloading_host_count,
+        mesh,
+    )
+  else:
+    assert False, f"Unknown dataset_type {config.dataset_type}, F5 training requires dataset_type grain"
+
+
 def make_dreambooth_train_iterator(config, mesh, global_batch_size, tokenizer, vae, vae_params):
   """Creates a dreambooth training iterator for sd1.x,sd2.x"""
 
@@ -198,5 +216,5 @@ def make_dreambooth_train_iterator(config, mesh, global_batch_size, tokenizer, v
   train_ds = tf.data.Dataset.zip((instance_train_ds, class_train_ds))
   train_ds = train_ds.shard(num_shards=jax.process_count(), index=jax.process_index())
 
-  train_iter = multihost_dataloading.MultiHostDataLoadIterator(train_ds, mesh)
+  train_iter = multihost_dataloading.MultiHostDataLoadIterator(train_ds, mesh, config.data_prefetch_depth)
   return train_iter
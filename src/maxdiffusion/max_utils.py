@@ -35,6 +35,7 @@ import optax
 from maxdiffusion import max_logging
 from maxdiffusion.checkpointing import checkpointing_utils
 from maxdiffusion.models.attention_flax import AttentionOp
+from maxdiffusion.models.quantizations import QuantDense
 from flax import linen as nn
 import flax.linen as nn
 import flax.linen.module as module_lib
@@ -69,6 +70,8 @@ class InferenceState(struct.PyTreeNode):
   # pylint: disable=g-bare-generic
   apply_fn: Callable = struct.field(pytree_node=False)
   params: FrozenDict[str, Any] | None = struct.field(pytree_node=True)
+  # Frozen AQT weights for quantized serving, see quantize_f5.py.
+  aqt: FrozenDict[str, Any] | None = struct.field(pytree_node=True, default=None)
 
 
 def l2norm_pytree(x):
@@ -265,16 +268,9 @@ def create_device_mesh(config, devices=None, logging=True):
 
   multi_slice_env = num_slices > 1
 
-  dcn_parallelism = [
-      config.dcn_data_parallelism,
-      config.dcn_fsdp_parallelism,
-      config.dcn_tensor_parallelism,
-  ]
-  ici_parallelism = [
-      config.ici_data_parallelism,
-      config.ici_fsdp_parallelism,
-      config.ici_tensor_parallelism,
-  ]
+  # One dcn_/ici_{axis}_parallelism entry per mesh axis, e.g. ['data', 'fsdp', 'context', 'tensor'].
+  dcn_parallelism = [getattr(config, f"dcn_{axis}_parallelism") for axis in config.mesh_axes]
+  ici_parallelism = [getattr(config, f"ici_{axis}_parallelism") for axis in config.mesh_axes]
 
   # Find possible unspecified parallelisms
   ici_parallelism = fill_unspecified_mesh_axes(ici_parallelism, num_devices_per_slice, "ICI")
@@ -333,7 +329,21 @@ def init_train_state(model, tx, weights_init_fn, params=None, training=True, eva
   return state
 
 
-def get_abstract_state(model, tx, config, mesh, weights_init_fn, training=True):
+def with_memory_kind(shardings, kind):
+  """Returns `shardings` placed in memory `kind`, e.g. "pinned_host" or "device"."""
+  return jax.tree_util.tree_map(lambda s: s.with_memory_kind(kind), shardings)
+
+
+def opt_state_to_device(state, state_shardings):
+  """Copies an optimizer state kept in pinned host memory to the devices, inside a jitted step.
+
+  The step's out_shardings move the updated optimizer state back to host memory.
+  """
+  device_shardings = with_memory_kind(state_shardings.opt_state, "device")
+  return state.replace(opt_state=jax.device_put(state.opt_state, device_shardings))
+
+
+def get_abstract_state(model, tx, config, mesh, weights_init_fn, training=True, offload_opt_state=False):
   """Get a shaped abstraction of the state (including optimizer)"""
   init_state_partial = functools.partial(
       init_train_state,
@@ -349,6 +359,10 @@ def get_abstract_state(model, tx, config, mesh, weights_init_fn, training=True):
   state_logical_annotations = nn.get_partition_spec(abstract_state)
 
   state_mesh_shardings = nn.logical_to_mesh_sharding(state_logical_annotations, mesh, config.logical_axis_rules)
+  if training and offload_opt_state:
+    state_mesh_shardings = state_mesh_shardings.replace(
+        opt_state=with_memory_kind(state_mesh_shardings.opt_state, "pinned_host")
+    )
 
   abstract_sharded_state = jax.jit(init_state_partial, in_shardings=None, out_shardings=state_mesh_shardings).eval_shape()
   unboxed_sharded_abstract_state = unbox_logicallypartioned_trainstate(abstract_sharded_state)
@@ -369,6 +383,7 @@ def setup_initial_state(
     checkpoint_manager=None,
     checkpoint_item=None,
     training=True,
+    offload_opt_state=False,
 ):
   """We initialize the model and optimizer state, and optionally load from a
   checkpoint as necessary.
@@ -383,6 +398,7 @@ def setup_initial_state(
     state_mesh_annotations: state mesh annotations from get_abstract_state()
     checkpoint_manager: an Orbax checkpointing.CheckpointManager object
     training: boolean True when initial state is used in training
+    offload_opt_state: place the optimizer state in pinned host memory
 
   Returns:
     state: the initialized train state
@@ -390,7 +406,9 @@ def setup_initial_state(
   """
   # Initialization
   state = None
-  unboxed_abstract_state, _, state_mesh_shardings = get_abstract_state(model, tx, config, mesh, weights_init_fn, training)
+  unboxed_abstract_state, _, state_mesh_shardings = get_abstract_state(
+      model, tx, config, mesh, weights_init_fn, training, offload_opt_state
+  )
   with nn_partitioning.axis_rules(config.logical_axis_rules):
     if checkpoint_manager and checkpoint_item:
       max_logging.log(f"setup_initial_state for {checkpoint_item}")
@@ -533,7 +551,7 @@ def calculate_model_tflops(module: module_lib.Module, rngs: Union[PRNGKey, RNGSe
       # Then 2 * 16 * 10 * 20.
       # In case of attention, an example if input shape batch,seq,hidden = (16, 4096, 320) and features = 320
       # Then 2 * 16 * 4096 * 320^2.
-      if isinstance(c.module, nn.Dense):
+      if isinstance(c.module, (nn.Dense, QuantDense)):
         total_flops += 2 * (reduce(lambda x, y: x * y, inputs.shape) * c.module.features)
       # Here we capture qk einsum, scaling, softmax and attention_values * v
       # qk einsum : 2 * batch_size * seq_length_1 * seq_length_2 * heads * head_dim where (heads * head_dim) == hidden_dim
@@ -110,6 +110,8 @@ class AttentionOp(nn.Module):
       return self.apply_attention_dot(query, key, value,decoder_segment_ids)
     elif self.attention_kernel == "flash":
       return self.tpu_flash_attention(query, key * self.scale, value,decoder_segment_ids)
+    elif self.attention_kernel == "flash_context_parallel":
+      return self.tpu_context_parallel_flash_attention(query, key * self.scale, value, decoder_segment_ids)
     elif self.attention_kernel == "cudnn_flash_te":
       return self.cudnn_flash_attention(query, key, value)
     else:
@@ -167,12 +169,83 @@ class AttentionOp(nn.Module):
           "Warning, batch dimension should be shardable among the devices in data and fsdp"
           f" axis, batch dimension: {query.shape[0]}, devices_in_data_fsdp: {devices_in_data_fsdp}"
       )
+    if axis_names[2] is not None and self.mesh.shape.get("context", 1) > 1:
+      raise ValueError(
+          "The flash attention kernel cannot shard the sequence, use attention=flash_context_parallel"
+          " when ici_context_parallelism > 1."
+      )
     x = wrap_flash_attention(query, key, value,decoder_segment_ids)
     x = x[:, :, :, :kv_size]
     x = self.reshape_heads_to_head_dim(x)
 
     return x
 
+  def tpu_context_parallel_flash_attention(
+      self, query: jax.Array, key: jax.Array, value: jax.Array, decoder_segment_ids=None
+  ) -> jax.Array:
+    """TPU Flash Attention with the sequence sharded over the mesh axis of `activation_length`.
+
+    Every device keeps its query shard and all-gathers K/V (and their segment ids) along the
+    sequence axis, then runs splash attention on (local q, global kv). K/V memory per device is
+    linear in the sequence length and the scores are computed blockwise, so long sequences do
+    not need quadratic per-chip memory.
+    """
+
+    query, kv_size = self.reshape_data_for_flash(query)
+    key, _ = self.reshape_data_for_flash(key)
+    value, _ = self.reshape_data_for_flash(value)
+    axis_names = nn.logical_to_mesh_axes(self.flash_axis_names)
+    segment_axis_names = nn.logical_to_mesh_axes((BATCH, "activation_length_no_heads"))
+    sequence_axis = axis_names[2]
+    if decoder_segment_ids is None:
+      decoder_segment_ids = jnp.ones(query.shape[:1] + query.shape[2:3], dtype=jnp.int32)
+
+    @functools.partial(
+        shard_map.shard_map,
+        mesh=self.mesh,
+        in_specs=(
+            axis_names,
+            axis_names,
+            axis_names,
+            segment_axis_names,
+        ),
+        out_specs=axis_names,
+        check_rep=False,
+    )
+    def wrap_flash_attention(query, key, value, decoder_segment_ids):
+      kv_segment_ids = decoder_segment_ids
+      if sequence_axis is not None:
+        key = jax.lax.all_gather(key, sequence_axis, axis=2, tiled=True)
+        value = jax.lax.all_gather(value, sequence_axis, axis=2, tiled=True)
+        kv_segment_ids = jax.lax.all_gather(decoder_segment_ids, sequence_axis, axis=1, tiled=True)
+      q_len, kv_len = query.shape[2], key.shape[2]
+      if self.flash_block_sizes:
+        block_sizes = self.flash_block_sizes
+      else:
+        block_sizes = splash_attention_kernel.BlockSizes(
+            block_q=min(512, q_len),
+            block_kv_compute=min(512, kv_len),
+            block_kv=min(512, kv_len),
+            block_q_dkv=min(512, q_len),
+            block_kv_dkv=min(512, kv_len),
+            block_kv_dkv_compute=min(512, kv_len),
+            block_q_dq=min(512, q_len),
+            block_kv_dq=min(512, kv_len),
+        )
+      masks = [splash_attention_mask.FullMask(_shape=(q_len, kv_len)) for _ in range(query.shape[1])]
+      multi_head_mask = splash_attention_mask.MultiHeadMask(masks=masks)
+      splash_kernel = splash_attention_kernel.make_splash_mha(
+          mask=multi_head_mask, head_shards=1, q_seq_shards=1, block_sizes=block_sizes
+      )
+      segment_ids = splash_attention_kernel.SegmentIds(decoder_segment_ids, kv_segment_ids)
+      return jax.vmap(splash_kernel)(query, key, value, segment_ids=segment_ids)
+
+    x = wrap_flash_attention(query, key, value, decoder_segment_ids)
+    x = x[:, :, :, :kv_size]
+    x = self.reshape_heads_to_head_dim(x)
+
+    return x
+
   def cudnn_flash_attention(
       self,
       query: Array,
@@ -1097,11 +1170,8 @@ class FlaxF5Attention(nn.Module):
     )
 
     qkv_init_kernel = nn.with_logical_partitioning(nn.initializers.lecun_normal(), ("embed", "heads"))
-    dot_general_cls = None
-    if self.quant:
-      dot_general_cls = self.quant.dot_general_cls()
 
-    self.query = nn.Dense(
+    self.query = quantizations.QuantDense(
         inner_dim,
         kernel_init=qkv_init_kernel,
         use_bias=self.qkv_bias,
@@ -1109,10 +1179,10 @@ class FlaxF5Attention(nn.Module):
         param_dtype=self.weights_dtype,
         name="to_q",
         precision=self.precision,
-        dot_general_cls=dot_general_cls,
+        quant=self.quant,
     )
 
-    self.key = nn.Dense(
+    self.key = quantizations.QuantDense(
         inner_dim,
         kernel_init=qkv_init_kernel,
         use_bias=self.qkv_bias,
@@ -1120,10 +1190,10 @@ class FlaxF5Attention(nn.Module):
         param_dtype=self.weights_dtype,
         name="to_k",
         precision=self.precision,
-        dot_general_cls=dot_general_cls,
+        quant=self.quant,
     )
 
-    self.value = nn.Dense(
+    self.value = quantizations.QuantDense(
         inner_dim,
         kernel_init=qkv_init_kernel,
         use_bias=self.qkv_bias,
@@ -1131,16 +1201,17 @@ class FlaxF5Attention(nn.Module):
         param_dtype=self.weights_dtype,
         name="to_v",
         precision=self.precision,
-        dot_general_cls=dot_general_cls,
+        quant=self.quant,
     )
 
-    self.proj_attn = nn.Dense(
+    self.proj_attn = quantizations.QuantDense(
         self.query_dim,
         kernel_init=nn.with_logical_partitioning(nn.initializers.lecun_normal(), ("heads", "embed")),
         dtype=self.dtype,
         param_dtype=self.weights_dtype,
         name="to_out_0",
         precision=self.precision,
+        quant=self.quant,
     )
     self.dropout_layer = nn.Dropout(rate=self.dropout)
   def rotate_half(self,x):
@@ -1149,24 +1220,34 @@ class FlaxF5Attention(nn.Module):
     x = jnp.concatenate((-x2, x1), axis = -1)
     return rearrange(x, '... d r -> ... (d r)')
 
-  def apply_rotary_pos_emb(self, t, freqs, scale = 1,decoder_segment_ids=None):
-      rot_dim, seq_len, orig_dtype = freqs.shape[-1], t.shape[-2], t.dtype
+  def apply_rotary_pos_emb(self, t, cos, sin, scale = None):
+      """Rotates `t` with precomputed (already segment-masked) rotary tables.
+
+      `scale` is the xpos scale table, or None when the rotary embedding doesn't use xpos.
+      """
+      rot_dim, seq_len, orig_dtype = cos.shape[-1], t.shape[-2], t.dtype
 
-      freqs = freqs[:, -seq_len:, :]
-      if decoder_segment_ids is not None:
-        freqs = freqs * decoder_segment_ids[...,jnp.newaxis]
-      scale = scale[:, -seq_len:, :] if isinstance(scale, jnp.ndarray) else scale
+      cos = cos[:, -seq_len:, :]
+      sin = sin[:, -seq_len:, :]
 
-      if t.ndim == 4 and freqs.ndim == 3:
-          freqs = rearrange(freqs, 'b n d -> b 1 n d')
+      if t.ndim == 4 and cos.ndim == 3:
+          cos = rearrange(cos, 'b n d -> b 1 n d')
+          sin = rearrange(sin, 'b n d -> b 1 n d')
+
+      if scale is not None:
+          scale = scale[:, -seq_len:, :]
+          if t.ndim == 4 and scale.ndim == 3:
+              scale = rearrange(scale, 'b n d -> b 1 n d')
+          cos = cos * scale
+          sin = sin * scale
 
       # partial rotary embeddings, Wang et al. GPT-J
       t, t_unrotated = t[..., :rot_dim], t[..., rot_dim:]
-      t = (t * jnp.cos(freqs) * scale) + (self.rotate_half(t) * jnp.sin(freqs) * scale)
+      t = (t * cos) + (self.rotate_half(t) * sin)
       out = jnp.concatenate((t, t_unrotated), axis = -1)
 
       return out.astype(orig_dtype)
-  
+
   def __call__(self, hidden_states, context=None,rope=None,decoder_segment_ids=None,deterministic=True):
     context = hidden_states if context is None else context
     query_proj = self.query(hidden_states)
@@ -1174,13 +1255,16 @@ class FlaxF5Attention(nn.Module):
     value_proj = self.value(context)
 
     if rope is not None:
-      freqs, xpos_scale = rope
-      q_xpos_scale, k_xpos_scale = (xpos_scale, xpos_scale**-1.0) if xpos_scale is not None else (1.0, 1.0)
+      cos, sin, xpos_scale = rope
+      q_xpos_scale, k_xpos_scale = (xpos_scale, xpos_scale**-1.0) if xpos_scale is not None else (None, None)
       query_proj = jnp.reshape(query_proj,(query_proj.shape[0], -1, self.heads, self.dim_head)).transpose(0,2,1,3)
       key_proj = jnp.reshape(key_proj,(key_proj.shape[0], -1, self.heads, self.dim_head)).transpose(0,2,1,3)
       value_proj = jnp.reshape(value_proj,(value_proj.shape[0], -1, self.heads, self.dim_head)).transpose(0,2,1,3)
-      query_proj = self.apply_rotary_pos_emb(query_proj, freqs, q_xpos_scale,decoder_segment_ids)
-      key_proj = self.apply_rotary_pos_emb(key_proj, freqs, k_xpos_scale,decoder_segment_ids)
+      query_proj = nn.with_logical_constraint(query_proj, (BATCH, HEAD, LENGTH, D_KV))
+      key_proj = nn.with_logical_constraint(key_proj, (BATCH, HEAD, LENGTH, D_KV))
+      value_proj = nn.with_logical_constraint(value_proj, (BATCH, HEAD, LENGTH, D_KV))
+      query_proj = self.apply_rotary_pos_emb(query_proj, cos, sin, q_xpos_scale)
+      key_proj = self.apply_rotary_pos_emb(key_proj, cos, sin, k_xpos_scale)
 
     hidden_states = self.attention_op.apply_attention(
       jnp.reshape(query_proj.transpose(0,2,1,3),(query_proj.shape[0], -1, self.heads * self.dim_head)),
@@ -1191,8 +1275,9 @@ class FlaxF5Attention(nn.Module):
     hidden_states = jnp.reshape(hidden_states,(hidden_states.shape[0], -1, self.heads * self.dim_head))
 
     hidden_states = self.proj_attn(hidden_states)
-    hidden_states = nn.with_logical_constraint(hidden_states, (BATCH, LENGTH, HEAD))
+    # to_out contracts over the (tensor sharded) heads, so its output is an embed-dim activation.
+    hidden_states = nn.with_logical_constraint(hidden_states, (BATCH, LENGTH, EMBED))
     hidden_states = self.dropout_layer(hidden_states, deterministic=deterministic)
     if decoder_segment_ids is not None:
-      hidden_states = hidden_states * decoder_segment_ids[...,jnp.newaxis]
+      hidden_states = hidden_states * (decoder_segment_ids > 0)[...,jnp.newaxis]
     return hidden_states
\ No newline at end of file
@@ -0,0 +1,98 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Reuse of deep transformer block outputs across diffusion steps.
+
+The blocks from `block_cache_start` on are covered by the cache. When they run, the cache
+keeps their residual (output minus input) and their input, the probe. A later call reuses
+the residual instead of running them while
+
+  - the residual has been reused fewer than `max_reuse` times in a row (the schedule), and
+  - the mean absolute change of the input since the probe, relative to the probe, stays
+    under `threshold` (0 disables this test).
+
+The cache lives in the sampling `fori_loop` carry and holds two activations of fixed shape,
+so its HBM use does not grow with the number of steps. The skipped blocks sit behind
+`nn.cond`, reuse costs no block compute. The decision is made for the whole batch.
+"""
+
+import jax
+import jax.numpy as jnp
+import flax.linen as nn
+
+# Reuse count of an empty cache, forces the first call to run the blocks.
+_EMPTY_CACHE_AGE = 2**30
+
+
+def init_block_cache(shape, dtype=jnp.bfloat16, max_reuse=1, threshold=0.0):
+  """An empty cache for block inputs of `shape`, (batch, length, hidden dim)."""
+  return {
+      "residual": jnp.zeros(shape, dtype=dtype),
+      "probe": jnp.zeros(shape, dtype=dtype),
+      "age": jnp.asarray(_EMPTY_CACHE_AGE, dtype=jnp.int32),
+      "max_reuse": jnp.asarray(max_reuse, dtype=jnp.int32),
+      "threshold": jnp.asarray(threshold if threshold > 0 else jnp.inf, dtype=jnp.float32),
+      "hits": jnp.zeros((), dtype=jnp.int32),
+      "calls": jnp.zeros((), dtype=jnp.int32),
+  }
+
+
+def block_cache_from_config(config, shape):
+  return init_block_cache(
+      shape,
+      dtype=config.block_cache_dtype,
+      max_reuse=config.block_cache_max_reuse,
+      threshold=config.block_cache_threshold,
+  )
+
+
+def block_cache_bytes(block_cache):
+  return sum(x.size * x.dtype.itemsize for x in jax.tree_util.tree_leaves(block_cache))
+
+
+def block_cache_hit_rate(*block_caches):
+  """Fraction of calls that reused the residual, over all given caches."""
+  hits = sum(block_cache["hits"] for block_cache in block_caches)
+  calls = sum(block_cache["calls"] for block_cache in block_caches)
+  return hits / jnp.maximum(calls, 1)
+
+
+def cached_blocks(mdl, run_blocks, x, block_cache):
+  """Returns (output of `run_blocks(mdl, x)` or its cached estimate, new cache).
+
+  `run_blocks` runs the covered blocks of the module `mdl` on the hidden states `x`.
+  """
+  probe = block_cache["probe"].astype(jnp.float32)
+  change = jnp.mean(jnp.abs(x.astype(jnp.float32) - probe)) / jnp.maximum(jnp.mean(jnp.abs(probe)), 1e-6)
+  reuse = (block_cache["age"] < block_cache["max_reuse"]) & (change < block_cache["threshold"])
+
+  def reuse_fn(mdl, x, residual):
+    return x + residual.astype(x.dtype), residual
+
+  def compute_fn(mdl, x, residual):
+    out = run_blocks(mdl, x)
+    return out, (out - x).astype(residual.dtype)
+
+  out, residual = nn.cond(reuse, reuse_fn, compute_fn, mdl, x, block_cache["residual"])
+  block_cache = {
+      **block_cache,
+      "residual": residual,
+      "probe": jnp.where(reuse, block_cache["probe"], x.astype(block_cache["probe"].dtype)),
+      "age": jnp.where(reuse, block_cache["age"] + 1, 0),
+      "hits": block_cache["hits"] + reuse.astype(jnp.int32),
+      "calls": block_cache["calls"] + 1,
+  }
+  return out, block_cache
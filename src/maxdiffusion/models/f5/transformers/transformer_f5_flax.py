@@ -15,6 +15,7 @@
  """
 
 from typing import Optional, Tuple
+import functools
 import jax
 import math
 import jax.numpy as jnp
@@ -23,6 +24,8 @@ import flax.linen as nn
 from einops import repeat, rearrange
 from ...normalization_flax import AdaLayerNormContinuous, AdaLayerNormZero
 from ...attention_flax import FlaxF5Attention
+from ... import quantizations
+from ...block_cache import cached_blocks
 from .... import common_types
 from ....common_types import BlockSizes
 from ....utils import BaseOutput
@@ -32,6 +35,9 @@ BATCH = common_types.BATCH
 LENGTH = common_types.LENGTH
 HEAD = common_types.HEAD
 D_KV = common_types.D_KV
+EMBED = common_types.EMBED
+MLP = common_types.MLP
+Quant = quantizations.AqtQuantization
 
 class F5TransformerBlock(nn.Module):
   r"""
@@ -61,6 +67,8 @@ class F5TransformerBlock(nn.Module):
   mlp_ratio: float = 4.0
   qkv_bias: bool = False
   attention_kernel: str = "dot_product"
+  scan_layers: bool = False
+  quant: Quant = None
 
   def setup(self):
 
@@ -77,6 +85,7 @@ class F5TransformerBlock(nn.Module):
         attention_kernel=self.attention_kernel,
         mesh=self.mesh,
         flash_block_sizes=self.flash_block_sizes,
+        quant=self.quant,
     )
 
     self.ff_norm = nn.LayerNorm(
@@ -88,7 +97,7 @@ class F5TransformerBlock(nn.Module):
     )
     self.ff = nn.Sequential(
         [
-            nn.Dense(
+            quantizations.QuantDense(
                 int(self.dim * self.mlp_ratio),
                 use_bias=True,
                 kernel_init=nn.with_logical_partitioning(nn.initializers.lecun_normal(), ("embed", "mlp")),
@@ -96,16 +105,18 @@ class F5TransformerBlock(nn.Module):
                 dtype=self.dtype,
                 param_dtype=self.weights_dtype,
                 precision=self.precision,
+                quant=self.quant,
             ),
-            nn.gelu,
-            nn.Dense(
+            lambda x: nn.with_logical_constraint(nn.gelu(x), (BATCH, LENGTH, MLP)),
+            quantizations.QuantDense(
                 self.dim,
                 use_bias=True,
-                kernel_init=nn.with_logical_partitioning(nn.initializers.lecun_normal(), ("embed", "mlp")),
-                bias_init=nn.with_logical_partitioning(nn.initializers.zeros, ("mlp",)),
+                kernel_init=nn.with_logical_partitioning(nn.initializers.lecun_normal(), ("mlp", "embed")),
+                bias_init=nn.with_logical_partitioning(nn.initializers.zeros, ("embed",)),
                 dtype=self.dtype,
                 param_dtype=self.weights_dtype,
                 precision=self.precision,
+                quant=self.quant,
             ),
         ]
     )
@@ -116,6 +127,7 @@ class F5TransformerBlock(nn.Module):
     self._chunk_dim = 0
 
   def __call__(self, x, temb, image_rotary_emb=None,decoder_segment_ids=None):
+    x = nn.with_logical_constraint(x, (BATCH, LENGTH, EMBED))
     norm_hidden_states, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.attn_norm(x, emb=temb)
 
     # Attention.
@@ -131,10 +143,54 @@ class F5TransformerBlock(nn.Module):
     ff_output = self.ff(norm)
     x = x + gate_mlp * ff_output
 
+    if self.scan_layers:
+      return x, None
     return x
 
 
 
+def segment_conv_general_dilated(
+    lhs,
+    rhs,
+    window_strides,
+    padding,
+    *,
+    segment_ids,
+    lhs_dilation,
+    rhs_dilation,
+    dimension_numbers,
+    feature_group_count,
+    precision,
+):
+    """`conv_general_dilated` for nn.Conv on packed rows: each output only reads inputs of its own segment.
+
+    Supports the stride 1, undilated 1D convolutions of the F5 embeddings. Runs one (grouped)
+    matmul per kernel tap, so pass it only for rows holding several segments.
+    """
+    del dimension_numbers  # nn.Conv's (batch, length, features) layout.
+    if tuple(window_strides) != (1,) or tuple(lhs_dilation) != (1,) or tuple(rhs_dilation) != (1,):
+        raise ValueError("segment_conv_general_dilated only supports stride 1, undilated 1D convolutions.")
+    kernel_size, group_in, features = rhs.shape
+    batch, length, _ = lhs.shape
+    pad = ((kernel_size - 1) // 2, kernel_size // 2) if padding == "SAME" else tuple(padding[0])
+    x = jnp.pad(lhs, ((0, 0), pad, (0, 0)))
+    segments = jnp.pad(segment_ids, ((0, 0), pad), constant_values=-1)
+    kernel = rhs.reshape(kernel_size, group_in, feature_group_count, features // feature_group_count)
+    out = 0.0
+    for k in range(kernel_size):
+        same_segment = (segments[:, k:k + length] == segment_ids)[..., jnp.newaxis]
+        tap = jnp.where(same_segment, x[:, k:k + length], 0).reshape(batch, length, feature_group_count, group_in)
+        out = out + jnp.einsum("bngi,igo->bngo", tap, kernel[k], precision=precision)
+    return out.reshape(batch, length, features).astype(lhs.dtype)
+
+
+def _segment_conv(segment_ids):
+    """nn.Conv's conv_general_dilated, restricted to segments when `segment_ids` are given."""
+    if segment_ids is None:
+        return None
+    return functools.partial(segment_conv_general_dilated, segment_ids=segment_ids)
+
+
 class ConvPositionEmbedding(nn.Module):
     dim: int
     kernel_size: int = 31
@@ -144,7 +200,8 @@ class ConvPositionEmbedding(nn.Module):
     precision: jax.lax.Precision = None
 
     @nn.compact
-    def __call__(self, x, mask=None):
+    def __call__(self, x, mask=None, segment_ids=None):
+        # segment_ids (packed rows) keep the convolutions from reading neighbouring segments.
         # 如果提供了 mask，则将 mask 扩展一个维度，并将对应位置置 0
         if mask is not None:
             mask_expanded = jnp.expand_dims(mask, axis=-1)  # (b, n, 1)
@@ -159,7 +216,8 @@ class ConvPositionEmbedding(nn.Module):
             feature_group_count=self.groups,
             dtype=self.dtype,
             param_dtype=self.weights_dtype,
-            precision=self.precision,)(x)
+            precision=self.precision,
+            conv_general_dilated=_segment_conv(segment_ids),)(x)
         x = jax.nn.mish(x)
         
         if mask is not None:
@@ -172,7 +230,8 @@ class ConvPositionEmbedding(nn.Module):
             feature_group_count=self.groups,
             dtype=self.dtype,
             param_dtype=self.weights_dtype,
-            precision=self.precision,)(x)
+            precision=self.precision,
+            conv_general_dilated=_segment_conv(segment_ids),)(x)
         x = jax.nn.mish(x)
         
         if mask is not None:
@@ -192,6 +251,7 @@ class InputEmbedding(nn.Module):
                  text_embed,
                  decoder_segment_ids=None,
                   #drop_audio_cond=False
+                 segment_ids=None,
                   ):
         # 如果 drop_audio_cond 为 True，则将 cond 置为全 0
         # if drop_audio_cond:
@@ -210,7 +270,7 @@ class InputEmbedding(nn.Module):
         x_out = x_proj + ConvPositionEmbedding(dim=self.out_dim,          
                                                dtype=self.dtype,
             weights_dtype=self.weights_dtype,
-            precision=self.precision,)(x_proj,mask=decoder_segment_ids)
+            precision=self.precision,)(x_proj,mask=decoder_segment_ids,segment_ids=segment_ids)
         if decoder_segment_ids is not None:
             x_out = x_out * decoder_segment_ids[...,jnp.newaxis]
         return x_out
@@ -219,12 +279,19 @@ class GRN(nn.Module):
     dim: int
 
     @nn.compact
-    def __call__(self, x):
+    def __call__(self, x, segment_ids=None):
         # Initialize parameters gamma and beta with shape (1, 1, dim)
         gamma = self.param("gamma", lambda rng, shape: jnp.zeros(shape), (1, 1, self.dim))
         beta = self.param("beta", lambda rng, shape: jnp.zeros(shape), (1, 1, self.dim))
         # Compute L2 norm over the sequence dimension (axis=1) with keepdims
-        Gx = jnp.linalg.norm(x, ord=2, axis=1, keepdims=True)
+        if segment_ids is None:
+            Gx = jnp.linalg.norm(x, ord=2, axis=1, keepdims=True)
+        else:
+            # Packed rows: the norm of each position's own segment.
+            segment_sq = jax.vmap(
+                lambda sq, ids: jax.ops.segment_sum(sq, ids, num_segments=sq.shape[0])
+            )(jnp.square(x), segment_ids)
+            Gx = jnp.sqrt(jnp.take_along_axis(segment_sq, segment_ids[..., jnp.newaxis], axis=1))
         # Normalize: divide by mean across the feature dimension (axis=-1)
         Nx = Gx / (jnp.mean(Gx, axis=-1, keepdims=True) + 1e-6)
         return gamma * (x * Nx) + beta + x
@@ -238,7 +305,7 @@ class ConvNeXtV2Block(nn.Module):
     precision: jax.lax.Precision = None
 
     @nn.compact
-    def __call__(self, x):
+    def __call__(self, x, segment_ids=None):
         residual = x
         # Calculate symmetric padding so that output length matches input length.
         # For a kernel size of 7 and dilation d, padding = d*3.
@@ -254,6 +321,7 @@ class ConvNeXtV2Block(nn.Module):
             dtype=self.dtype,
             param_dtype=self.weights_dtype,
             precision=self.precision,
+            conv_general_dilated=_segment_conv(segment_ids),
         )(x)
         # Layer normalization (applied over the last dimension)
         x = nn.LayerNorm(epsilon=1e-6,
@@ -266,7 +334,7 @@ class ConvNeXtV2Block(nn.Module):
             precision=self.precision,)(x)
         x = nn.gelu(x,approximate=False)
         # Apply GRN module on the intermediate features
-        x = GRN(dim=self.intermediate_dim)(x)
+        x = GRN(dim=self.intermediate_dim)(x, segment_ids=segment_ids)
         # Second pointwise (dense) layer
         x = nn.Dense(features=self.dim,
                     dtype=self.dtype,
@@ -320,13 +388,13 @@ class F5TextEmbedding(nn.Module):
     dtype: jnp.dtype = jnp.float32
     weights_dtype: jnp.dtype = jnp.float32
     precision: jax.lax.Precision = None
+    # ~44s of 24khz audio. Longer (e.g. sequence sharded) inputs extend the table to their length.
+    precompute_max_pos: int = 4096
     def setup(self):
         self.text_embed = nn.Embed(self.text_num_embeds + 1, self.text_dim, dtype=self.dtype)  # use 0 as filler token
         
         if self.conv_layers > 0:
             self.extra_modeling = True
-            self.precompute_max_pos = 4096  # ~44s of 24khz audio
-            self.freqs_cis = precompute_freqs_cis(self.text_dim, self.precompute_max_pos)
             self.text_blocks = [ConvNeXtV2Block(
             self.text_dim, self.text_dim * self.conv_mult,
             dtype=self.dtype,
@@ -339,7 +407,9 @@ class F5TextEmbedding(nn.Module):
     def __call__(self, 
                  text, 
                  #seq_len,
-                 text_decoder_segment_ids):#, drop_text=False):  # noqa: F722
+                 text_decoder_segment_ids,#, drop_text=False):  # noqa: F722
+                 text_positions=None,  # per-utterance positions of packed rows
+                 segment_ids=None):  # segment ids of packed rows, keeps the conv blocks within each segment
         
         batch, text_len = text.shape[0], text.shape[1]
 
@@ -352,26 +422,27 @@ class F5TextEmbedding(nn.Module):
         if self.extra_modeling:
             # sinus pos emb
             batch_start = jnp.zeros((batch,))
-            pos_idx = get_pos_embed_indices(batch_start, 
-                                            #seq_len, 
-                                            max_pos=self.precompute_max_pos)
-            text_pos_embed = self.freqs_cis[pos_idx]
+            max_pos = max(self.precompute_max_pos, text_len)
+            freqs_cis = precompute_freqs_cis(self.text_dim, max_pos)
+            if text_positions is None:
+                pos_idx = get_pos_embed_indices(batch_start, 
+                                                #seq_len, 
+                                                max_pos=max_pos)[:, :text_len]
+            else:
+                pos_idx = jnp.clip(text_positions, 0, max_pos - 1)
+            text_pos_embed = freqs_cis[pos_idx]
             text = text + text_pos_embed
 
             # convnextv2 blocks
             text = text * text_decoder_segment_ids[...,jnp.newaxis]
             for block in self.text_blocks:
-                text = block(text)
+                text = block(text, segment_ids=segment_ids)
                 text = text * text_decoder_segment_ids[...,jnp.newaxis]
 
         return text
     def init_weights(self, rngs, max_sequence_length, eval_only=True):
         num_devices = len(jax.devices())
         batch_size = 1 * num_devices
-        decoder_segment_ids_shape = (
-            batch_size,
-            max_sequence_length
-        )
         # bs, encoder_input, seq_length
         txt_ids_shape = (
             batch_size,
@@ -383,23 +454,18 @@ class F5TextEmbedding(nn.Module):
             max_sequence_length,
         )
         text_ids = jnp.zeros(txt_ids_shape, dtype=jnp.int32)
-        decoder_segment_ids = jnp.zeros(decoder_segment_ids_shape, dtype=jnp.int32)
         text_decoder_segment_ids = jnp.zeros(text_decoder_segment_ids_shape,dtype=jnp.int32)
         if eval_only:
             return jax.eval_shape(
                 self.init,
                     rngs,
                     text=text_ids,
-                    seq_len=max_sequence_length,
-                    decoder_segment_ids=decoder_segment_ids,
                     text_decoder_segment_ids=text_decoder_segment_ids,
             )["params"]
         else:
             return self.init(
                 rngs,
                 text=text_ids,
-                seq_len=max_sequence_length,
-                decoder_segment_ids=decoder_segment_ids,
                 text_decoder_segment_ids=text_decoder_segment_ids,
             )["params"]
 def exists(val):
@@ -500,7 +566,7 @@ class RotaryEmbedding(nn.Module):
         freqs_complex = rearrange(freqs_complex, '... d r -> ... (d r)')
 
         if not exists(self.scale):
-            return freqs_complex, 1.
+            return freqs_complex, None
 
         power = (t - (max_pos // 2)) / self.scale_base
         scale_val = self.scale ** rearrange(power, '... n -> ... n 1')
@@ -509,6 +575,15 @@ class RotaryEmbedding(nn.Module):
 
         return freqs_complex, scale_complex
     
+def _get_remat_policy(remat_policy: str):
+  """Maps the `remat_policy` config string to a jax checkpoint policy."""
+  if remat_policy == "full":
+    return jax.checkpoint_policies.nothing_saveable
+  if remat_policy == "dots_saveable":
+    return jax.checkpoint_policies.checkpoint_dots
+  raise ValueError(f"Unknown remat_policy {remat_policy}, expected one of 'full', 'dots_saveable', 'none'.")
+
+
 class F5Transformer2DModel(nn.Module):
   flash_min_seq_length: int = 4096
   flash_block_sizes: BlockSizes = None
@@ -532,6 +607,20 @@ class F5Transformer2DModel(nn.Module):
   dim_head:int = 64
   depth:int = 22
   heads:int = 16
+  # Stacks the blocks under a single `blocks` param tree with a leading `depth` axis
+  # and runs them with nn.scan, so the HLO contains one block instead of `depth`.
+  scan_layers:bool = False
+  # 'none', 'full' or 'dots_saveable'.
+  remat_policy:str = "none"
+  # AQT quantization of the attention and FFN projections, see quantize_f5.py.
+  quant: Quant = None
+  # Adds an embedding of the classifier-free guidance scale to the timestep embedding, as
+  # Flux does, so a guidance distilled model (train_f5_distill.py) samples without the
+  # unconditional pass. The scale follows generate_f5: pred + (pred - null_pred) * scale.
+  guidance_embeds: bool = False
+  # First block of the range a `block_cache` covers, see models/block_cache.py. The earlier
+  # blocks always run, their output is the input the cache compares across steps.
+  block_cache_start: int = 1
 
   def setup(self):
     self.time_embed = TimestepEmbedding(
@@ -539,6 +628,13 @@ class F5Transformer2DModel(nn.Module):
             dtype=self.dtype,
             weights_dtype=self.weights_dtype,
             precision=self.precision,)
+    if self.guidance_embeds:
+      self.guidance_embed = TimestepEmbedding(
+          dim=self.dim,
+          dtype=self.dtype,
+          weights_dtype=self.weights_dtype,
+          precision=self.precision,
+      )
     self.input_embed = InputEmbedding(
         mel_dim=self.mel_dim,
         text_dim=self.text_dim,
@@ -549,24 +645,44 @@ class F5Transformer2DModel(nn.Module):
     #self.text_embed = TextEmbedding(self.text_num_embeds, self.text_dim, conv_layers=self.conv_layers)
     self.rotary_embed = RotaryEmbedding(self.dim_head)
 
-    blocks = []
-    for _ in range(self.depth):
-      block = F5TransformerBlock(
-          dim=self.dim,
-          num_attention_heads=self.heads,
-          attention_head_dim=self.dim_head,
-          attention_kernel=self.attention_kernel,
-          flash_min_seq_length=self.flash_min_seq_length,
-          flash_block_sizes=self.flash_block_sizes,
-          mesh=self.mesh,
-          dtype=self.dtype,
-          weights_dtype=self.weights_dtype,
-          precision=self.precision,
-          mlp_ratio=self.mlp_ratio,
-          qkv_bias=self.qkv_bias,
+    block_cls = F5TransformerBlock
+    if self.remat_policy != "none":
+      block_cls = nn.remat(
+          block_cls,
+          policy=_get_remat_policy(self.remat_policy),
+          prevent_cse=not self.scan_layers,
       )
-      blocks.append(block)
-    self.blocks = blocks
+    block_kwargs = {
+        "dim": self.dim,
+        "num_attention_heads": self.heads,
+        "attention_head_dim": self.dim_head,
+        "attention_kernel": self.attention_kernel,
+        "flash_min_seq_length": self.flash_min_seq_length,
+        "flash_block_sizes": self.flash_block_sizes,
+        "mesh": self.mesh,
+        "dtype": self.dtype,
+        "weights_dtype": self.weights_dtype,
+        "precision": self.precision,
+        "mlp_ratio": self.mlp_ratio,
+        "qkv_bias": self.qkv_bias,
+        "scan_layers": self.scan_layers,
+        "quant": self.quant,
+    }
+    if self.scan_layers:
+      self.blocks = nn.scan(
+          block_cls,
+          variable_axes={"params": 0, "aqt": 0},
+          split_rngs={"params": True, "aqt": True},
+          in_axes=(nn.broadcast, nn.broadcast, nn.broadcast),
+          length=self.depth,
+          metadata_params={nn.PARTITION_NAME: "layers"},
+      )(**block_kwargs, name="blocks")
+    else:
+      blocks = []
+      for _ in range(self.depth):
+        block = block_cls(**block_kwargs)
+        blocks.append(block)
+      self.blocks = blocks
 
     self.norm_out = AdaLayerNormContinuous(
         self.dim,
@@ -598,35 +714,74 @@ class F5Transformer2DModel(nn.Module):
       #drop_text:bool = False,
       #drop_audio_cond:bool = False,
       train: bool = False,
+      rotary_cos_sin = None, #precomputed by rotary_cos_sin(), reused across diffusion steps
+      guidance = None, #(batch,) guidance scales, required with guidance_embeds
+      block_cache = None, #from init_block_cache, returns (output, block_cache) when given
+      mask_conv_segments: bool = False, #keep the input embedding convs within each segment of packed rows
   ):
     batch, seq_len = x.shape[0], x.shape[1]
     
     t = self.time_embed(timestep)
+    if self.guidance_embeds:
+      t = t + self.guidance_embed(guidance)
     #if drop_text:  # cfg for text
     #    txt_ids = jnp.zeros_like(txt_ids)
     #text_embed = self.text_embed(txt_ids, seq_len,decoder_segment_ids=decoder_segment_ids,text_decoder_segment_ids=text_decoder_segment_ids, drop_text=self.drop_text)
     #text_embed = nn.with_logical_constraint(text_embed, ("activation_batch", None))
+    # Packed batches carry one id per utterance, padding is 0.
+    padding_mask = (decoder_segment_ids > 0).astype(x.dtype)
     x = self.input_embed(x,
                          cond,
                          text_embed,
-                         decoder_segment_ids=decoder_segment_ids,
+                         decoder_segment_ids=padding_mask,
                          #drop_audio_cond=drop_audio_cond
-                         ) * decoder_segment_ids[...,jnp.newaxis]
-    image_rotary_emb = self.rotary_embed.forward_from_seq_len(seq_len)
+                         segment_ids=decoder_segment_ids if mask_conv_segments else None,
+                         ) * padding_mask[...,jnp.newaxis]
+    if rotary_cos_sin is None:
+      rotary_cos_sin = self.rotary_cos_sin(seq_len, decoder_segment_ids)
+    image_rotary_emb = rotary_cos_sin
     #image_rotary_emb = nn.with_logical_constraint(image_rotary_emb, ("activation_batch", "activation_embed"))
 
-    for block in self.blocks:
-      x = block(
-          x=x,
-          temb=t,
-          image_rotary_emb=image_rotary_emb,
-          decoder_segment_ids=decoder_segment_ids,
+    def run_blocks(x, blocks):
+      for block in blocks:
+        x = block(
+            x,
+            t,
+            image_rotary_emb,
+            decoder_segment_ids,
+        )
+      return x
+
+    if self.scan_layers:
+      if block_cache is not None:
+        raise ValueError("block_cache requires scan_layers=False.")
+      x, _ = self.blocks(x, t, image_rotary_emb, decoder_segment_ids)
+    elif block_cache is not None:
+      x = run_blocks(x, self.blocks[: self.block_cache_start])
+      x, block_cache = cached_blocks(
+          self, lambda mdl, x: run_blocks(x, mdl.blocks[self.block_cache_start :]), x, block_cache
       )
+    else:
+      x = run_blocks(x, self.blocks)
 
     x = self.norm_out(x, t)
     output = self.proj_out(x)
+    if block_cache is not None:
+      return output, block_cache
     return output
 
+  def rotary_cos_sin(self, seq_len, decoder_segment_ids=None):
+    """Segment-masked rotary cos/sin tables shared by every block.
+
+    The tables only depend on the sequence length and the padding mask, so callers running
+    several forward passes over the same sequence (e.g. the diffusion loop) should compute
+    them once with `method=F5Transformer2DModel.rotary_cos_sin` and pass them as `rotary_cos_sin`.
+    """
+    freqs, xpos_scale = self.rotary_embed.forward_from_seq_len(seq_len)
+    if decoder_segment_ids is not None:
+      freqs = freqs * (decoder_segment_ids > 0)[..., jnp.newaxis]
+    return jnp.cos(freqs), jnp.sin(freqs), xpos_scale
+
   def init_weights(self, rngs, max_sequence_length, eval_only=True):
     num_devices = len(jax.devices())
     batch_size = 1 * num_devices
@@ -650,6 +805,9 @@ class F5Transformer2DModel(nn.Module):
     text_embed = jnp.zeros(text_embed_shape, dtype=jnp.int32)
     decoder_segment_ids = jnp.zeros(decoder_segment_ids_shape, dtype=jnp.int32)
     t = jnp.asarray((0,))
+    guidance = jnp.zeros((batch_size,)) if self.guidance_embeds else None
+    if self.quant is not None:
+      rngs = {"params": rngs, "aqt": rngs}
     if eval_only:
       return jax.eval_shape(
           self.init,
@@ -659,6 +817,7 @@ class F5Transformer2DModel(nn.Module):
             text_embed=text_embed,
             timestep=t,
             decoder_segment_ids=decoder_segment_ids,
+            guidance=guidance,
       )["params"]
     else:
         return self.init(
@@ -668,4 +827,5 @@ class F5Transformer2DModel(nn.Module):
             text_embed=text_embed,
             timestep=t,
             decoder_segment_ids=decoder_segment_ids,
+            guidance=guidance,
         )["params"]
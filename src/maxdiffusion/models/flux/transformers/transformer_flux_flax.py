@@ -25,6 +25,7 @@ from ....configuration_utils import ConfigMixin, flax_register_to_config
 from ...modeling_flax_utils import FlaxModelMixin
 from ...normalization_flax import AdaLayerNormZeroSingle, AdaLayerNormContinuous, AdaLayerNormZero
 from ...attention_flax import FlaxFluxAttention
+from ...block_cache import cached_blocks
 from ...embeddings_flax import (FluxPosEmbed, CombinedTimestepGuidanceTextProjEmbeddings, CombinedTimestepTextProjEmbeddings)
 from .... import common_types
 from ....common_types import BlockSizes
@@ -323,6 +324,7 @@ class FluxTransformer2DModel(nn.Module, FlaxModelMixin, ConfigMixin):
       joint_attention_dim (`int`, *optional*): The number of `encoder_hidden_states` dimensions to use.
       pooled_projection_dim (`int`): Number of dimensions to use when projecting the `pooled_projections`.
       guidance_embeds (`bool`, defaults to False): Whether to use guidance embeddings.
+      block_cache_start (`int`, defaults to 1): First single DiT block of the range a `block_cache` covers.
 
   """
 
@@ -346,6 +348,7 @@ class FluxTransformer2DModel(nn.Module, FlaxModelMixin, ConfigMixin):
   qkv_bias: bool = True
   theta: int = 1000
   attention_kernel: str = "dot_product"
+  block_cache_start: int = 1
   eps = 1e-6
 
   def setup(self):
@@ -480,7 +483,9 @@ class FluxTransformer2DModel(nn.Module, FlaxModelMixin, ConfigMixin):
       guidance,
       return_dict: bool = True,
       train: bool = False,
+      block_cache=None,
   ):
+    """With a `block_cache` from init_block_cache, returns (output, block_cache), see models/block_cache.py."""
     hidden_states = self.img_in(hidden_states)
     timestep = self.timestep_embedding(timestep, 256)
     if self.guidance_embeds:
@@ -512,13 +517,31 @@ class FluxTransformer2DModel(nn.Module, FlaxModelMixin, ConfigMixin):
       )
     hidden_states = jnp.concatenate([encoder_hidden_states, hidden_states], axis=1)
     hidden_states = nn.with_logical_constraint(hidden_states, ("activation_batch", "activation_length", "activation_embed"))
-    for single_block in self.single_blocks:
-      hidden_states = single_block(hidden_states=hidden_states, temb=temb, image_rotary_emb=image_rotary_emb)
+
+    def run_single_blocks(mdl, hidden_states, single_blocks):
+      for single_block in single_blocks:
+        hidden_states = single_block(hidden_states=hidden_states, temb=temb, image_rotary_emb=image_rotary_emb)
+      return hidden_states
+
+    if block_cache is None:
+      hidden_states = run_single_blocks(self, hidden_states, self.single_blocks)
+    else:
+      hidden_states = run_single_blocks(self, hidden_states, self.single_blocks[: self.block_cache_start])
+      hidden_states, block_cache = cached_blocks(
+          self,
+          lambda mdl, hidden_states: run_single_blocks(mdl, hidden_states, mdl.single_blocks[self.block_cache_start :]),
+          hidden_states,
+          block_cache,
+      )
     hidden_states = hidden_states[:, encoder_hidden_states.shape[1] :, ...]
 
     hidden_states = self.norm_out(hidden_states, temb)
     output = self.proj_out(hidden_states)
 
+    if block_cache is not None:
+      output = Transformer2DModelOutput(sample=output) if return_dict else (output,)
+      return output, block_cache
+
     if not return_dict:
       return (output,)
 
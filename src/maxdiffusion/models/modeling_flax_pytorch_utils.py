@@ -17,6 +17,7 @@ import re
 
 import jax
 import jax.numpy as jnp
+import numpy as np
 from flax.linen import Partitioned
 from flax.traverse_util import flatten_dict, unflatten_dict
 from flax.core.frozen_dict import unfreeze
@@ -326,7 +327,7 @@ def convert_pytorch_state_dict_to_flax(pt_state_dict, flax_model, init_key=42):
 
   return unflatten_dict(flax_state_dict)
 
-def convert_f5_state_dict_to_flax(path,use_ema=True):
+def convert_f5_state_dict_to_flax(path,use_ema=True,scan_layers=False):
   import torch
   
   state_dict = torch.load(path,map_location=torch.device('cpu'))
@@ -396,5 +397,26 @@ def convert_f5_state_dict_to_flax(path,use_ema=True):
   params = unflatten_dict(params, sep=".")
   text_encoder_params = {k: v.cpu().numpy() for k, v in text_encoder_params.items()}
   text_encoder_params = unflatten_dict(text_encoder_params, sep=".")
+  if scan_layers:
+    params = stack_f5_block_params(params)
 
-  return params,text_encoder_params
\ No newline at end of file
+  return params,text_encoder_params
+
+
+def stack_f5_block_params(params):
+  """Stacks per-layer `blocks_{i}` F5 params into the `blocks` tree used with `scan_layers`."""
+  params = dict(params)
+  depth = sum(1 for name in params if name.startswith("blocks_"))
+  layers = [params.pop(f"blocks_{i}") for i in range(depth)]
+  params["blocks"] = jax.tree_util.tree_map(lambda *xs: np.stack(xs), *layers)
+  return params
+
+
+def unstack_f5_block_params(params):
+  """Inverse of `stack_f5_block_params`, splits the scanned `blocks` tree back into `blocks_{i}`."""
+  params = dict(params)
+  blocks = params.pop("blocks")
+  depth = jax.tree_util.tree_leaves(blocks)[0].shape[0]
+  for i in range(depth):
+    params[f"blocks_{i}"] = jax.tree_util.tree_map(lambda x, i=i: x[i], blocks)
+  return params
@@ -104,13 +104,17 @@ class AqtQuantization:
     """Returns dot_general configured with aqt params."""
     # module_path = "/".join(nn.module._context.module_stack[-1].path)
     # print(f"quant_dg: {quant_dg}, is_tiled: {is_tiled}, module_path: {module_path}")
+    rhs_axis_metadata_wrapper = self._get_rhs_axis_metadata_wrapper(mesh_axes, replicate_scale=self.replicate_scale)
     aqt_dg_cls = functools.partial(
         aqt_flax.AqtDotGeneral,
         self.quant_dg,
-        lhs_quant_mode=self.lhs_quant_mode,
-        rhs_quant_mode=self.rhs_quant_mode,
-        lhs_freeze_mode=aqt_flax.FreezerMode.CALIBRATION,
+        rhs_quant_mode=self.quant_mode,
+        lhs_freeze_mode=aqt_flax.FreezerMode.NONE,
         rhs_freeze_mode=aqt_flax.FreezerMode.CALIBRATION_AND_VALUE,
+        rhs_axis_metadata_wrapper=rhs_axis_metadata_wrapper,
+        # Only the gradient noise in train mode draws random numbers, so convert and serve
+        # applies don't need to provide a 'params' rng.
+        prng_name="params" if self.quant_mode == aqt_flax.QuantMode.TRAIN else None,
     )
     return aqt_dg_cls
 
@@ -119,9 +123,8 @@ class AqtQuantization:
     aqt_einsum = functools.partial(
         aqt_flax.AqtEinsum(
             cfg=self.quant_dg,
-            lhs_quant_mode=self.lhs_quant_mode,
-            rhs_quant_mode=self.rhs_quant_mode,
-            lhs_freeze_mode=aqt_flax.FreezerMode.CALIBRATION,
+            rhs_quant_mode=self.quant_mode,
+            lhs_freeze_mode=aqt_flax.FreezerMode.NONE,
             rhs_freeze_mode=aqt_flax.FreezerMode.CALIBRATION_AND_VALUE,
         )
     )
@@ -175,12 +178,18 @@ def _get_int8_quant_config(config):
   )
 
 
+def _get_weight_only_quant_config(lhs_bits=None, rhs_bits=None):
+  return aqt_config.dot_general_make(lhs_bits=lhs_bits, rhs_bits=rhs_bits)
+
+
 def _get_quant_config(config):
   """Set quantization params based on user configuration."""
   if not config.quantization or config.quantization == "":
     return None
   if config.quantization == "int8":
     return _get_int8_quant_config(config)
+  if config.quantization == "int8w":
+    return _get_weight_only_quant_config(lhs_bits=None, rhs_bits=8)
   raise ValueError(f"Invalid value configured for quantization {config.quantization}.")
 
 
@@ -255,3 +264,41 @@ def remove_quantized_params(params, aqt_vars):
       v = {}
     tree_flat[i] = v
   return tree_unflatten(tree_struct, tree_flat)
+
+
+class QuantDense(nn.Module):
+  """nn.Dense with an AQT dot_general that skips the float kernel in serve mode.
+
+  Parameter names match nn.Dense so checkpoints load unchanged. In serve mode the kernel has been
+  removed by `remove_quantized_params` and AQT reads the frozen int8 weights from the `aqt` collection.
+  """
+
+  features: int
+  use_bias: bool = True
+  dtype: DType | None = None
+  param_dtype: DType = jnp.float32
+  precision: jax.lax.Precision | None = None
+  kernel_init: nn.initializers.Initializer = nn.initializers.lecun_normal()
+  bias_init: nn.initializers.Initializer = nn.initializers.zeros_init()
+  quant: AqtQuantization | None = None
+
+  @nn.compact
+  def __call__(self, inputs: Array) -> Array:
+    kernel_shape = (jnp.shape(inputs)[-1], self.features)
+    if in_serve_mode(self.quant):
+      kernel = jnp.zeros(kernel_shape, self.param_dtype)
+    else:
+      kernel = self.param("kernel", self.kernel_init, kernel_shape, self.param_dtype)
+    bias = self.param("bias", self.bias_init, (self.features,), self.param_dtype) if self.use_bias else None
+    inputs, kernel, bias = nn.dtypes.promote_dtype(inputs, kernel, bias, dtype=self.dtype)
+
+    dot_general = jax.lax.dot_general if self.quant is None else self.quant.dot_general_cls()()
+    y = dot_general(
+        inputs,
+        kernel,
+        (((inputs.ndim - 1,), (0,)), ((), ())),
+        precision=self.precision,
+    )
+    if bias is not None:
+      y += jnp.reshape(bias, (1,) * (y.ndim - 1) + (-1,))
+    return y
@@ -24,6 +24,8 @@ from functools import partial  # pylint: disable=g-importing-member
 from typing import Union
 from collections.abc import Iterator, Iterable
 import tensorflow as tf  # pylint: disable=g-import-not-at-top
+import queue
+import threading
 import time
 import numpy as np
 
@@ -89,17 +91,42 @@ def get_next_batch_sharded(local_dataset: Iterator, global_mesh: Mesh) -> jax.Ar
 
 
 class MultiHostDataLoadIterator:
-  """fold get_next_batch_sharded into a iterator class"""
+  """fold get_next_batch_sharded into a iterator class
 
-  def __init__(self, dataloader: Union[tf.data.Dataset, Iterable], global_mesh: Mesh):
+  With `prefetch_depth > 0` a background thread keeps up to that many global batches on
+  device, so host decoding and the host to device copies overlap the running train step.
+  The time `__next__` spends waiting on the input pipeline accumulates in `stall_seconds`.
+  """
+
+  def __init__(
+      self, dataloader: Union[tf.data.Dataset, Iterable], global_mesh: Mesh, prefetch_depth: int = 0
+  ):
     self.global_mesh = global_mesh
     self.dataloader = dataloader
-    if isinstance(self.dataloader, tf.data.Dataset):
-      self.local_iterator = self.dataloader.as_numpy_iterator()
-    elif isinstance(self.dataloader, Iterable):
-      self.local_iterator = iter(self.dataloader)
-    else:
-      raise ValueError("Type error: dataloader should be either tf.data.Dataset or Iterable.")
+    self.prefetch_depth = prefetch_depth
+    self.stall_seconds = 0.0
+    self._prefetch_thread = None
+    self._prefetch_queue = None
+    self._stop_prefetch = None
+    self._resume_state = None
+    self._local_iterator = None
+    self.reset()
+
+  @property
+  def local_iterator(self):
+    """The host iterator, e.g. for checkpointing the grain iterator state.
+
+    Prefetching is stopped and iterators that support it are set back to the state after
+    the last batch returned by `__next__`; the next call resumes prefetching from there.
+    """
+    if hasattr(self._local_iterator, "set_state"):
+      self._stop_prefetching()
+    return self._local_iterator
+
+  @local_iterator.setter
+  def local_iterator(self, local_iterator):
+    self._stop_prefetching(rewind=False)
+    self._local_iterator = local_iterator
 
   def reset(self):
     if isinstance(self.dataloader, tf.data.Dataset):
@@ -109,9 +136,75 @@ class MultiHostDataLoadIterator:
     else:
       raise ValueError("Type error: dataloader should be either tf.data.Dataset or grain.DataLoader.")
 
+  def pop_stall_seconds(self):
+    """Returns the time spent waiting for batches since the last call."""
+    stall_seconds, self.stall_seconds = self.stall_seconds, 0.0
+    return stall_seconds
+
+  def _start_prefetching(self):
+    self._prefetch_queue = queue.Queue(maxsize=self.prefetch_depth)
+    self._stop_prefetch = threading.Event()
+    if hasattr(self._local_iterator, "get_state"):
+      self._resume_state = self._local_iterator.get_state()
+    self._prefetch_thread = threading.Thread(
+        target=self._prefetch,
+        args=(self._local_iterator, self._prefetch_queue, self._stop_prefetch),
+        daemon=True,
+    )
+    self._prefetch_thread.start()
+
+  def _prefetch(self, local_iterator, prefetch_queue, stop_prefetch):
+    """Puts (global batch, iterator state after it, exception) on the queue until stopped."""
+
+    def put(item):
+      while not stop_prefetch.is_set():
+        try:
+          prefetch_queue.put(item, timeout=1)
+          return True
+        except queue.Full:
+          pass
+      return False
+
+    try:
+      while not stop_prefetch.is_set():
+        batch = get_next_batch_sharded(local_iterator, self.global_mesh)
+        state = local_iterator.get_state() if hasattr(local_iterator, "get_state") else None
+        if not put((batch, state, None)):
+          return
+    except BaseException as e:  # pylint: disable=broad-except
+      # Includes StopIteration, re-raised on the training thread by __next__.
+      put((None, None, e))
+
+  def _stop_prefetching(self, rewind=True):
+    if self._prefetch_thread is None:
+      return
+    self._stop_prefetch.set()
+    self._prefetch_thread.join()
+    self._prefetch_thread = None
+    self._prefetch_queue = None
+    if rewind and self._resume_state is not None:
+      self._local_iterator.set_state(self._resume_state)
+    self._resume_state = None
+
   def __iter__(self):
     self.reset()
     return self
 
   def __next__(self):
-    return get_next_batch_sharded(self.local_iterator, self.global_mesh)
+    start = time.perf_counter()
+    if self.prefetch_depth <= 0:
+      batch = get_next_batch_sharded(self._local_iterator, self.global_mesh)
+      self.stall_seconds += time.perf_counter() - start
+      return batch
+
+    if self._prefetch_thread is None:
+      self._start_prefetching()
+    batch, state, error = self._prefetch_queue.get()
+    self.stall_seconds += time.perf_counter() - start
+    if error is not None:
+      self._prefetch_thread.join()
+      self._prefetch_thread = None
+      self._resume_state = None
+      raise error
+    self._resume_state = state
+    return batch
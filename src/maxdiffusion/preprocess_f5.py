@@ -0,0 +1,256 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Offline feature extraction for F5 training.
+
+Reads a manifest of `audio_path|text` lines (F5-TTS metadata.csv, relative paths are
+resolved against the manifest directory), computes the same log-mel as the F5 entry
+points and the pinyin vocab ids in worker processes, and writes length-sorted ArrayRecord
+shards to `f5_dataset_dir`:
+
+  python src/maxdiffusion/preprocess_f5.py src/maxdiffusion/configs/f5.yml \
+    f5_manifest_path=/data/metadata.csv f5_dataset_dir=/data/f5_records
+
+Next to the shards, `frames.npy` holds the mel length of every record in the order of the
+sorted shard files and `index.json` the per shard record counts and length ranges.
+Train with `grain_train_files=/data/f5_records/*.array_record`.
+"""
+
+import functools
+import json
+import multiprocessing
+import os
+from typing import Sequence
+
+from absl import app
+import jax
+import jax.numpy as jnp
+import numpy as np
+from pypinyin import lazy_pinyin, Style
+import jieba
+import librosa
+import audax.core.functional
+
+from maxdiffusion import pyconfig, max_logging
+from maxdiffusion.input_pipeline._grain_data_processing import serialize_f5_example
+
+SAMPLING_RATE = 24000
+HOP_LENGTH = 256
+# Audio is zero padded to a multiple of this many frames so each worker compiles
+# get_mel for a handful of shapes. Only the last frame or two see the padding.
+_PAD_FRAMES = 64
+
+
+def dynamic_range_compression_jax(x, C=1, clip_val=1e-7):
+  return jnp.log(jnp.clip(x, min=clip_val) * C)
+
+
+def get_mel(
+    y, n_mels=100, n_fft=1024, win_size=1024, hop_length=HOP_LENGTH, fmin=0, fmax=None, clip_val=1e-7, sampling_rate=SAMPLING_RATE
+):
+  """(batch, samples) audio to a (batch, frames, n_mels) log-mel, as in generate_f5."""
+  window = jnp.hanning(win_size)
+  spec_func = functools.partial(
+      audax.core.functional.spectrogram,
+      pad=0,
+      window=window,
+      n_fft=n_fft,
+      hop_length=hop_length,
+      win_length=win_size,
+      power=1.0,
+      normalized=False,
+      center=True,
+      onesided=True,
+  )
+  fb = audax.core.functional.melscale_fbanks(
+      n_freqs=(n_fft // 2) + 1, n_mels=n_mels, sample_rate=sampling_rate, f_min=fmin, f_max=fmax
+  )
+  mel_spec_func = functools.partial(audax.core.functional.apply_melscale, melscale_filterbank=fb)
+  spec = spec_func(y)
+  spec = mel_spec_func(spec)
+  spec = dynamic_range_compression_jax(spec, clip_val=clip_val)
+  return spec
+
+
+def convert_char_to_pinyin(text_list, polyphone=True):
+  if jieba.dt.initialized is False:
+    jieba.default_logger.setLevel(50)  # CRITICAL
+    jieba.initialize()
+
+  final_text_list = []
+  custom_trans = str.maketrans({";": ",", "“": '"', "”": '"', "‘": "'", "’": "'"})  # add custom trans here, to address oov
+
+  def is_chinese(c):
+    return "\u3100" <= c <= "\u9fff"  # common chinese characters
+
+  for text in text_list:
+    char_list = []
+    text = text.translate(custom_trans)
+    for seg in jieba.cut(text):
+      seg_byte_len = len(bytes(seg, "UTF-8"))
+      if seg_byte_len == len(seg):  # if pure alphabets and symbols
+        if char_list and seg_byte_len > 1 and char_list[-1] not in " :'\"":
+          char_list.append(" ")
+        char_list.extend(seg)
+      elif polyphone and seg_byte_len == 3 * len(seg):  # if pure east asian characters
+        seg_ = lazy_pinyin(seg, style=Style.TONE3, tone_sandhi=True)
+        for i, c in enumerate(seg):
+          if is_chinese(c):
+            char_list.append(" ")
+          char_list.append(seg_[i])
+      else:  # if mixed characters, alphabets and symbols
+        for c in seg:
+          if ord(c) < 256:
+            char_list.extend(c)
+          elif is_chinese(c):
+            char_list.append(" ")
+            char_list.extend(lazy_pinyin(c, style=Style.TONE3, tone_sandhi=True))
+          else:
+            char_list.append(c)
+    final_text_list.append(char_list)
+
+  return final_text_list
+
+
+def load_vocab(vocab_path):
+  """vocab.txt with one token per line, index 0 is used for unknown tokens."""
+  with open(vocab_path, "r", encoding="utf-8") as f:
+    return {char[:-1]: i for i, char in enumerate(f)}
+
+
+def text_to_ids(text, vocab_char_map):
+  """Pinyin vocab ids shifted by one so 0 is the filler token, as the F5 text embedding expects."""
+  chars = convert_char_to_pinyin([text])[0]
+  return np.asarray([vocab_char_map.get(c, 0) for c in chars], dtype=np.int32) + 1
+
+
+def read_manifest(manifest_path):
+  """Returns [(audio_path, text)] from `audio_path|text` lines."""
+  base_dir = os.path.dirname(os.path.abspath(manifest_path))
+  entries = []
+  with open(manifest_path, "r", encoding="utf-8") as f:
+    for line in f:
+      line = line.rstrip("\n")
+      if not line or line == "audio_file|text":
+        continue
+      audio_path, text = line.split("|", 1)
+      entries.append((os.path.join(base_dir, audio_path), text.strip()))
+  return entries
+
+
+def _init_worker():
+  # Workers share the host with the parent, keep them off the accelerators.
+  jax.config.update("jax_platforms", "cpu")
+
+
+def _num_frames(audio_path):
+  try:
+    return int(librosa.get_duration(path=audio_path) * SAMPLING_RATE) // HOP_LENGTH + 1
+  except Exception:  # pylint: disable=broad-except
+    return -1
+
+
+def _write_shard(shard_path, entries, vocab_path, n_mels, max_frames):
+  """Writes one ArrayRecord shard in `entries` order, returns the mel length of every record written."""
+  from array_record.python.array_record_module import ArrayRecordWriter  # pylint: disable=import-outside-toplevel
+
+  vocab_char_map = load_vocab(vocab_path)
+  jitted_get_mel = jax.jit(functools.partial(get_mel, n_mels=n_mels))
+  pad_samples = _PAD_FRAMES * HOP_LENGTH
+
+  frames = []
+  writer = ArrayRecordWriter(shard_path, "group_size:1")
+  for audio_path, text in entries:
+    try:
+      y, _ = librosa.load(audio_path, sr=SAMPLING_RATE)
+    except Exception as e:  # pylint: disable=broad-except
+      max_logging.log(f"Skipping {audio_path}: {e}")
+      continue
+    num_frames = y.shape[0] // HOP_LENGTH + 1
+    if num_frames > max_frames:
+      continue
+    y = np.pad(y, (0, -y.shape[0] % pad_samples))
+    mel = np.asarray(jitted_get_mel(y[np.newaxis]))[0, :num_frames]
+    writer.write(serialize_f5_example(mel, text_to_ids(text, vocab_char_map)))
+    frames.append(num_frames)
+  writer.close()
+  return frames
+
+
+def _write_shard_star(args):
+  return _write_shard(*args)
+
+
+def run(config):
+  if not config.f5_manifest_path or not config.f5_dataset_dir:
+    raise ValueError("preprocess_f5 requires f5_manifest_path and f5_dataset_dir.")
+  os.makedirs(config.f5_dataset_dir, exist_ok=True)
+  max_frames = max(config.f5_length_buckets)
+  num_workers = config.f5_preprocess_num_workers if config.f5_preprocess_num_workers > 0 else os.cpu_count()
+
+  entries = [entry for entry in read_manifest(config.f5_manifest_path) if entry[1]]
+  max_logging.log(f"Read {len(entries)} utterances from {config.f5_manifest_path}")
+
+  with multiprocessing.get_context("spawn").Pool(num_workers, initializer=_init_worker) as pool:
+    # Sort by the header duration first so every shard covers a narrow length range.
+    estimated_frames = pool.map(_num_frames, [audio_path for audio_path, _ in entries], chunksize=64)
+    entries = [entry for entry, n in sorted(zip(entries, estimated_frames), key=lambda x: x[1]) if 0 < n <= max_frames]
+
+    num_shards = max(1, -(-len(entries) // config.f5_records_per_shard))
+    shard_names = [f"f5-{i:05d}-of-{num_shards:05d}.array_record" for i in range(num_shards)]
+    shard_args = [
+        (
+            os.path.join(config.f5_dataset_dir, shard_names[i]),
+            entries[i * config.f5_records_per_shard : (i + 1) * config.f5_records_per_shard],
+            config.vocab_name_or_path,
+            config.n_mels,
+            max_frames,
+        )
+        for i in range(num_shards)
+    ]
+    shard_frames = []
+    for i, frames in enumerate(pool.imap(_write_shard_star, shard_args)):
+      shard_frames.append(frames)
+      max_logging.log(f"Wrote {shard_names[i]}: {len(frames)} records")
+
+  np.save(os.path.join(config.f5_dataset_dir, "frames.npy"), np.asarray(sum(shard_frames, []), dtype=np.int32))
+  index = {
+      "sampling_rate": SAMPLING_RATE,
+      "hop_length": HOP_LENGTH,
+      "n_mels": config.n_mels,
+      "num_records": sum(len(frames) for frames in shard_frames),
+      "shards": [
+          {
+              "path": name,
+              "num_records": len(frames),
+              "min_frames": min(frames, default=0),
+              "max_frames": max(frames, default=0),
+          }
+          for name, frames in zip(shard_names, shard_frames)
+      ],
+  }
+  with open(os.path.join(config.f5_dataset_dir, "index.json"), "w", encoding="utf-8") as f:
+    json.dump(index, f, indent=2)
+  max_logging.log(f"Wrote {index['num_records']} records to {config.f5_dataset_dir}")
+
+
+def main(argv: Sequence[str]) -> None:
+  pyconfig.initialize(argv)
+  run(pyconfig.config)
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -51,11 +51,23 @@ def _lists_to_tuples(l: list[Any]) -> Union[tuple[Any], list[Any]]:
   return tuple(_lists_to_tuples(x) for x in l) if isinstance(l, list) else l
 
 
+def _load_config(config_path: str) -> dict[str, Any]:
+  """Loads a yaml config, on top of the one named by its `base_config` key if it has one.
+
+  `base_config` is relative to the config's directory; the config's own keys override it.
+  """
+  with open(config_path, "r", encoding="utf-8") as yaml_file:
+    raw_data_from_yaml = yaml.safe_load(yaml_file)
+  if "base_config" in raw_data_from_yaml:
+    base_path = os.path.join(os.path.dirname(config_path), raw_data_from_yaml.pop("base_config"))
+    raw_data_from_yaml = {**_load_config(base_path), **raw_data_from_yaml}
+  return raw_data_from_yaml
+
+
 class _HyperParameters:
   # pylint: disable=missing-class-docstring
   def __init__(self, argv: list[str], **kwargs):
-    with open(argv[1], "r", encoding="utf-8") as yaml_file:
-      raw_data_from_yaml = yaml.safe_load(yaml_file)
+    raw_data_from_yaml = _load_config(argv[1])
     raw_data_from_cmd_line = self._load_kwargs(argv)
 
     for k in raw_data_from_cmd_line:
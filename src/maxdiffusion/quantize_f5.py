@@ -0,0 +1,183 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Offline int8 conversion of the F5 transformer for serving.
+
+Runs the transformer once in AQT convert mode, which freezes the int8 attention and FFN
+weights into the `aqt` collection, drops the float kernels that serve mode no longer reads
+and pickles the result to `quantized_params_path`:
+
+  python src/maxdiffusion/quantize_f5.py src/maxdiffusion/configs/f5.yml \
+    quantization=int8w quantized_params_path=/tmp/f5_int8w.pickle
+
+The F5 entry points pick the file up when started with the same `quantization` and
+`quantized_params_path`.
+"""
+
+import functools
+import pickle
+from typing import Sequence
+
+from absl import app
+import jax
+import jax.numpy as jnp
+from jax.sharding import Mesh, PartitionSpec as P
+import flax.linen as nn
+from flax.linen import partitioning as nn_partitioning
+from flax.traverse_util import flatten_dict, unflatten_dict
+
+from maxdiffusion import pyconfig, max_logging
+from maxdiffusion.max_utils import create_device_mesh, get_flash_block_sizes, get_precision
+from maxdiffusion.models import quantizations
+from maxdiffusion.models.f5.transformers.transformer_f5_flax import F5Transformer2DModel
+from maxdiffusion.checkpointing.checkpointing_utils import load_f5_params
+
+
+def _prune_to(params, abstract_params):
+  """Keeps only the params that exist in `abstract_params`."""
+  keep = flatten_dict(abstract_params).keys()
+  return unflatten_dict({k: v for k, v in flatten_dict(params).items() if k in keep})
+
+
+def quantize_f5_params(transformer, params, config, mesh):
+  """Returns (params, aqt_vars) for serving `transformer` with `quantization=config.quantization`.
+
+  `transformer` must be configured with a convert-mode `quant`.
+  """
+  if not quantizations.in_convert_mode(transformer.quant):
+    raise ValueError("quantize_f5_params requires a transformer configured with a convert mode quant.")
+  batch_size = jax.device_count()
+  x = jnp.zeros((batch_size, config.max_sequence_length, transformer.mel_dim), dtype=jnp.float32)
+  text_embed = jnp.zeros((batch_size, config.max_sequence_length, transformer.text_dim), dtype=jnp.float32)
+  decoder_segment_ids = jnp.ones((batch_size, config.max_sequence_length), dtype=jnp.int32)
+  timestep = jnp.zeros((batch_size,), dtype=jnp.float32)
+
+  def convert(params):
+    _, variables = transformer.apply(
+        {"params": params},
+        x=x,
+        cond=x,
+        text_embed=text_embed,
+        timestep=timestep,
+        decoder_segment_ids=decoder_segment_ids,
+        mutable=["aqt"],
+    )
+    return variables["aqt"]
+
+  with mesh, nn_partitioning.axis_rules(config.logical_axis_rules):
+    aqt_vars = jax.jit(convert)(params)
+
+  serve_transformer = transformer.clone(quant=quantizations.configure_quantization(config, "serve"))
+  abstract_params = serve_transformer.init_weights(
+      jax.random.key(config.seed), max_sequence_length=config.max_sequence_length, eval_only=True
+  )
+  return _prune_to(params, abstract_params), aqt_vars
+
+
+def save_quantized_params(path, params, aqt_vars):
+  with open(path, "wb") as f:
+    pickle.dump({"params": jax.device_get(params), "aqt": jax.device_get(aqt_vars)}, f)
+
+
+def load_quantized_params(path):
+  with open(path, "rb") as f:
+    quantized = pickle.load(f)
+  return quantized["params"], quantized["aqt"]
+
+
+def aqt_logical_partition_specs(transformer, aqt_vars, config):
+  """Returns logical PartitionSpecs for `aqt_vars`, taken from the float kernels they replace.
+
+  The int8 value is partitioned like its kernel. The per-channel scale keeps the kernel's output
+  axis (and the leading layers axis with scan_layers), or is replicated with replicate_quant_scale.
+  """
+  float_params = transformer.clone(quant=None).init_weights(
+      jax.random.key(config.seed), max_sequence_length=config.max_sequence_length, eval_only=True
+  )
+  kernel_specs = flatten_dict(nn.get_partition_spec(float_params))
+  specs = {}
+  for path, x in flatten_dict(aqt_vars).items():
+    # path is (..., <dense>, "AqtDotGeneral_0", "qrhs", "value" | "scale").
+    kernel_spec = tuple(kernel_specs[path[:-3] + ("kernel",)])
+    if path[-1] == "value" or not kernel_spec:
+      specs[path] = P(*kernel_spec)
+    else:
+      leading = kernel_spec[:-2]
+      out_axis = None if config.replicate_quant_scale else kernel_spec[-1]
+      specs[path] = P(*leading, *([None] * (len(x.shape) - len(leading) - 1)), out_axis)
+  return unflatten_dict(specs)
+
+
+def load_quantized_transformer_state(
+    transformer, config, mesh, transformer_state, transformer_state_shardings, quantized_params_path=None
+):
+  """Swaps the converted int8 weights into an (unplaced) serve-mode F5 InferenceState.
+
+  The aqt weights follow the logical axis rules of the float kernels they replace; the remaining
+  float params keep the shardings from `setup_initial_state`. `quantized_params_path` defaults to
+  config.quantized_params_path.
+  """
+  params, aqt_vars = load_quantized_params(quantized_params_path or config.quantized_params_path)
+  aqt_specs = aqt_logical_partition_specs(transformer, aqt_vars, config)
+  aqt_shardings = nn.logical_to_mesh_sharding(aqt_specs, mesh, config.logical_axis_rules)
+  transformer_state = transformer_state.replace(params=params, aqt=aqt_vars)
+  transformer_state_shardings = transformer_state_shardings.replace(aqt=aqt_shardings)
+  return transformer_state, transformer_state_shardings
+
+
+def run(config):
+  if not config.quantization:
+    raise ValueError("quantize_f5 requires quantization to be set, e.g. quantization=int8w.")
+  if not config.quantized_params_path:
+    raise ValueError("quantize_f5 requires quantized_params_path.")
+
+  devices_array = create_device_mesh(config)
+  mesh = Mesh(devices_array, config.mesh_axes)
+
+  transformer = F5Transformer2DModel(
+      mesh=mesh,
+      attention_kernel=config.attention,
+      flash_block_sizes=get_flash_block_sizes(config),
+      dtype=config.activations_dtype,
+      weights_dtype=config.weights_dtype,
+      precision=get_precision(config),
+      scan_layers=config.scan_layers,
+      quant=quantizations.configure_quantization(config, "convert"),
+  )
+  transformer_params, _ = load_f5_params(
+      config.pretrained_model_name_or_path, use_ema=config.use_ema, scan_layers=config.scan_layers
+  )
+  if "guidance_embed" in transformer_params:
+    transformer = transformer.clone(guidance_embeds=True)
+
+  params, aqt_vars = quantize_f5_params(transformer, transformer_params, config, mesh)
+  save_quantized_params(config.quantized_params_path, params, aqt_vars)
+
+  num_bytes = functools.partial(jax.tree_util.tree_reduce, lambda acc, x: acc + x.nbytes, initializer=0)
+  max_logging.log(
+      f"Saved {config.quantization} F5 weights to {config.quantized_params_path}: "
+      f"float params {num_bytes(transformer_params) / 1e9:.2f} GB -> "
+      f"{(num_bytes(jax.device_get(params)) + num_bytes(jax.device_get(aqt_vars))) / 1e9:.2f} GB"
+  )
+
+
+def main(argv: Sequence[str]) -> None:
+  pyconfig.initialize(argv)
+  run(pyconfig.config)
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,88 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Classifier-free guidance interval and unconditional prediction reuse for the F5 sampling loop.
+
+Guidance is applied only for `t_min <= t <= t_max`, outside the interval the velocity is the
+conditional prediction and the unconditional pass is skipped. Inside it the unconditional
+prediction is recomputed every `null_pred_every` model evaluations and reused in between, from
+a cache in the `fori_loop` carry.
+
+The controls are traced arrays, changing them per request does not recompile the loop.
+"""
+
+import jax
+import jax.numpy as jnp
+
+# Age of an empty cache, forces a recompute at the first guided evaluation.
+_EMPTY_CACHE_AGE = 2**30
+
+
+def init_guidance_controls(t_min=0.0, t_max=1.0, null_pred_every=1):
+  """The runtime controls of `guided_velocity`, the defaults guide every evaluation."""
+  return {
+      "t_min": jnp.asarray(t_min, dtype=jnp.float32),
+      "t_max": jnp.asarray(t_max, dtype=jnp.float32),
+      "null_pred_every": jnp.asarray(max(int(null_pred_every), 1), dtype=jnp.int32),
+  }
+
+
+def guidance_controls_from_config(config):
+  return init_guidance_controls(config.cfg_interval_min, config.cfg_interval_max, config.cfg_null_pred_every)
+
+
+def guidance_cost(timesteps, t_min=0.0, t_max=1.0, null_pred_every=1):
+  """Model passes of `guided_velocity` at `timesteps`, relative to guiding every evaluation.
+
+  1.0 when every evaluation runs both passes, 0.5 when none runs the unconditional one.
+  """
+  passes, age = 0, _EMPTY_CACHE_AGE
+  for t in timesteps:
+    guided = t_min <= t <= t_max
+    recompute = guided and age >= max(int(null_pred_every), 1)
+    passes += 1 + recompute
+    age = 1 if recompute else age + guided
+  return passes / (2 * max(len(timesteps), 1))
+
+
+def init_guidance_cache(latents):
+  """The guidance part of the loop carry."""
+  return {"null_pred": jnp.zeros_like(latents), "age": jnp.asarray(_EMPTY_CACHE_AGE, dtype=jnp.int32)}
+
+
+def guided_velocity(pred_fn, null_pred_fn, combine_fn, x, t, controls, cache, null_pred_state=None):
+  """Returns (velocity, new cache, new `null_pred_state`).
+
+  `pred_fn(x, t)` runs the conditional pass. `null_pred_fn(x, t, null_pred_state)` runs the
+  unconditional one and returns (null_pred, null_pred_state), the state is threaded through
+  the skipped passes unchanged, e.g. the pass's block cache. `combine_fn(pred, null_pred)`
+  applies the caller's guidance formula.
+  """
+  pred = pred_fn(x, t)
+  guided = (t >= controls["t_min"]) & (t <= controls["t_max"])
+  recompute = guided & (cache["age"] >= controls["null_pred_every"])
+
+  def run_null_pred():
+    null_pred, state = null_pred_fn(x, t, null_pred_state)
+    return null_pred.astype(cache["null_pred"].dtype), state
+
+  null_pred, null_pred_state = jax.lax.cond(recompute, run_null_pred, lambda: (cache["null_pred"], null_pred_state))
+  cache = {
+      "null_pred": null_pred,
+      "age": jnp.where(recompute, 1, cache["age"] + guided.astype(jnp.int32)),
+  }
+  velocity = jnp.where(guided, combine_fn(pred, null_pred.astype(pred.dtype)), pred)
+  return velocity, cache, null_pred_state
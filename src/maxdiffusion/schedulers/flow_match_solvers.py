@@ -0,0 +1,71 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""ODE solvers for the flow matching sampling loops of F5 and Flux.
+
+`solver_step` moves the latents from `t_curr` to `t_next` along `velocity_fn(latents, t)`
+inside the sampling `fori_loop`. The solver name is static, each solver compiles to its own
+loop. Multistep solvers keep earlier velocities in `solver_state`, part of the loop carry,
+created by `init_solver_state`.
+
+  euler     first order, one evaluation per step.
+  midpoint  second order Runge-Kutta, two evaluations per step.
+  heun      Euler predictor and trapezoidal corrector, two evaluations per step.
+  adams2    second order Adams-Bashforth for varying step sizes, one evaluation per step
+            and the previous step's velocity. The first step is an Euler step.
+"""
+
+import jax.numpy as jnp
+
+# Model evaluations per step.
+FLOW_SOLVERS = {"euler": 1, "midpoint": 2, "heun": 2, "adams2": 1}
+
+
+def init_solver_state(solver, latents):
+  """The solver's part of the loop carry."""
+  if solver not in FLOW_SOLVERS:
+    raise ValueError(f"Unknown flow_solver {solver}, expected one of {list(FLOW_SOLVERS)}.")
+  if solver == "adams2":
+    return {"velocity": jnp.zeros_like(latents), "dt": jnp.zeros((), dtype=jnp.float32)}
+  return {}
+
+
+def solver_step(solver, velocity_fn, latents, t_curr, t_next, solver_state):
+  """Returns (latents at `t_next`, new solver state)."""
+  dt = t_next - t_curr
+  if solver == "euler":
+    velocity = velocity_fn(latents, t_curr)
+  elif solver == "midpoint":
+    velocity = velocity_fn(latents, t_curr)
+    velocity = velocity_fn((latents + dt / 2 * velocity).astype(latents.dtype), t_curr + dt / 2)
+  elif solver == "heun":
+    velocity = velocity_fn(latents, t_curr)
+    velocity_next = velocity_fn((latents + dt * velocity).astype(latents.dtype), t_next)
+    velocity = (velocity + velocity_next) / 2
+  elif solver == "adams2":
+    velocity_curr = velocity_fn(latents, t_curr)
+    prev_dt = solver_state["dt"]
+    # Extrapolates the velocity to the middle of the step, 0 while there is no previous step.
+    ratio = jnp.where(prev_dt != 0, dt / jnp.where(prev_dt != 0, prev_dt, 1.0), 0.0)
+    velocity = (1 + ratio / 2) * velocity_curr - ratio / 2 * solver_state["velocity"]
+    solver_state = {
+        "velocity": velocity_curr.astype(solver_state["velocity"].dtype),
+        "dt": jnp.asarray(dt, dtype=jnp.float32),
+    }
+  else:
+    raise ValueError(f"Unknown flow_solver {solver}, expected one of {list(FLOW_SOLVERS)}.")
+  latents = (latents + dt * velocity).astype(latents.dtype)
+  return latents, solver_state
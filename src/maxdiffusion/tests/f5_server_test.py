@@ -0,0 +1,266 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+import asyncio
+import io
+import json
+import os
+import tempfile
+import types
+import unittest
+import wave
+from absl.testing import absltest
+import numpy as np
+import orbax.checkpoint as ocp
+import soundfile as sf
+from ..f5_audio_encoding import AudioEncoder, available_audio_formats, encode_audio, pcm16
+from ..f5_engine import F5Engine, PendingBatch, SynthesisRequest, _path_signature, batch_key
+from ..f5_result_cache import ResultCache
+from ..f5_server import ChunkBatcher, F5Server, HttpError
+
+
+class _Engine:
+  """Returns each chunk's value as its audio and records the batches and weight swaps."""
+
+  max_chunks = 4
+  loaded = True
+
+  def __init__(self):
+    self.batches = []
+    self.fingerprint = "initial"
+    self.discarded = []
+
+  def load_weights(self, path, quantized_params_path=None):
+    return path
+
+  def canary(self, weights):
+    if weights == "broken":
+      raise ValueError("non finite audio")
+
+  def batch_secs(self, num_chunks, *key):
+    # A second per batch, cheaper as the unconditional prediction is reused for longer.
+    return 1.0 / key[3] if key else 1.0
+
+  def swap_weights(self, weights, path, quantized_params_path=None):
+    self.fingerprint = weights
+
+  def discard_weights(self, weights):
+    self.discarded.append(weights)
+
+  def dispatch_batch(self, chunks, *key):
+    self.batches.append((key, list(chunks)))
+    return chunks
+
+  def finish_batch(self, chunks):
+    stats = {"bucket": self.max_chunks, "rows": len(chunks), "device_secs": 0.0}
+    return [np.full((2,), chunk, dtype=np.float32) for chunk in chunks], stats
+
+
+class F5ServerTest(unittest.TestCase):
+  """Test the F5 HTTP server's batching, result cache and audio encoding"""
+
+  def test_wav(self):
+    audio = np.linspace(-1.0, 1.0, 100, dtype=np.float32)
+    with wave.open(io.BytesIO(encode_audio(pcm16(audio), "wav"))) as f:
+      assert f.getnchannels() == 1 and f.getsampwidth() == 2 and f.getframerate() == 24000
+      np.testing.assert_array_equal(np.frombuffer(f.readframes(100), "<i2"), (audio * 32767).astype(np.int16))
+    # Streamed, the header comes with the first piece and the samples follow unchanged.
+    encoder = AudioEncoder("wav")
+    streamed = encoder.encode(pcm16(audio[:50])) + encoder.encode(pcm16(audio[50:])) + encoder.close()
+    assert streamed[44:] == pcm16(audio)
+
+  def test_flac(self):
+    """FLAC is lossless, the decoded samples are the encoded ones."""
+    if "flac" not in available_audio_formats():
+      self.skipTest("libsndfile without FLAC")
+    pcm = pcm16(np.sin(np.linspace(0.0, 100.0, 4800, dtype=np.float32)))
+    audio, sample_rate = sf.read(io.BytesIO(encode_audio(pcm, "flac")), dtype="int16")
+    assert sample_rate == 24000
+    np.testing.assert_array_equal(audio, np.frombuffer(pcm, "<i2"))
+
+  def test_batching(self):
+    """Chunks of concurrent requests share batches of up to max_chunks, per batch key, in order."""
+    engine = _Engine()
+
+    async def run():
+      batcher = ChunkBatcher(engine, max_queued_chunks=8, batch_wait_secs=0.01)
+      task = asyncio.create_task(batcher.run())
+      plain = SynthesisRequest("a", "b", np.zeros(1))
+      sway = SynthesisRequest("a", "b", np.zeros(1), sway_sampling=True)
+      futures = [batcher.submit(plain, [1, 2, 3]), batcher.submit(sway, [4]), batcher.submit(plain, [5, 6])]
+      with self.assertRaises(HttpError):
+        batcher.submit(plain, [7, 8, 9])
+      results = [[float(audio[0]) for audio in await asyncio.gather(*f)] for f in futures]
+      task.cancel()
+      return results
+
+    assert asyncio.run(run()) == [[1, 2, 3], [4], [5, 6]]
+    assert [chunks for _, chunks in engine.batches] == [[1, 2, 3, 5], [4], [6]]
+    assert engine.batches[1][0][0]
+
+  def _server(self, num_replicas, latency_targets_ms=None, quantization=""):
+    config = types.SimpleNamespace(
+        serve_max_queued_chunks=16,
+        serve_batch_wait_ms=10,
+        serve_pipeline_depth=2,
+        serve_encode_workers=1,
+        result_cache_memory_mb=0,
+        result_cache_dir="",
+        serve_latency_targets_ms=latency_targets_ms or {},
+        serve_slo_delay_factor=2.0,
+        quantization=quantization,
+    )
+    engines = [_Engine() for _ in range(num_replicas)]
+    return F5Server(engines, config), engines
+
+  def test_dispatch(self):
+    """Requests go to the loaded replica with the fewest chunks queued or running."""
+    server, engines = self._server(3)
+    first, second, third = server.batchers
+    first.pending.extend([None] * 2)
+    second.running_chunks = 1
+    third.pending.append(None)
+    assert server.dispatch() is second
+    second.engine.loaded = False
+    assert server.dispatch() is third
+    for engine in engines:
+      engine.loaded = False
+    with self.assertRaises(HttpError):
+      server.dispatch()
+
+  def test_swap_weights(self):
+    """Every replica swaps only once every replica passed its canary, rejected weights are freed."""
+    server, engines = self._server(2)
+
+    async def swap(path):
+      return await server.swap_weights(json.dumps({"pretrained_model_name_or_path": path}).encode())
+
+    with self.assertRaises(HttpError):
+      asyncio.run(swap("broken"))
+    assert [engine.fingerprint for engine in engines] == ["initial", "initial"]
+    assert [engine.discarded for engine in engines] == [["broken"], ["broken"]]
+    assert asyncio.run(swap("new"))["fingerprint"] == "new"
+    assert [engine.fingerprint for engine in engines] == ["new", "new"]
+
+  def test_swap_quantized_weights(self):
+    """With quantization a swap needs the int8 weights of the new checkpoint."""
+    server, engines = self._server(1, quantization="int8w")
+
+    async def swap(payload):
+      return await server.swap_weights(json.dumps(payload).encode())
+
+    with self.assertRaises(HttpError) as e:
+      asyncio.run(swap({"pretrained_model_name_or_path": "new"}))
+    assert e.exception.status == 400
+    assert engines[0].fingerprint == "initial"
+    payload = {"pretrained_model_name_or_path": "new", "quantized_params_path": "new_int8"}
+    assert asyncio.run(swap(payload))["fingerprint"] == "new"
+
+  def test_path_signature(self):
+    """A checkpoint directory's signature follows the files of its latest step."""
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+      os.makedirs(os.path.join(checkpoint_dir, "100", "dit_state"))
+      item = os.path.join(checkpoint_dir, "100", "dit_state", "data")
+      with open(item, "wb") as f:
+        f.write(b"a")
+      signature = _path_signature(checkpoint_dir)
+      # Rewritten in place, the directories' own stats do not change.
+      with open(item, "wb") as f:
+        f.write(b"bb")
+      assert _path_signature(checkpoint_dir) != signature
+      signature = _path_signature(checkpoint_dir)
+      os.makedirs(os.path.join(checkpoint_dir, "200", "dit_state"))
+      assert _path_signature(checkpoint_dir) != signature
+    assert _path_signature(checkpoint_dir) is None
+
+  def test_load_weights_sampling_config(self):
+    """Checkpoints sampled differently from what the executables were compiled for are rejected."""
+    engine = F5Engine.__new__(F5Engine)
+    engine.config = types.SimpleNamespace(quantization="", num_inference_steps=32, sway_sampling_coef=-1.0)
+    engine.guidance_distilled = False
+    engine.load_transformer_state = lambda path, quantized_params_path: self.fail("loaded rejected weights")
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+      sampling_config = {"guidance_distilled": True, "num_inference_steps": None, "sway_sampling_coef": -1.0}
+      checkpointer = ocp.Checkpointer(ocp.JsonCheckpointHandler())
+      checkpointer.save(os.path.join(checkpoint_dir, "100", "f5_sampling"), args=ocp.args.JsonSave(sampling_config))
+      with self.assertRaises(ValueError):
+        engine.load_weights(checkpoint_dir)
+      engine.guidance_distilled = True
+      sampling_config["num_inference_steps"] = 8
+      checkpointer.save(os.path.join(checkpoint_dir, "200", "f5_sampling"), args=ocp.args.JsonSave(sampling_config))
+      with self.assertRaises(ValueError):
+        engine.load_weights(checkpoint_dir)
+
+  def test_canary_skips_batch_stats(self):
+    """Canary batches leave the batch time estimates of served batches alone."""
+    engine = F5Engine.__new__(F5Engine)
+    engine.config = types.SimpleNamespace(n_mels=4)
+    engine.max_sequence_length = 8
+    engine.bucket_secs = {}
+    engine.last_finished = 0.0
+
+    def dispatch_batch(chunks, *key, weights=None):
+      audio = np.zeros((len(chunks), 8 * 256), dtype=np.float32)
+      durations = np.array([chunk.duration for chunk in chunks])
+      return PendingBatch(chunks, 1, durations, audio, 1.0, guidance_cost=1.0, dispatched_at=0.0)
+
+    engine.dispatch_batch = dispatch_batch
+    engine.canary("weights")
+    assert engine.bucket_secs == {} and engine.last_finished == 0.0
+    engine.run_batch([engine._dummy_chunk()])
+    assert set(engine.bucket_secs) == {1} and engine.last_finished > 0.0
+
+  def test_admission(self):
+    """Requests are admitted, degraded, delayed or rejected against the target of their class."""
+    server, _ = self._server(1, {"slow": 10000, "fast": 1500})
+    batcher = server.batchers[0]
+    request = SynthesisRequest("a", "b", np.zeros(1))
+    assert server.priority_ranks == {"fast": 0, "slow": 1}
+
+    async def admit(queued_fast, queued_slow):
+      batcher.pending.clear()
+      batcher.submit(request, [0] * queued_fast, rank=0)
+      batcher.submit(request, [0] * queued_slow, rank=1)
+      queued, rank, admission = server.admit(batcher, request, "fast", 4, elapsed_secs=0.0)
+      return batch_key(queued)[3], rank, admission
+
+    # One batch of its own, the slow chunks wait.
+    assert asyncio.run(admit(0, 8)) == (1, 0, "admitted")
+    # A full batch ahead, fits with the unconditional prediction reused every other evaluation.
+    assert asyncio.run(admit(4, 0)) == (2, 0, "degraded")
+    # Two batches ahead, the cheapest guidance ranks after all classes, within twice the target.
+    assert asyncio.run(admit(8, 0)) == (8, 2, "delayed")
+    with self.assertRaises(HttpError):
+      asyncio.run(admit(8, 4))
+
+  def test_result_cache(self):
+    """Both levels evict the least recently used entries, the disk level survives a restart."""
+    with tempfile.TemporaryDirectory() as disk_dir:
+      cache = ResultCache(memory_bytes=8, disk_dir=disk_dir, disk_bytes=12)
+      for key in ("a", "b"):
+        cache.put(key, key.encode() * 4)
+      assert cache.get("a") == b"aaaa"
+      cache.put("c", b"cccc")
+      assert list(cache.memory) == ["a", "c"]
+      cache.put("d", b"dddd")
+      assert list(cache.disk) == ["a", "c", "d"]
+      restarted = ResultCache(memory_bytes=0, disk_dir=disk_dir, disk_bytes=12)
+      assert restarted.get("c") == b"cccc" and restarted.get("b") is None
+      assert (restarted.hits, restarted.misses) == (1, 1)
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -0,0 +1,209 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+import types
+import unittest
+from absl.testing import absltest
+import jax
+import jax.numpy as jnp
+from jax.sharding import Mesh, NamedSharding, PartitionSpec as P
+import numpy as np
+from ..checkpointing.checkpointing_utils import check_f5_sampling_config
+from ..input_pipeline._grain_data_processing import (
+    PackedF5BatchSource,
+    ParseF5Features,
+    plan_f5_batches,
+    serialize_f5_example,
+)
+from ..train_utils import ema_update
+from ..trainers.f5_distill_trainer import distills_guidance, sway_timesteps
+from ..trainers.f5_trainer import F5Trainer, span_mask
+
+N_MELS = 4
+
+
+class _Records:
+  """Stands in for the ArrayRecordDataSource with serialized mel/text records."""
+
+  def __init__(self, lengths):
+    self.lengths = lengths
+
+  def __len__(self):
+    return len(self.lengths)
+
+  def __getitem__(self, index):
+    length = self.lengths[index]
+    return serialize_f5_example(np.full((length, N_MELS), length, dtype=np.float32), np.arange(1, length // 2 + 1, dtype=np.int32))
+
+
+def _toy_train_step(dit_state, text_encoder_state, dit_ema, batch, train_rng, pipeline, config, state_shardings):
+  dit_state = jax.tree_util.tree_map(lambda w: w + jnp.mean(batch["mel"]), dit_state)
+  if dit_ema is not None:
+    dit_ema = ema_update(dit_ema, dit_state, 0.9)
+  return dit_state, text_encoder_state, dit_ema, {"loss": jnp.mean(batch["mel"])}, train_rng
+
+
+class _ToyF5Trainer(F5Trainer):
+  """F5Trainer compiling `_toy_train_step` on a one axis mesh, without a checkpointer."""
+
+  def __init__(self, config):
+    self.config = config
+    self.mesh = Mesh(np.array(jax.devices()), ("data",))
+    self.rng = jax.random.key(0)
+    self.length_buckets = sorted(config.f5_length_buckets)
+
+  def train_step_fn(self):
+    return _toy_train_step
+
+
+class F5TrainerTest(unittest.TestCase):
+  """Test F5 packing and flow matching masks"""
+
+  def test_plan_batches(self):
+    """Every batch has a fixed row count of one bucket and stays under the frame budget."""
+    frames = np.random.default_rng(0).integers(5, 130, size=500)
+    rows_per_batch = {64: 4, 128: 2}
+    batches = plan_f5_batches(frames, rows_per_batch, max_segments_per_row=3, seed=1)
+    assert batches == plan_f5_batches(frames, rows_per_batch, max_segments_per_row=3, seed=1)
+    assert {length for length, _ in batches} == {64, 128}
+    seen = set()
+    for length, rows in batches:
+      assert len(rows) == rows_per_batch[length]
+      for row in rows:
+        assert 1 <= len(row) <= 3
+        assert frames[row].sum() <= length
+        # in the smallest bucket that holds it
+        assert all(frames[i] > 64 for i in row) or length == 64
+        seen.update(row)
+    assert len(seen) == sum(len(row) for _, rows in batches for row in rows)
+
+  def test_packed_batch_source(self):
+    """Hosts read disjoint rows, utterances are packed with restarting positions."""
+    lengths = [10, 20, 50, 12, 60, 30, 25, 8]
+    batches = [(64, [[0, 1, 3], [2, 7], [4], [5, 6]])]
+    for host_index in range(2):
+      batch = PackedF5BatchSource(_Records(lengths), batches, host_index, {64: 2}, N_MELS)[0]
+      assert batch["mel"].shape == (2, 64, N_MELS)
+      for row, record_indices in enumerate(batches[0][1][host_index * 2 : host_index * 2 + 2]):
+        segment_ids = batch["decoder_segment_ids"][row]
+        assert segment_ids.max() == len(record_indices)
+        for segment_id, record_index in enumerate(record_indices, start=1):
+          frames = segment_ids == segment_id
+          length = lengths[record_index]
+          assert int(frames.sum()) == length
+          np.testing.assert_array_equal(batch["decoder_positions"][row][frames], np.arange(length))
+          np.testing.assert_array_equal(batch["mel"][row][frames], length)
+          np.testing.assert_array_equal(batch["text_ids"][row][frames][: length // 2], np.arange(1, length // 2 + 1))
+        assert not batch["mel"][row][segment_ids == 0].any()
+
+  def test_parse_features(self):
+    """Records written by preprocess_f5 round trip without TensorFlow."""
+    mel = np.random.randn(37, N_MELS).astype(np.float32)
+    text_ids = np.arange(1, 12, dtype=np.int32)
+    features = ParseF5Features().map(serialize_f5_example(mel, text_ids))
+    np.testing.assert_array_equal(features["mel"], mel)
+    np.testing.assert_array_equal(features["text_ids"], text_ids)
+
+  def test_span_mask(self):
+    """One span of the configured fraction per segment, never on padding."""
+    decoder_segment_ids = jnp.array([[1] * 40 + [2] * 20 + [0] * 4, [1] * 64])
+    decoder_positions = jnp.array([list(range(40)) + list(range(20)) + [0] * 4, list(range(64))])
+    mask = span_mask(jax.random.PRNGKey(0), decoder_segment_ids, decoder_positions, 0.7, 1.0, max_segments=4)
+    assert not mask[0, 60:].any()
+    for row, segment_id, length in [(0, 1, 40), (0, 2, 20), (1, 1, 64)]:
+      segment_mask = np.asarray(mask[row][decoder_segment_ids[row] == segment_id])
+      masked = np.flatnonzero(segment_mask)
+      assert int(0.7 * length) - 1 <= len(masked) <= length
+      # contiguous span
+      assert masked[-1] - masked[0] + 1 == len(masked)
+
+
+  def test_ema_update(self):
+    """The EMA keeps its float32 dtype and moves towards the bfloat16 params."""
+    ema = {"kernel": jnp.zeros((4,), dtype=jnp.float32)}
+    params = {"kernel": jnp.ones((4,), dtype=jnp.bfloat16)}
+    for _ in range(3):
+      ema = ema_update(ema, params, 0.9)
+    assert ema["kernel"].dtype == jnp.float32
+    np.testing.assert_allclose(ema["kernel"], 1 - 0.9**3, rtol=1e-6)
+
+  def test_compile_train_step_skipping_ema(self):
+    """With ema_update_every > 1 both the EMA and the no EMA steps compile and run."""
+    config = types.SimpleNamespace(
+        logical_axis_rules=(),
+        ema_update_every=2,
+        f5_length_buckets=[8],
+        f5_frames_per_device=16,
+        data_sharding=("data",),
+    )
+    trainer = _ToyF5Trainer(config)
+    pipeline = types.SimpleNamespace(transformer=types.SimpleNamespace(mel_dim=N_MELS))
+    train_states = {
+        "dit_state": {"kernel": jnp.zeros((4,))},
+        "text_encoder_state": {"kernel": jnp.zeros((4,))},
+        "dit_ema": {"kernel": jnp.zeros((4,))},
+    }
+    replicated = NamedSharding(trainer.mesh, P())
+    state_shardings = {
+        "dit_state_shardings": {"kernel": replicated},
+        "text_encoder_state_shardings": {"kernel": replicated},
+        "dit_ema_shardings": {"kernel": replicated},
+    }
+    p_train_steps = trainer.compile_train_step(
+        pipeline, None, train_states, state_shardings, trainer.get_data_shardings()
+    )
+    assert set(p_train_steps) == {(8, True), (8, False)}
+
+    batch = jax.tree_util.tree_map(
+        lambda x: jnp.ones(x.shape, x.dtype), trainer.get_shaped_batch(config, pipeline, 8)
+    )
+    dit_state, _, dit_ema, _, _ = p_train_steps[(8, False)](
+        train_states["dit_state"], train_states["text_encoder_state"], None, batch, jax.random.key(1)
+    )
+    assert dit_ema is None
+    np.testing.assert_allclose(dit_state["kernel"], 1.0)
+
+  def test_distill_grids(self):
+    """Every student time is a teacher time and the grids span the whole path."""
+    teacher_ts = sway_timesteps(32, -1.0)
+    student_ts = sway_timesteps(8, -1.0)
+    np.testing.assert_allclose(teacher_ts[::4], student_ts, atol=1e-6)
+    np.testing.assert_allclose(student_ts[jnp.array([0, -1])], [0.0, 1.0], atol=1e-6)
+    assert (np.diff(teacher_ts) > 0).all()
+
+  def test_distills_guidance(self):
+    """Only a teacher sampled with a nonzero guidance scale gives a guidance distilled student."""
+    config = types.SimpleNamespace(f5_distill_cfg_strength=2.0, f5_distill_cfg_strength_max=3.0)
+    assert distills_guidance(config, guidance_embeds=False)
+    assert distills_guidance(config, guidance_embeds=True)
+    config = types.SimpleNamespace(f5_distill_cfg_strength=0.0, f5_distill_cfg_strength_max=0.0)
+    assert not distills_guidance(config, guidance_embeds=False)
+    assert not distills_guidance(config, guidance_embeds=True)
+
+  def test_check_sampling_config(self):
+    """Step distilled checkpoints only sample on the grid they were distilled for."""
+    check_f5_sampling_config({}, 32, None)
+    check_f5_sampling_config({"num_inference_steps": None, "sway_sampling_coef": -1.0}, 16, None)
+    sampling_config = {"num_inference_steps": 8, "sway_sampling_coef": -1.0}
+    check_f5_sampling_config(sampling_config, 8, -1.0)
+    with self.assertRaises(ValueError):
+      check_f5_sampling_config(sampling_config, 32, -1.0)
+    with self.assertRaises(ValueError):
+      check_f5_sampling_config(sampling_config, 8, None)
+
+
+if __name__ == "__main__":
+  absltest.main()
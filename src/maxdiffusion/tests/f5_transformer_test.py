@@ -0,0 +1,199 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+import types
+import unittest
+from absl.testing import absltest
+import jax
+import jax.numpy as jnp
+import flax.linen as nn
+import numpy as np
+from ..models import quantizations
+from ..models.block_cache import block_cache_hit_rate, init_block_cache
+from ..models.f5.transformers.transformer_f5_flax import F5TextEmbedding, F5Transformer2DModel
+from ..models.modeling_flax_pytorch_utils import stack_f5_block_params, unstack_f5_block_params
+from ..quantize_f5 import aqt_logical_partition_specs
+
+DEPTH = 2
+
+
+def _small_f5(**kwargs):
+  return F5Transformer2DModel(
+      dim=64,
+      dim_head=32,
+      heads=2,
+      depth=DEPTH,
+      text_dim=32,
+      attention_kernel="dot_product",
+      **kwargs,
+  )
+
+
+def _inputs(batch=2, length=32):
+  key1, key2, key3 = jax.random.split(jax.random.PRNGKey(0), 3)
+  x = jax.random.normal(key1, (batch, length, 100))
+  cond = jax.random.normal(key2, (batch, length, 100))
+  text_embed = jax.random.normal(key3, (batch, length, 32))
+  decoder_segment_ids = jnp.ones((batch, length), dtype=jnp.int32).at[:, -4:].set(0)
+  timestep = jnp.full((batch,), 0.5)
+  return {
+      "x": x,
+      "cond": cond,
+      "text_embed": text_embed,
+      "timestep": timestep,
+      "decoder_segment_ids": decoder_segment_ids,
+  }
+
+
+class F5TransformerTest(unittest.TestCase):
+  """Test F5Transformer2DModel"""
+
+  def test_precomputed_rotary_matches(self):
+    """Passing precomputed rotary tables gives the same output as computing them inline."""
+    model = _small_f5()
+    inputs = _inputs()
+    params = model.init(jax.random.PRNGKey(1), **inputs)["params"]
+    out = model.apply({"params": params}, **inputs)
+    rotary_cos_sin = model.apply(
+        {"params": params},
+        inputs["x"].shape[1],
+        inputs["decoder_segment_ids"],
+        method=F5Transformer2DModel.rotary_cos_sin,
+    )
+    out_precomputed = model.apply({"params": params}, **inputs, rotary_cos_sin=rotary_cos_sin)
+    np.testing.assert_allclose(out, out_precomputed, atol=1e-5)
+
+  def test_scan_layers_matches_unrolled(self):
+    """Stacked params under scan_layers reproduce the unrolled model."""
+    inputs = _inputs()
+    model = _small_f5()
+    params = nn.unbox(model.init(jax.random.PRNGKey(1), **inputs)["params"])
+    out = model.apply({"params": params}, **inputs)
+
+    scanned_model = _small_f5(scan_layers=True, remat_policy="full")
+    scanned_params = stack_f5_block_params(params)
+    assert jax.tree_util.tree_structure(scanned_params) == jax.tree_util.tree_structure(
+        nn.unbox(jax.eval_shape(scanned_model.init, jax.random.PRNGKey(1), **inputs)["params"])
+    )
+    scanned_out = scanned_model.apply({"params": scanned_params}, **inputs)
+    np.testing.assert_allclose(out, scanned_out, atol=1e-4)
+
+    unstacked = unstack_f5_block_params(scanned_params)
+    assert jax.tree_util.tree_structure(unstacked) == jax.tree_util.tree_structure(params)
+
+  def test_remat_full_matches(self):
+    """remat_policy="full" leaves the output and the gradients unchanged."""
+    inputs = _inputs()
+    model = _small_f5()
+    params = nn.unbox(model.init(jax.random.PRNGKey(1), **inputs)["params"])
+    remat_model = _small_f5(remat_policy="full")
+
+    def loss(model, params):
+      return jnp.mean(model.apply({"params": params}, **inputs) ** 2)
+
+    np.testing.assert_allclose(loss(model, params), loss(remat_model, params), rtol=1e-5)
+    grads = jax.grad(lambda p: loss(model, p))(params)
+    remat_grads = jax.grad(lambda p: loss(remat_model, p))(params)
+    jax.tree_util.tree_map(lambda a, b: np.testing.assert_allclose(a, b, atol=1e-5), grads, remat_grads)
+
+  def test_packed_segments_dont_mix(self):
+    """With mask_conv_segments the first utterance of a packed row matches it run alone."""
+    inputs = _inputs()
+    model = _small_f5()
+    params = model.init(jax.random.PRNGKey(1), **inputs)["params"]
+    packed = jnp.ones((2, 32), dtype=jnp.int32).at[:, 20:].set(2)
+    alone = model.apply({"params": params}, **{**inputs, "decoder_segment_ids": packed.at[:, 20:].set(0)})
+    out = model.apply({"params": params}, **{**inputs, "decoder_segment_ids": packed}, mask_conv_segments=True)
+    np.testing.assert_allclose(out[:, :20], alone[:, :20], atol=1e-5)
+    # The convolutional position embedding reads the next utterance otherwise.
+    leaky = model.apply({"params": params}, **{**inputs, "decoder_segment_ids": packed})
+    assert not np.allclose(leaky[:, :20], alone[:, :20], atol=1e-5)
+
+    text_encoder = F5TextEmbedding(text_num_embeds=16, text_dim=32, conv_layers=2)
+    text = jax.random.randint(jax.random.PRNGKey(3), (2, 32), 1, 17)
+    text_params = text_encoder.init(jax.random.PRNGKey(4), text, jnp.ones_like(text))["params"]
+    text_alone = text.at[:, 20:].set(0)
+    embed_alone = text_encoder.apply({"params": text_params}, text_alone, (text_alone != 0).astype(jnp.int32))
+    embed = text_encoder.apply({"params": text_params}, text, jnp.ones_like(text), segment_ids=packed)
+    np.testing.assert_allclose(embed[:, :20], embed_alone[:, :20], atol=1e-5)
+
+  def test_guidance_embed(self):
+    """A zero output layer reproduces the model without guidance, the scale then changes the output."""
+    inputs = _inputs()
+    params = nn.unbox(_small_f5().init(jax.random.PRNGKey(1), **inputs)["params"])
+    out = _small_f5().apply({"params": params}, **inputs)
+
+    model = _small_f5(guidance_embeds=True)
+    guidance = jnp.full((inputs["x"].shape[0],), 2.0)
+    guidance_params = nn.unbox(model.init(jax.random.PRNGKey(2), **inputs, guidance=guidance)["params"])
+    guidance_embed = guidance_params["guidance_embed"]
+    guidance_embed["linear2"] = jax.tree_util.tree_map(jnp.zeros_like, guidance_embed["linear2"])
+    params = {**params, "guidance_embed": guidance_embed}
+    np.testing.assert_allclose(out, model.apply({"params": params}, **inputs, guidance=guidance), atol=1e-5)
+
+    # After training moves the output layer off zero.
+    guidance_embed["linear2"] = jax.tree_util.tree_map(lambda x: x + 0.1, guidance_embed["linear2"])
+    out_1 = model.apply({"params": params}, **inputs, guidance=jnp.ones_like(guidance))
+    out_2 = model.apply({"params": params}, **inputs, guidance=guidance)
+    assert not np.allclose(out_1, out_2)
+
+  def test_block_cache(self):
+    """A reused residual reproduces the uncached output on the same input, the schedule forces recomputes."""
+    inputs = _inputs()
+    model = _small_f5(block_cache_start=1)
+    params = nn.unbox(model.init(jax.random.PRNGKey(1), **inputs)["params"])
+    out = model.apply({"params": params}, **inputs)
+    block_cache = init_block_cache(inputs["x"].shape[:2] + (64,), dtype=jnp.float32, max_reuse=1)
+
+    out_1, block_cache = model.apply({"params": params}, **inputs, block_cache=block_cache)
+    out_2, block_cache = model.apply({"params": params}, **inputs, block_cache=block_cache)
+    np.testing.assert_allclose(out, out_1, atol=1e-5)
+    np.testing.assert_allclose(out, out_2, atol=1e-5)
+    assert int(block_cache["hits"]) == 1
+
+    # Reused once, the next call runs the blocks again.
+    later = {**inputs, "timestep": jnp.full_like(inputs["timestep"], 0.9)}
+    out_3, block_cache = model.apply({"params": params}, **later, block_cache=block_cache)
+    np.testing.assert_allclose(model.apply({"params": params}, **later), out_3, atol=1e-5)
+    np.testing.assert_allclose(block_cache_hit_rate(block_cache), 1 / 3, rtol=1e-6)
+
+  def test_int8_weight_only_serving(self):
+    """Convert -> serve keeps outputs close to the float model without float block kernels."""
+    inputs = _inputs()
+    model = _small_f5()
+    params = nn.unbox(model.init(jax.random.PRNGKey(1), **inputs)["params"])
+    out = model.apply({"params": params}, **inputs)
+
+    config = types.SimpleNamespace(quantization="int8w", quantization_local_shard_count=-1, replicate_quant_scale=False)
+    convert_model = _small_f5(quant=quantizations.configure_quantization(config, "convert"))
+    _, variables = convert_model.apply({"params": params}, **inputs, mutable=["aqt"])
+    serve_model = _small_f5(quant=quantizations.configure_quantization(config, "serve"))
+    serve_params = nn.unbox(jax.eval_shape(serve_model.init, jax.random.PRNGKey(1), **inputs)["params"])
+    assert "kernel" not in serve_params["blocks_0"]["attn"]["to_q"]
+    assert "kernel" not in serve_params["blocks_0"]["ff"]["layers_0"]
+
+    serve_out = serve_model.apply({"params": params, "aqt": variables["aqt"]}, **inputs)
+    assert jnp.linalg.norm(out - serve_out) / jnp.linalg.norm(out) < 0.05
+
+    config = types.SimpleNamespace(seed=0, max_sequence_length=32, replicate_quant_scale=False)
+    specs = aqt_logical_partition_specs(convert_model, variables["aqt"], config)
+    to_q = specs["blocks_0"]["attn"]["to_q"]["AqtDotGeneral_0"]["qrhs"]
+    self.assertEqual(to_q["value"], jax.sharding.PartitionSpec("embed", "heads"))
+    self.assertEqual(to_q["scale"], jax.sharding.PartitionSpec(None, None, "heads"))
+
+
+if __name__ == "__main__":
+  absltest.main()
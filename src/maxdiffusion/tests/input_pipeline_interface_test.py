@@ -31,6 +31,8 @@ from jax.sharding import Mesh
 
 from .. import pyconfig
 from .. import max_utils
+from .. import multihost_dataloading
+from ..input_pipeline._grain_data_processing import ParseFeatures, serialize_example
 from maxdiffusion.input_pipeline.input_pipeline_interface import (
     make_data_iterator,
     make_dreambooth_train_iterator,
@@ -572,6 +574,44 @@ class InputPipelineInterface(unittest.TestCase):
     assert base_image.shape == test_image.shape
     assert ssim_compare >= 0.70
 
+  def test_latent_cache_record_round_trip(self):
+    """Records written by cache_latents parse into the grain batch layout."""
+    moments = np.random.randn(8, 8, 8).astype(np.float32)
+    clip_embeddings = np.random.randn(77, 1024).astype(np.float32)
+    features = ParseFeatures().map(serialize_example(moments, clip_embeddings))
+    np.testing.assert_array_equal(features["pixel_values"], moments)
+    np.testing.assert_array_equal(features["input_ids"], clip_embeddings)
+
+  def test_prefetch_resumes_after_last_returned_batch(self):
+    """Reading the local iterator for checkpointing drops prefetched batches and rewinds."""
+
+    class StatefulIterator:
+
+      def __init__(self):
+        self.step = 0
+
+      def __iter__(self):
+        return self
+
+      def __next__(self):
+        self.step += 1
+        return {"x": np.full((jax.local_device_count(), 2), self.step, dtype=np.int32)}
+
+      def get_state(self):
+        return self.step
+
+      def set_state(self, state):
+        self.step = state
+
+    mesh = Mesh(np.array(jax.devices()), ("data",))
+    data_iter = multihost_dataloading.MultiHostDataLoadIterator([], mesh, prefetch_depth=3)
+    data_iter.local_iterator = StatefulIterator()
+    assert int(next(data_iter)["x"][0, 0]) == 1
+    assert int(next(data_iter)["x"][0, 0]) == 2
+    assert data_iter.local_iterator.get_state() == 2
+    assert int(next(data_iter)["x"][0, 0]) == 3
+    assert data_iter.pop_stall_seconds() >= 0
+    assert data_iter.stall_seconds == 0
 
 if __name__ == "__main__":
   absltest.main()
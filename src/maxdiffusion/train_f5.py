@@ -32,6 +32,8 @@ from maxdiffusion.train_utils import (
 
 
 def train(config):
+  if config.f5_guidance_embeds:
+    raise ValueError("f5_guidance_embeds models are trained with train_f5_distill.py.")
   trainer = F5Trainer(config)
   trainer.start_training()
 
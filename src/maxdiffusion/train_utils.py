@@ -61,14 +61,24 @@ def validate_train_config(config):
     )
 
 
-def record_scalar_metrics(metrics, step_time_delta, per_device_tflops, lr):
+def record_scalar_metrics(metrics, step_time_delta, per_device_tflops, lr, peak_per_device_tflops=0):
   """Records scalar metrics to be written to tensorboard"""
   metrics["scalar"].update({"perf/step_time_seconds": step_time_delta.total_seconds()})
   metrics["scalar"].update({"perf/per_device_tflops": per_device_tflops})
   metrics["scalar"].update({"perf/per_device_tflops_per_sec": per_device_tflops / step_time_delta.total_seconds()})
+  if peak_per_device_tflops > 0:
+    metrics["scalar"].update(
+        {"perf/mfu": per_device_tflops / step_time_delta.total_seconds() / peak_per_device_tflops}
+    )
   metrics["scalar"].update({"learning/current_learning_rate": lr})
 
 
+def record_data_stall_metrics(metrics, train_iter):
+  """Records the time spent waiting on the input pipeline since the last step"""
+  if hasattr(train_iter, "pop_stall_seconds"):
+    metrics["scalar"].update({"perf/data_stall_seconds": train_iter.pop_stall_seconds()})
+
+
 _buffered_step = None
 _buffered_metrics = None
 
@@ -115,12 +125,23 @@ def write_metrics_to_tensorboard(writer, metrics, step, config):
           f"TFLOP/s/device: {metrics['scalar']['perf/per_device_tflops_per_sec']:.3f}, "
           f"loss: {metrics['scalar']['learning/loss']:.3f}"
       )
+      if "perf/checkpoint_blocking_seconds" in metrics["scalar"]:
+        max_logging.log(f"checkpoint save blocked the train loop for {metrics['scalar']['perf/checkpoint_blocking_seconds']:.3f}s")
+      if "perf/checkpoint_save_seconds" in metrics["scalar"]:
+        max_logging.log(f"checkpoint written in the background in {metrics['scalar']['perf/checkpoint_save_seconds']:.3f}s")
 
     if full_log and jax.process_index() == 0:
       max_logging.log(f"To see full metrics 'tensorboard --logdir={config.tensorboard_dir}'")
       writer.flush()
 
 
+def ema_update(ema_params, params, decay):
+  """One exponential moving average step, kept in the dtype of `ema_params`"""
+  return jax.tree_util.tree_map(
+      lambda ema, param: (decay * ema + (1.0 - decay) * param.astype(ema.dtype)).astype(ema.dtype), ema_params, params
+  )
+
+
 def get_params_to_save(params):
   """Retrieves params from host"""
   return jax.device_get(jax.tree_util.tree_map(lambda x: x, params))
@@ -15,8 +15,7 @@
  """
 
 from abc import abstractmethod
-import jax
-from maxdiffusion import (max_utils, maxdiffusion_utils, max_logging)
+from maxdiffusion import max_utils
 
 from maxdiffusion.checkpointing.base_f5_checkpointer import (BaseF5Checkpointer)
 
@@ -36,7 +35,7 @@ class BaseF5Trainer(BaseF5Checkpointer):
     self.p_train_step = None
 
   @abstractmethod
-  def get_shaped_batch(self, config, pipeline):
+  def get_shaped_batch(self, config, pipeline, length_bucket):
     pass
 
   @abstractmethod
@@ -56,7 +55,7 @@ class BaseF5Trainer(BaseF5Checkpointer):
     pass
 
   @abstractmethod
-  def training_loop(self, p_train_step, pipeline, params, train_states, data_iterator, unet_learning_rate_scheduler):
+  def training_loop(self, p_train_step, pipeline, params, train_states, data_iterator, dit_learning_rate_scheduler):
     pass
 
   @abstractmethod
@@ -64,15 +63,8 @@ class BaseF5Trainer(BaseF5Checkpointer):
     pass
 
   @abstractmethod
-  def create_scheduler(self, pipeline, params):
-    pass
-
   def calculate_tflops(self, pipeline, params):
-    per_device_tflops = maxdiffusion_utils.calculate_unet_tflops(
-        self.config, pipeline, (self.config.per_device_batch_size * jax.local_device_count()), self.rng, train=True
-    )
-    max_logging.log(f"UNET per device TFLOPS: {per_device_tflops}")
-    return per_device_tflops
+    pass
 
   def start_training(self):
 
@@ -84,10 +76,9 @@ class BaseF5Trainer(BaseF5Checkpointer):
     train_states = {}
     state_shardings = {}
     dit_state, dit_state_mesh_shardings, dit_learning_rate_scheduler = self.create_dit_state(
-        # ambiguous here, but if self.params.get("unet") doesn't exist
-        # Then its 1 of 2 scenarios:
-        # 1. unet state will be loaded directly from orbax
-        # 2. a new unet is being trained from scratch.
+        # If params has no "transformer" entry then either:
+        # 1. dit state will be loaded directly from orbax
+        # 2. a new dit is being trained from scratch.
         pipeline=pipeline,
         params=params,
         checkpoint_item_name="dit_state",
@@ -95,12 +86,10 @@ class BaseF5Trainer(BaseF5Checkpointer):
     )
     train_states["dit_state"] = dit_state
     state_shardings["dit_state_shardings"] = dit_state_mesh_shardings
-    # vae_state, vae_state_mesh_shardings = self.create_vae_state(
-    #     pipeline=pipeline, params=params, checkpoint_item_name="vae_state", is_training=False
-    # )
 
-    # train_states["vae_state"] = vae_state
-    # state_shardings["vae_state_shardings"] = vae_state_mesh_shardings
+    dit_ema, dit_ema_shardings = self.create_dit_ema(dit_state, dit_state_mesh_shardings, checkpoint_item_name="dit_ema")
+    train_states["dit_ema"] = dit_ema
+    state_shardings["dit_ema_shardings"] = dit_ema_shardings
 
     text_encoder_state, text_encoder_state_mesh_shardings = self.create_text_encoder_state(
         pipeline=pipeline,
@@ -110,17 +99,8 @@ class BaseF5Trainer(BaseF5Checkpointer):
     )
     train_states["text_encoder_state"] = text_encoder_state
     state_shardings["text_encoder_state_shardings"] = text_encoder_state_mesh_shardings
-    # if hasattr(pipeline, "text_encoder_2"):
-    #   text_encoder_2_state, text_encoder_2_state_mesh_shardings = self.create_text_encoder_2_state(
-    #       pipeline, params, "text_encoder_2_state", is_training=self.config.train_text_encoder
-    #   )
-    #   train_states["text_encoder_2_state"] = text_encoder_2_state
-    #   state_shardings["text_encoder_2_state_shardings"] = text_encoder_2_state_mesh_shardings
-
-    # Create scheduler
-    noise_scheduler, noise_scheduler_state = self.create_scheduler(pipeline, params)
-    pipeline.scheduler = noise_scheduler
-    params["scheduler"] = noise_scheduler_state
+
+    # Flow matching samples timesteps directly, there is no noise scheduler to create.
 
     # Calculate tflops
     per_device_tflops = self.calculate_tflops(pipeline, params)
@@ -136,7 +116,7 @@ class BaseF5Trainer(BaseF5Checkpointer):
     p_train_step = self.compile_train_step(pipeline, params, train_states, state_shardings, data_shardings)
     # Start training
     train_states = self.training_loop(
-        p_train_step, pipeline, params, train_states, data_iterator, unet_learning_rate_scheduler
+        p_train_step, pipeline, params, train_states, data_iterator, dit_learning_rate_scheduler
     )
     # 6. save final checkpoint
     # Hook
@@ -168,7 +168,7 @@ class DreamboothTrainer(BaseStableDiffusionTrainer):
     self.rng, train_rngs = jax.random.split(self.rng)
     with self.mesh, nn_partitioning.axis_rules(self.config.logical_axis_rules):
       p_train_step = jax.jit(
-          partial(_train_step, config=self.config, pipeline=pipeline, params=params),
+          partial(_train_step, config=self.config, pipeline=pipeline, params=params, state_shardings=state_shardings),
           in_shardings=(state_shardings["unet_state_shardings"], None, data_shardings, None),
           out_shardings=(state_shardings["unet_state_shardings"], None, None, None),
           donate_argnums=(0,),
@@ -226,6 +226,8 @@ class DreamboothTrainer(BaseStableDiffusionTrainer):
       train_utils.record_scalar_metrics(
           train_metric, new_time - last_step_completion, self.per_device_tflops, learning_rate_scheduler(step)
       )
+      train_utils.record_data_stall_metrics(train_metric, data_iterator)
+      self.checkpoint_save_timer.record_metrics(train_metric)
       if self.config.write_metrics:
         train_utils.write_metrics(writer, local_metrics_file, running_gcs_metrics, train_metric, step, self.config)
       last_step_completion = new_time
@@ -237,7 +239,7 @@ class DreamboothTrainer(BaseStableDiffusionTrainer):
       if step != 0 and self.config.checkpoint_every != -1 and samples_count % self.config.checkpoint_every == 0:
         train_states["unet_state"] = unet_state
         train_states["text_encoder_state"] = text_encoder_state
-        self.save_checkpoint(step, pipeline, params, train_states)
+        last_step_completion = self.save_checkpoint(step, pipeline, params, train_states)
 
     if self.config.write_metrics:
       train_utils.write_metrics(writer, local_metrics_file, running_gcs_metrics, train_metric, step, self.config)
@@ -249,7 +251,7 @@ class DreamboothTrainer(BaseStableDiffusionTrainer):
     return train_states
 
 
-def _train_step(unet_state, text_encoder_state, batch, train_rng, config, pipeline, params):
+def _train_step(unet_state, text_encoder_state, batch, train_rng, config, pipeline, params, state_shardings):
   _, gen_dummy_rng = jax.random.split(train_rng)
   sample_rng, timestep_bias_rng, new_train_rng = jax.random.split(gen_dummy_rng, 3)
   instance_batch = batch[0]
@@ -326,6 +328,8 @@ def _train_step(unet_state, text_encoder_state, batch, train_rng, config, pipeli
   if config.max_grad_norm > 0:
     grad, _ = optax.clip_by_global_norm(config.max_grad_norm).update(grad, unet_state, None)
 
+  if config.offload_opt_state_to_host:
+    unet_state = max_utils.opt_state_to_device(unet_state, state_shardings["unet_state_shardings"])
   new_unet_state = unet_state.apply_gradients(grads=grad["unet"])
 
   if config.train_text_encoder:
@@ -0,0 +1,255 @@
+"""
+ Copyright 2025 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+import jax
+import jax.numpy as jnp
+import optax
+import orbax.checkpoint as ocp
+from maxdiffusion import max_utils, max_logging, train_utils
+from maxdiffusion.checkpointing.checkpointing_utils import load_f5_params
+from maxdiffusion.models.f5.transformers.transformer_f5_flax import F5Transformer2DModel
+from maxdiffusion.trainers.f5_trainer import F5Trainer, span_mask
+
+
+def sway_timesteps(num_steps, sway_sampling_coef):
+  """The `num_steps + 1` sampling times of generate_f5, sway sampled."""
+  timesteps = jnp.linspace(0.0, 1.0, num_steps + 1, dtype=jnp.float32)
+  return timesteps + sway_sampling_coef * (jnp.cos(jnp.pi / 2 * timesteps) - 1 + timesteps)
+
+
+def distills_guidance(config, guidance_embeds):
+  """Whether the student learns a guided velocity, so sampling can skip the unconditional pass.
+
+  A zero guidance scale makes the teacher's target its plain conditional velocity.
+  """
+  if guidance_embeds:
+    return config.f5_distill_cfg_strength_max > 0
+  return config.f5_distill_cfg_strength != 0
+
+
+class F5DistillTrainer(F5Trainer):
+  """Step and guidance distillation of a frozen F5 teacher into a few step student.
+
+  The teacher samples with classifier-free guidance at `f5_distill_cfg_strength` on a
+  `f5_distill_teacher_steps` grid. The student, initialized like train_f5.py, learns to
+  cover each interval of the coarser `f5_distill_student_steps` grid in one conditional
+  pass, matching the teacher's guided trajectory over it. Sway sampling maps both uniform
+  grids through the same function, so every student time is also a teacher time.
+
+  With `f5_distill_student_steps: 0` only the guidance is distilled: timesteps are drawn
+  uniformly and the student matches the teacher's guided velocity, for sampling at any
+  number of steps. With `f5_guidance_embeds` the student is conditioned on the guidance
+  scale, drawn per row from `f5_distill_cfg_strength_min`..`f5_distill_cfg_strength_max`.
+
+  Checkpoints are train_f5.py checkpoints plus an `f5_sampling` item that tells the F5
+  entry points to drop the unconditional pass.
+  """
+
+  def __init__(self, config):
+    F5Trainer.__init__(self, config)
+    if config.f5_distill_student_steps and config.f5_distill_teacher_steps % config.f5_distill_student_steps != 0:
+      raise ValueError(
+          f"f5_distill_teacher_steps ({config.f5_distill_teacher_steps}) must be a multiple of "
+          f"f5_distill_student_steps ({config.f5_distill_student_steps})."
+      )
+
+  def train_step_fn(self):
+    return _distill_train_step
+
+  def frozen_train_step_inputs(self, pipeline, train_states, state_shardings):
+    """The teacher's transformer and text embedding params, laid out like the student's."""
+    teacher_path = self.config.f5_teacher_model_name_or_path or self.config.pretrained_model_name_or_path
+    max_logging.log(f"Loading F5 teacher from {teacher_path}")
+    teacher_params = load_f5_params(teacher_path, use_ema=self.config.use_ema, scan_layers=self.config.scan_layers)
+    teacher_params = jax.tree_util.tree_map(lambda x: x.astype(self.config.weights_dtype), teacher_params)
+    # A teacher without guidance embedding has a subset of the student's params.
+    dit_shardings = state_shardings["dit_state_shardings"].params
+    teacher_shardings = (
+        {name: dit_shardings[name] for name in teacher_params[0]},
+        state_shardings["text_encoder_state_shardings"].params,
+    )
+    return (jax.device_put(teacher_params, teacher_shardings),), (teacher_shardings,)
+
+  def checkpoint_items(self, pipeline, train_states, data_iterator):
+    items = F5Trainer.checkpoint_items(self, pipeline, train_states, data_iterator)
+    items["f5_sampling"] = ocp.args.JsonSave(
+        {
+            "guidance_distilled": distills_guidance(self.config, pipeline.transformer.guidance_embeds),
+            "num_inference_steps": self.config.f5_distill_student_steps or None,
+            "sway_sampling_coef": self.config.sway_sampling_coef,
+        }
+    )
+    return items
+
+
+def _distill_train_step(
+    dit_state, text_encoder_state, dit_ema, batch, train_rng, teacher_params, pipeline, config, state_shardings
+):
+  _, gen_dummy_rng = jax.random.split(train_rng)
+  noise_rng, timestep_rng, guidance_rng, mask_rng, new_train_rng = jax.random.split(gen_dummy_rng, 5)
+  teacher_dit_params, teacher_text_encoder_params = teacher_params
+  teacher = pipeline.transformer.clone(guidance_embeds="guidance_embed" in teacher_dit_params)
+
+  if config.train_text_encoder:
+    state_params = {"text_encoder": text_encoder_state.params, "dit": dit_state.params}
+  else:
+    state_params = {"dit": dit_state.params}
+
+  mel = batch["mel"]
+  text_ids = batch["text_ids"]
+  decoder_segment_ids = batch["decoder_segment_ids"]
+  decoder_positions = batch["decoder_positions"]
+  bsz = mel.shape[0]
+
+  loss_mask = span_mask(
+      mask_rng,
+      decoder_segment_ids,
+      decoder_positions,
+      config.f5_mask_frac_min,
+      config.f5_mask_frac_max,
+      config.f5_max_segments_per_row,
+  )
+  cond = jnp.where(loss_mask[..., jnp.newaxis], jnp.zeros_like(mel), mel)
+  text_decoder_segment_ids = (text_ids != 0).astype(jnp.int32)
+
+  if pipeline.transformer.guidance_embeds:
+    guidance = jax.random.uniform(
+        guidance_rng, (bsz,), minval=config.f5_distill_cfg_strength_min, maxval=config.f5_distill_cfg_strength_max
+    )
+  else:
+    guidance = jnp.full((bsz,), config.f5_distill_cfg_strength, dtype=jnp.float32)
+
+  # Every row starts at a random student time, on the same optimal transport path as train_f5.py.
+  if config.f5_distill_student_steps:
+    teacher_ts = sway_timesteps(config.f5_distill_teacher_steps, config.sway_sampling_coef)
+    substeps = config.f5_distill_teacher_steps // config.f5_distill_student_steps
+    start = jax.random.randint(timestep_rng, (bsz,), 0, config.f5_distill_student_steps) * substeps
+    t = teacher_ts[start]
+  else:
+    t = jax.random.uniform(timestep_rng, (bsz,), dtype=jnp.float32)
+  x0 = jax.random.normal(noise_rng, mel.shape, dtype=mel.dtype)
+  x_t = (1 - t[:, jnp.newaxis, jnp.newaxis]) * x0 + t[:, jnp.newaxis, jnp.newaxis] * mel
+
+  def embed_text(text_encoder_params, text_ids):
+    return pipeline.text_encoder.apply(
+        {"params": text_encoder_params},
+        text=text_ids,
+        text_decoder_segment_ids=text_decoder_segment_ids,
+        text_positions=decoder_positions,
+        segment_ids=decoder_segment_ids,
+    )
+
+  teacher_text_embed = embed_text(teacher_text_encoder_params, text_ids)
+  teacher_null_text_embed = embed_text(teacher_text_encoder_params, jnp.zeros_like(text_ids))
+  rotary_cos_sin = teacher.apply(
+      {"params": teacher_dit_params},
+      mel.shape[1],
+      decoder_segment_ids,
+      method=F5Transformer2DModel.rotary_cos_sin,
+  )
+
+  def teacher_velocity(x, t_curr):
+    """The guided velocity, as generate_f5 samples."""
+    if teacher.guidance_embeds:
+      return teacher.apply(
+          {"params": teacher_dit_params},
+          x=x,
+          cond=cond,
+          text_embed=teacher_text_embed,
+          timestep=t_curr,
+          decoder_segment_ids=decoder_segment_ids,
+          rotary_cos_sin=rotary_cos_sin,
+          guidance=guidance,
+          mask_conv_segments=True,
+      )
+    pred = teacher.apply(
+        {"params": teacher_dit_params},
+        x=x,
+        cond=cond,
+        text_embed=teacher_text_embed,
+        timestep=t_curr,
+        decoder_segment_ids=decoder_segment_ids,
+        rotary_cos_sin=rotary_cos_sin,
+        mask_conv_segments=True,
+    )
+    null_pred = teacher.apply(
+        {"params": teacher_dit_params},
+        x=x,
+        cond=jnp.zeros_like(cond),
+        text_embed=teacher_null_text_embed,
+        timestep=t_curr,
+        decoder_segment_ids=decoder_segment_ids,
+        rotary_cos_sin=rotary_cos_sin,
+        mask_conv_segments=True,
+    )
+    return pred + (pred - null_pred) * guidance[:, jnp.newaxis, jnp.newaxis]
+
+  if config.f5_distill_student_steps:
+
+    def teacher_step(substep, x):
+      t_curr = teacher_ts[start + substep]
+      t_prev = teacher_ts[start + substep + 1]
+      pred = teacher_velocity(x, t_curr)
+      return (x + (t_prev - t_curr)[:, jnp.newaxis, jnp.newaxis] * pred).astype(x.dtype)
+
+    # The velocity that takes one student Euler step to where the teacher's steps ended up.
+    x_next = jax.lax.fori_loop(0, substeps, teacher_step, x_t)
+    t_next = teacher_ts[start + substeps]
+    target = (x_next - x_t) / (t_next - t)[:, jnp.newaxis, jnp.newaxis]
+  else:
+    target = teacher_velocity(x_t, t)
+  target = jax.lax.stop_gradient(target.astype(jnp.float32))
+
+  def compute_loss(state_params):
+    text_embed = embed_text(state_params.get("text_encoder", text_encoder_state.params), text_ids)
+    model_pred = pipeline.transformer.apply(
+        {"params": state_params["dit"]},
+        x=x_t,
+        cond=cond,
+        text_embed=text_embed,
+        timestep=t,
+        decoder_segment_ids=decoder_segment_ids,
+        train=True,
+        guidance=guidance if pipeline.transformer.guidance_embeds else None,
+        mask_conv_segments=True,
+    )
+    loss = jnp.mean((target - model_pred.astype(jnp.float32)) ** 2, axis=-1)
+    return jnp.sum(loss * loss_mask) / jnp.maximum(jnp.sum(loss_mask), 1)
+
+  grad_fn = jax.value_and_grad(compute_loss)
+  loss, grad = grad_fn(state_params)
+
+  if config.max_grad_norm > 0:
+    grad, _ = optax.clip_by_global_norm(config.max_grad_norm).update(grad, optax.EmptyState())
+
+  if config.offload_opt_state_to_host:
+    dit_state = max_utils.opt_state_to_device(dit_state, state_shardings["dit_state_shardings"])
+  new_state = dit_state.apply_gradients(grads=grad["dit"])
+
+  if config.train_text_encoder:
+    new_text_encoder_state = text_encoder_state.apply_gradients(grads=grad["text_encoder"])
+  else:
+    new_text_encoder_state = text_encoder_state
+
+  new_dit_ema = None
+  if dit_ema is not None:
+    if config.ema_offload_to_host:
+      dit_ema = jax.device_put(dit_ema, max_utils.with_memory_kind(state_shardings["dit_ema_shardings"], "device"))
+    new_dit_ema = train_utils.ema_update(dit_ema, new_state.params, config.ema_decay**config.ema_update_every)
+
+  metrics = {"scalar": {"learning/loss": loss}, "scalars": {}}
+
+  return new_state, new_text_encoder_state, new_dit_ema, metrics, new_train_rng
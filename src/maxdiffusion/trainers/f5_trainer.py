@@ -25,148 +25,173 @@ import jax.numpy as jnp
 from jax.sharding import PartitionSpec as P
 from flax.linen import partitioning as nn_partitioning
 import optax
-from maxdiffusion.trainers.base_stable_diffusion_trainer import BaseStableDiffusionTrainer
+from maxdiffusion.trainers.base_f5_trainer import BaseF5Trainer
 
-from maxdiffusion import (FlaxDDPMScheduler, maxdiffusion_utils, train_utils, max_utils, max_logging)
+from maxdiffusion import (train_utils, max_utils, max_logging)
 
-from maxdiffusion.input_pipeline.input_pipeline_interface import (make_data_iterator)
-from maxdiffusion.models.vae_flax import FlaxDiagonalGaussianDistribution
+from maxdiffusion.input_pipeline.input_pipeline_interface import (make_f5_data_iterator)
 
-from maxdiffusion.checkpointing.base_stable_diffusion_checkpointer import (STABLE_DIFFUSION_CHECKPOINT)
+from maxdiffusion.checkpointing.checkpointing_utils import (F5_CHECKPOINT)
 
 
-class F5Trainer(BaseStableDiffusionTrainer):
+class F5Trainer(BaseF5Trainer):
+  """Conditional flow matching for F5Transformer2DModel on packed mel batches.
+
+  Batches come from `make_f5_data_iterator`: utterances packed into rows of one of
+  `f5_length_buckets` frames, `f5_frames_per_device // length` rows per device. A step is
+  compiled ahead of training for every bucket.
+  """
+
   checkpoint_manager: None
 
-  def __init__(self, config, checkpoint_type=STABLE_DIFFUSION_CHECKPOINT):
-    BaseStableDiffusionTrainer.__init__(self, config, checkpoint_type)
+  def __init__(self, config, checkpoint_type=F5_CHECKPOINT):
+    BaseF5Trainer.__init__(self, config, checkpoint_type)
+    self.length_buckets = sorted(config.f5_length_buckets)
 
   def pre_training_steps(self):
-    return super().pre_training_steps()
+    pass
 
   def post_training_steps(self, pipeline, params, train_states):
-    return super().post_training_steps(pipeline, params, train_states)
-
-  def get_shaped_batch(self, config, pipeline):
-    """Return the shape of the batch - this is what eval_shape would return for the
-    output of create_data_iterator_with_tokenizer, but eval_shape doesn't work, see b/306901078.
-    This function works with sd1.x and 2.x.
-    """
-    total_train_batch_size = self.total_train_batch_size
-    #dataset always grain
-
-    batch_image_shape = (
-        total_train_batch_size,
-        128,  #seq len
-        config.mel_bands , # mel bands
-    )
-    batch_ids_shape = (
-        total_train_batch_size,
-        128, # padded text seq len
-        pipeline.text_encoder.config.hidden_size, #text hidden size
-    )
-    input_ids_dtype = jnp.float32
+    pass
+
+  def rows_per_device(self, length_bucket):
+    return self.config.f5_frames_per_device // length_bucket
 
+  def get_shaped_batch(self, config, pipeline, length_bucket):
+    """Return the shape of a packed batch of `length_bucket` frames per row."""
+    rows = self.rows_per_device(length_bucket) * jax.device_count()
     shaped_batch = {}
-    shaped_batch["pixel_values"] = jax.ShapeDtypeStruct(batch_image_shape, jnp.float32)
-    shaped_batch["input_ids"] = jax.ShapeDtypeStruct(batch_ids_shape, input_ids_dtype)
+    shaped_batch["mel"] = jax.ShapeDtypeStruct((rows, length_bucket, pipeline.transformer.mel_dim), jnp.float32)
+    shaped_batch["text_ids"] = jax.ShapeDtypeStruct((rows, length_bucket), jnp.int32)
+    shaped_batch["decoder_segment_ids"] = jax.ShapeDtypeStruct((rows, length_bucket), jnp.int32)
+    shaped_batch["decoder_positions"] = jax.ShapeDtypeStruct((rows, length_bucket), jnp.int32)
     return shaped_batch
 
-  def create_scheduler(self, pipeline, params):
-    noise_scheduler, noise_scheduler_state = FlaxDDPMScheduler.from_pretrained(
-        self.config.pretrained_model_name_or_path, revision=self.config.revision, subfolder="scheduler", dtype=jnp.float32
-    )
-    return noise_scheduler, noise_scheduler_state
+  def calculate_tflops(self, pipeline, params):
+    """Per device training TFLOPs of the transformer for each length bucket."""
+    per_device_tflops = {}
+    with self.mesh, nn_partitioning.axis_rules(self.config.logical_axis_rules):
+      for length_bucket in self.length_buckets:
+        # local device count rows so attention's shard_map sees the per device batch.
+        batch_size = self.rows_per_device(length_bucket) * jax.local_device_count()
+        x = jnp.zeros((batch_size, length_bucket, pipeline.transformer.mel_dim), dtype=jnp.float32)
+        per_device_tflops[length_bucket] = (
+            max_utils.calculate_model_tflops(
+                pipeline.transformer,
+                self.rng,
+                train=True,
+                x=x,
+                cond=x,
+                text_embed=jnp.zeros((batch_size, length_bucket, pipeline.transformer.text_dim), dtype=jnp.float32),
+                timestep=jnp.zeros((batch_size,), dtype=jnp.float32),
+                decoder_segment_ids=jnp.ones((batch_size, length_bucket), dtype=jnp.int32),
+                guidance=jnp.zeros((batch_size,), dtype=jnp.float32) if pipeline.transformer.guidance_embeds else None,
+            )
+            / jax.local_device_count()
+        )
+        max_logging.log(f"F5 per device TFLOPS for {length_bucket} frame rows: {per_device_tflops[length_bucket]}")
+    return per_device_tflops
 
   def get_data_shardings(self):
     data_sharding = jax.sharding.NamedSharding(self.mesh, P(*self.config.data_sharding))
-    data_sharding = {"input_ids": data_sharding, "pixel_values": data_sharding}
+    data_sharding = {
+        "mel": data_sharding,
+        "text_ids": data_sharding,
+        "decoder_segment_ids": data_sharding,
+        "decoder_positions": data_sharding,
+    }
 
     return data_sharding
 
   def load_dataset(self, pipeline, params, train_states):
-    p_encode = None
-    p_vae_apply = None
-    rng = None
-    if self.config.dataset_type == "tf" and self.config.cache_latents_text_encoder_outputs:
-      p_encode = jax.jit(
-          partial(
-              maxdiffusion_utils.encode,
-              text_encoder=pipeline.text_encoder,
-              text_encoder_params=train_states["text_encoder_state"].params,
-          )
-      )
-      p_vae_apply = jax.jit(
-          partial(maxdiffusion_utils.vae_apply, vae=pipeline.vae, vae_params=train_states["vae_state"].params)
-      )
-      rng = self.rng
-
-    tokenize_fn = partial(
-        maxdiffusion_utils.tokenize_captions,
-        caption_column=self.config.caption_column,
-        tokenizer=pipeline.tokenizer,
-        p_encode=p_encode,
-    )
-    image_transforms_fn = partial(
-        maxdiffusion_utils.transform_images,
-        image_column=self.config.image_column,
-        image_resolution=self.config.resolution,
-        rng=rng,
-        global_batch_size=self.total_train_batch_size,
-        p_vae_apply=p_vae_apply,
-    )
-    data_iterator = make_data_iterator(
+    return make_f5_data_iterator(
         self.config,
         jax.process_index(),
         jax.process_count(),
         self.mesh,
-        self.total_train_batch_size,
-        tokenize_fn=tokenize_fn,
-        image_transforms_fn=image_transforms_fn,
     )
-    return data_iterator
+
+  def train_step_fn(self):
+    return _train_step
+
+  def frozen_train_step_inputs(self, pipeline, train_states, state_shardings):
+    """(values, shardings) of read-only inputs passed to the train step after the rng."""
+    return (), ()
 
   def compile_train_step(self, pipeline, params, train_states, state_shardings, data_shardings):
+    """Returns a dict of compiled train steps keyed by (length bucket, whether the step updates the EMA)."""
     self.rng, train_rngs = jax.random.split(self.rng)
-    with self.mesh, nn_partitioning.axis_rules(self.config.logical_axis_rules):
-      p_train_step = jax.jit(
-          partial(_train_step, pipeline=pipeline, params=params, config=self.config),
+    frozen_inputs, frozen_input_shardings = self.frozen_train_step_inputs(pipeline, train_states, state_shardings)
+
+    def jit_train_step(ema_shardings):
+      return jax.jit(
+          partial(self.train_step_fn(), pipeline=pipeline, config=self.config, state_shardings=state_shardings),
           in_shardings=(
-              state_shardings["unet_state_shardings"],
-              state_shardings["vae_state_shardings"],
-              None,
+              state_shardings["dit_state_shardings"],
+              state_shardings["text_encoder_state_shardings"],
+              ema_shardings,
               data_shardings,
               None,
+              *frozen_input_shardings,
           ),
-          out_shardings=(state_shardings["unet_state_shardings"], None, None, None),
-          donate_argnums=(0,),
-      )
-      max_logging.log("Precompiling...")
-      s = time.time()
-      dummy_batch = self.get_shaped_batch(self.config, pipeline)
-      p_train_step = p_train_step.lower(
-          train_states["unet_state"], train_states["vae_state"], train_states["text_encoder_state"], dummy_batch, train_rngs
+          out_shardings=(
+              state_shardings["dit_state_shardings"],
+              state_shardings["text_encoder_state_shardings"],
+              ema_shardings,
+              None,
+              None,
+          ),
+          donate_argnums=(0, 1, 2),
       )
-      p_train_step = p_train_step.compile()
-      max_logging.log(f"Compile time: {(time.time() - s )}")
-      return p_train_step
-
-  def training_loop(self, p_train_step, pipeline, params, train_states, data_iterator, unet_learning_rate_scheduler):
-    writer = max_utils.initialize_summary_writer(self.config)
-    unet_state = train_states["unet_state"]
-    vae_state = train_states["vae_state"]
+
+    with self.mesh, nn_partitioning.axis_rules(self.config.logical_axis_rules):
+      # Steps that skip the EMA update don't take it, so it is neither read nor copied. They get
+      # their own jit with no EMA shardings, the EMA argument being None.
+      ema_variants = []
+      if train_states["dit_ema"] is not None:
+        ema_variants.append(True)
+      if train_states["dit_ema"] is None or self.config.ema_update_every > 1:
+        ema_variants.append(False)
+      p_train_step = {
+          update_ema: jit_train_step(state_shardings["dit_ema_shardings"] if update_ema else None)
+          for update_ema in ema_variants
+      }
+      p_train_steps = {}
+      for length_bucket in self.length_buckets:
+        for update_ema in ema_variants:
+          max_logging.log(f"Precompiling {length_bucket} frame bucket{' with EMA update' if update_ema else ''}...")
+          s = time.time()
+          dummy_batch = self.get_shaped_batch(self.config, pipeline, length_bucket)
+          compiled = p_train_step[update_ema].lower(
+              train_states["dit_state"],
+              train_states["text_encoder_state"],
+              train_states["dit_ema"] if update_ema else None,
+              dummy_batch,
+              train_rngs,
+              *frozen_inputs,
+          ).compile()
+          p_train_steps[(length_bucket, update_ema)] = (
+              partial(_call_with_frozen_inputs, compiled, frozen_inputs) if frozen_inputs else compiled
+          )
+          max_logging.log(f"Compile time: {(time.time() - s )}")
+      return p_train_steps
+
+  def training_loop(self, p_train_step, pipeline, params, train_states, data_iterator, dit_learning_rate_scheduler):
+    writer = self.writer
+    dit_state = train_states["dit_state"]
     text_encoder_state = train_states["text_encoder_state"]
+    dit_ema = train_states["dit_ema"]
 
-    num_model_parameters = max_utils.calculate_num_params_from_pytree(unet_state.params)
+    num_model_parameters = max_utils.calculate_num_params_from_pytree(dit_state.params)
 
     max_utils.add_text_to_summary_writer("number_model_parameters", str(num_model_parameters), writer)
-    max_utils.add_text_to_summary_writer("libtpu_init_args", os.environ["LIBTPU_INIT_ARGS"], writer)
+    max_utils.add_text_to_summary_writer("libtpu_init_args", os.environ.get("LIBTPU_INIT_ARGS", ""), writer)
     max_utils.add_config_to_summary_writer(self.config, writer)
 
     if jax.process_index() == 0:
       max_logging.log("***** Running training *****")
-      max_logging.log(f"  Instantaneous batch size per device = {self.config.per_device_batch_size}")
-      max_logging.log(f"  Total train batch size (w. parallel & distributed) = {self.total_train_batch_size}")
+      max_logging.log(f"  Length buckets = {self.length_buckets}")
+      max_logging.log(f"  Frames per device = {self.config.f5_frames_per_device}")
       max_logging.log(f"  Total optimization steps = {self.config.max_train_steps}")
 
     last_step_completion = datetime.datetime.now()
@@ -181,7 +206,7 @@ class F5Trainer(BaseStableDiffusionTrainer):
         first_profiling_step + self.config.profiler_steps - 1, first_profiling_step, self.config.max_train_steps - 1
     )
 
-    start_step = train_utils.get_first_step(train_states["unet_state"])
+    start_step = train_utils.get_first_step(train_states["dit_state"])
     _, train_rngs = jax.random.split(self.rng)
 
     for step in np.arange(start_step, self.config.max_train_steps):
@@ -189,25 +214,36 @@ class F5Trainer(BaseStableDiffusionTrainer):
         max_utils.activate_profiler(self.config)
 
       example_batch = train_utils.load_next_batch(data_iterator, example_batch, self.config)
+      length_bucket = example_batch["mel"].shape[1]
+
+      update_ema = dit_ema is not None and step % self.config.ema_update_every == 0
 
       with jax.profiler.StepTraceAnnotation("train", step_num=step):
-        unet_state, text_encoder_state, train_metric, train_rngs = p_train_step(
-            unet_state, vae_state, text_encoder_state, example_batch, train_rngs
+        dit_state, text_encoder_state, new_dit_ema, train_metric, train_rngs = p_train_step[(length_bucket, update_ema)](
+            dit_state, text_encoder_state, dit_ema if update_ema else None, example_batch, train_rngs
         )
+      if update_ema:
+        dit_ema = new_dit_ema
       new_time = datetime.datetime.now()
 
       train_utils.record_scalar_metrics(
-          train_metric, new_time - last_step_completion, self.per_device_tflops, unet_learning_rate_scheduler(step)
+          train_metric,
+          new_time - last_step_completion,
+          self.per_device_tflops[length_bucket],
+          dit_learning_rate_scheduler(step),
+          self.config.peak_per_device_tflops,
       )
+      train_utils.record_data_stall_metrics(train_metric, data_iterator)
+      self.checkpoint_save_timer.record_metrics(train_metric)
       if self.config.write_metrics:
         train_utils.write_metrics(writer, local_metrics_file, running_gcs_metrics, train_metric, step, self.config)
       last_step_completion = new_time
 
       if step != 0 and self.config.checkpoint_every != -1 and step % self.config.checkpoint_every == 0:
-        train_states["unet_state"] = unet_state
-        train_states["vae_state"] = vae_state
-        train_states["text_encoder"] = text_encoder_state
-        self.save_checkpoint(step, pipeline, params, train_states, data_iterator)
+        train_states["dit_state"] = dit_state
+        train_states["text_encoder_state"] = text_encoder_state
+        train_states["dit_ema"] = dit_ema
+        last_step_completion = self.save_checkpoint(step, pipeline, params, train_states, data_iterator)
 
       if self.checkpoint_manager.reached_preemption(step):
         self.checkpoint_manager.wait_until_finished()
@@ -221,117 +257,122 @@ class F5Trainer(BaseStableDiffusionTrainer):
           writer, local_metrics_file, running_gcs_metrics, train_metric, self.config.max_train_steps - 1, self.config
       )
 
-    train_states["unet_state"] = unet_state
-    train_states["vae_state"] = vae_state
-    train_states["text_encoder"] = text_encoder_state
+    train_states["dit_state"] = dit_state
+    train_states["text_encoder_state"] = text_encoder_state
+    train_states["dit_ema"] = dit_ema
     # save the inference states of the last checkpoint so they can be easily loaded during gen.
     self.save_checkpoint(self.config.max_train_steps - 1, pipeline, params, train_states, data_iterator)
     self.checkpoint_manager.wait_until_finished()
+    return train_states
+
+
+def _call_with_frozen_inputs(compiled, frozen_inputs, *args):
+  return compiled(*args, *frozen_inputs)
+
+
+def span_mask(rng, decoder_segment_ids, decoder_positions, frac_min, frac_max, max_segments):
+  """Masks one random span per packed utterance covering `frac_min`..`frac_max` of its frames.
 
+  Mirrors F5-TTS `mask_from_frac_lengths`, with the span drawn independently for every
+  segment of a packed row. Segment ids above `max_segments` are never masked.
+  """
+  lengths = jax.vmap(
+      lambda segment_ids: jax.ops.segment_sum(jnp.ones_like(segment_ids), segment_ids, num_segments=max_segments + 1)
+  )(decoder_segment_ids)
+  frac_rng, start_rng = jax.random.split(rng)
+  frac = jax.random.uniform(frac_rng, lengths.shape, minval=frac_min, maxval=frac_max)
+  span_lengths = (frac * lengths).astype(jnp.int32)
+  starts = (jax.random.uniform(start_rng, lengths.shape) * (lengths - span_lengths)).astype(jnp.int32)
 
-def _train_step(unet_state, vae_state, text_encoder_state, batch, train_rng, pipeline, params, config):
+  starts = jnp.take_along_axis(starts, decoder_segment_ids, axis=1)
+  span_lengths = jnp.take_along_axis(span_lengths, decoder_segment_ids, axis=1)
+  return (decoder_positions >= starts) & (decoder_positions < starts + span_lengths) & (decoder_segment_ids > 0)
+
+
+def _train_step(dit_state, text_encoder_state, dit_ema, batch, train_rng, pipeline, config, state_shardings):
   _, gen_dummy_rng = jax.random.split(train_rng)
-  sample_rng, timestep_bias_rng, new_train_rng = jax.random.split(gen_dummy_rng, 3)
+  noise_rng, timestep_rng, mask_rng, drop_rng, new_train_rng = jax.random.split(gen_dummy_rng, 5)
 
   if config.train_text_encoder:
-    state_params = {"text_encoder": text_encoder_state.params, "unet": unet_state.params}
+    state_params = {"text_encoder": text_encoder_state.params, "dit": dit_state.params}
   else:
-    state_params = {"unet": unet_state.params}
+    state_params = {"dit": dit_state.params}
+
+  mel = batch["mel"]
+  text_ids = batch["text_ids"]
+  decoder_segment_ids = batch["decoder_segment_ids"]
+  decoder_positions = batch["decoder_positions"]
+  bsz = mel.shape[0]
+
+  # The masked span is generated from the rest of the utterance and is what the loss is taken on.
+  loss_mask = span_mask(
+      mask_rng,
+      decoder_segment_ids,
+      decoder_positions,
+      config.f5_mask_frac_min,
+      config.f5_mask_frac_max,
+      config.f5_max_segments_per_row,
+  )
+  cond = jnp.where(loss_mask[..., jnp.newaxis], jnp.zeros_like(mel), mel)
+
+  # Classifier-free guidance dropout, per row: drop the audio condition, or it and the text.
+  # Inference embeds the null text with the mask of the real one, so keep that mask here.
+  audio_drop_rng, cond_drop_rng = jax.random.split(drop_rng)
+  drop_text = jax.random.bernoulli(cond_drop_rng, config.f5_cond_drop_prob, (bsz,))
+  drop_audio = jax.random.bernoulli(audio_drop_rng, config.f5_audio_drop_prob, (bsz,)) | drop_text
+  cond = jnp.where(drop_audio[:, jnp.newaxis, jnp.newaxis], jnp.zeros_like(cond), cond)
+  text_decoder_segment_ids = (text_ids != 0).astype(jnp.int32)
+  text_ids = jnp.where(drop_text[:, jnp.newaxis], jnp.zeros_like(text_ids), text_ids)
+
+  # Optimal transport path from noise (t=0) to data (t=1), as integrated by generate_f5.
+  # Packed utterances in a row share the row's timestep.
+  x0 = jax.random.normal(noise_rng, mel.shape, dtype=mel.dtype)
+  t = jax.random.uniform(timestep_rng, (bsz,), dtype=mel.dtype)
+  x_t = (1 - t[:, jnp.newaxis, jnp.newaxis]) * x0 + t[:, jnp.newaxis, jnp.newaxis] * mel
+  target = mel - x0
 
   def compute_loss(state_params):
-    if config.dataset_type == "tf" and config.cache_latents_text_encoder_outputs:
-      latents = batch["pixel_values"]
-      encoder_hidden_states = batch["input_ids"]
-    elif config.dataset_type in ("tfrecord", "grain"):
-      latents = FlaxDiagonalGaussianDistribution(batch["pixel_values"]).sample(sample_rng)
-      latents = jnp.transpose(latents, (0, 3, 1, 2))
-      latents = latents * pipeline.vae.config.scaling_factor
-      encoder_hidden_states = batch["input_ids"]
-    else:
-      # Convert images to latent space
-      vae_outputs = pipeline.vae.apply(
-          {"params": vae_state.params}, batch["pixel_values"], deterministic=True, method=pipeline.vae.encode
-      )
-      latents = vae_outputs.latent_dist.sample(sample_rng)
-      # (NHWC) -> (NCHW)
-      latents = jnp.transpose(latents, (0, 3, 1, 2))
-      latents = latents * pipeline.vae.config.scaling_factor
-
-      # Get the text embedding for conditioning
-      if config.train_text_encoder:
-        encoder_hidden_states = maxdiffusion_utils.encode(
-            batch["input_ids"], pipeline.text_encoder, state_params["text_encoder"]
-        )
-      else:
-        encoder_hidden_states = maxdiffusion_utils.encode(
-            batch["input_ids"], pipeline.text_encoder, text_encoder_state.params
-        )
-
-    # Sample noise that we'll add to the latents
-    noise_rng, timestep_rng = jax.random.split(sample_rng)
-    noise = jax.random.normal(noise_rng, latents.shape)
-    # Sample a random timestep for each image
-    bsz = latents.shape[0]
-    if config.timestep_bias["strategy"] == "none":
-      timesteps = jax.random.randint(
-          timestep_rng,
-          (bsz,),
-          0,
-          pipeline.scheduler.config.num_train_timesteps,
-      )
-    else:
-      weights = train_utils.generate_timestep_weights(config, pipeline.scheduler.config.num_train_timesteps)
-      timesteps = jax.random.categorical(timestep_bias_rng, logits=jnp.log(weights), shape=(bsz,))
-
-    # Add noise to the latents according to the noise magnitude at each timestep
-    # (this is the forward diffusion process)
-    noisy_latents = pipeline.scheduler.add_noise(params["scheduler"], latents, noise, timesteps)
-    # TODO - laion dataset was prepared with an extra dim.
-    # need to preprocess the dataset with dim removed.
-    if len(encoder_hidden_states.shape) == 4:
-      encoder_hidden_states = jnp.squeeze(encoder_hidden_states)
-
-    # Predict the noise residual and compute loss
-    model_pred = pipeline.unet.apply(
-        {"params": state_params["unet"]}, noisy_latents, timesteps, encoder_hidden_states, train=True
-    ).sample
-
-    # Get the target for loss depending on the prediction type
-    if pipeline.scheduler.config.prediction_type == "epsilon":
-      target = noise
-    elif pipeline.scheduler.config.prediction_type == "v_prediction":
-      target = pipeline.scheduler.get_velocity(params["scheduler"], latents, noise, timesteps)
-    else:
-      raise ValueError(f"Unknown prediction type {pipeline.scheduler.config.prediction_type}")
-    loss = (target - model_pred) ** 2
-
-    # snr
-    if config.snr_gamma > 0:
-      snr = jnp.array(train_utils.compute_snr(timesteps, params["scheduler"]))
-      snr_loss_weights = jnp.where(snr < config.snr_gamma, snr, jnp.ones_like(snr) * config.snr_gamma)
-      if pipeline.noise_scheduler.config.prediction_type == "epsilon":
-        snr_loss_weights = snr_loss_weights / snr
-      elif pipeline.noise_scheduler.config.prediction_type == "v_prediction":
-        snr_loss_weights = snr_loss_weights / (snr + 1)
-      loss = loss * snr_loss_weights[:, None, None, None]
-
-    loss = loss.mean()
-
-    return loss
+    text_embed = pipeline.text_encoder.apply(
+        {"params": state_params.get("text_encoder", text_encoder_state.params)},
+        text=text_ids,
+        text_decoder_segment_ids=text_decoder_segment_ids,
+        text_positions=decoder_positions,
+        segment_ids=decoder_segment_ids,
+    )
+    model_pred = pipeline.transformer.apply(
+        {"params": state_params["dit"]},
+        x=x_t,
+        cond=cond,
+        text_embed=text_embed,
+        timestep=t,
+        decoder_segment_ids=decoder_segment_ids,
+        train=True,
+        mask_conv_segments=True,
+    )
+    loss = jnp.mean((target - model_pred.astype(jnp.float32)) ** 2, axis=-1)
+    return jnp.sum(loss * loss_mask) / jnp.maximum(jnp.sum(loss_mask), 1)
 
   grad_fn = jax.value_and_grad(compute_loss)
   loss, grad = grad_fn(state_params)
 
   if config.max_grad_norm > 0:
-    grad, _ = optax.clip_by_global_norm(config.max_grad_norm).update(grad, unet_state, None)
+    grad, _ = optax.clip_by_global_norm(config.max_grad_norm).update(grad, optax.EmptyState())
 
-  new_state = unet_state.apply_gradients(grads=grad["unet"])
+  if config.offload_opt_state_to_host:
+    dit_state = max_utils.opt_state_to_device(dit_state, state_shardings["dit_state_shardings"])
+  new_state = dit_state.apply_gradients(grads=grad["dit"])
 
   if config.train_text_encoder:
     new_text_encoder_state = text_encoder_state.apply_gradients(grads=grad["text_encoder"])
   else:
     new_text_encoder_state = text_encoder_state
 
+  new_dit_ema = None
+  if dit_ema is not None:
+    if config.ema_offload_to_host:
+      dit_ema = jax.device_put(dit_ema, max_utils.with_memory_kind(state_shardings["dit_ema_shardings"], "device"))
+    new_dit_ema = train_utils.ema_update(dit_ema, new_state.params, config.ema_decay**config.ema_update_every)
+
   metrics = {"scalar": {"learning/loss": loss}, "scalars": {}}
 
-  return new_state, new_text_encoder_state, metrics, new_train_rng
+  return new_state, new_text_encoder_state, new_dit_ema, metrics, new_train_rng
@@ -34,6 +34,7 @@ from maxdiffusion.train_utils import (
     generate_timestep_weights,
     get_first_step,
     load_next_batch,
+    record_data_stall_metrics,
     record_scalar_metrics,
     write_metrics,
 )
@@ -153,7 +154,7 @@ class StableDiffusionXLTrainer(StableDiffusionTrainer):
     self.rng, train_rngs = jax.random.split(self.rng)
     with self.mesh, nn_partitioning.axis_rules(self.config.logical_axis_rules):
       p_train_step = jax.jit(
-          partial(_train_step, pipeline=pipeline, params=params, config=self.config),
+          partial(_train_step, pipeline=pipeline, params=params, config=self.config, state_shardings=state_shardings),
           in_shardings=(
               state_shardings["unet_state_shardings"],
               state_shardings["vae_state_shardings"],
@@ -230,6 +231,8 @@ class StableDiffusionXLTrainer(StableDiffusionTrainer):
       record_scalar_metrics(
           train_metric, new_time - last_step_completion, self.per_device_tflops, unet_learning_rate_scheduler(step)
       )
+      record_data_stall_metrics(train_metric, data_iterator)
+      self.checkpoint_save_timer.record_metrics(train_metric)
       if self.config.write_metrics:
         write_metrics(writer, local_metrics_file, running_gcs_metrics, train_metric, step, self.config)
       last_step_completion = new_time
@@ -239,7 +242,7 @@ class StableDiffusionXLTrainer(StableDiffusionTrainer):
         train_states["vae_state"] = vae_state
         train_states["text_encoder_state"] = text_encoder_state
         train_states["text_encoder_2_state"] = text_encoder_2_state
-        self.save_checkpoint(step, pipeline, params, train_states)
+        last_step_completion = self.save_checkpoint(step, pipeline, params, train_states)
 
       if self.config.enable_profiler and step == last_profiling_step:
         max_utils.deactivate_profiler(self.config)
@@ -256,7 +259,9 @@ class StableDiffusionXLTrainer(StableDiffusionTrainer):
     self.checkpoint_manager.wait_until_finished()
 
 
-def _train_step(unet_state, vae_state, text_encoder_state, text_encoder_2_state, batch, train_rng, pipeline, params, config):
+def _train_step(
+    unet_state, vae_state, text_encoder_state, text_encoder_2_state, batch, train_rng, pipeline, params, config, state_shardings
+):
   _, gen_dummy_rng = jax.random.split(train_rng)
   sample_rng, timestep_bias_rng, new_train_rng = jax.random.split(gen_dummy_rng, 3)
 
@@ -349,6 +354,8 @@ def _train_step(unet_state, vae_state, text_encoder_state, text_encoder_2_state,
   grad_fn = jax.value_and_grad(compute_loss)
   loss, grad = grad_fn(state_params)
 
+  if config.offload_opt_state_to_host:
+    unet_state = max_utils.opt_state_to_device(unet_state, state_shardings["unet_state_shardings"])
   new_state = unet_state.apply_gradients(grads=grad["unet"])
 
   metrics = {"scalar": {"learning/loss": loss}, "scalars": {}}
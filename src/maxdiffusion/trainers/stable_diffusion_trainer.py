@@ -148,7 +148,7 @@ class StableDiffusionTrainer(BaseStableDiffusionTrainer):
     self.rng, train_rngs = jax.random.split(self.rng)
     with self.mesh, nn_partitioning.axis_rules(self.config.logical_axis_rules):
       p_train_step = jax.jit(
-          partial(_train_step, pipeline=pipeline, params=params, config=self.config),
+          partial(_train_step, pipeline=pipeline, params=params, config=self.config, state_shardings=state_shardings),
           in_shardings=(
               state_shardings["unet_state_shardings"],
               state_shardings["vae_state_shardings"],
@@ -217,6 +217,8 @@ class StableDiffusionTrainer(BaseStableDiffusionTrainer):
       train_utils.record_scalar_metrics(
           train_metric, new_time - last_step_completion, self.per_device_tflops, unet_learning_rate_scheduler(step)
       )
+      train_utils.record_data_stall_metrics(train_metric, data_iterator)
+      self.checkpoint_save_timer.record_metrics(train_metric)
       if self.config.write_metrics:
         train_utils.write_metrics(writer, local_metrics_file, running_gcs_metrics, train_metric, step, self.config)
       last_step_completion = new_time
@@ -225,7 +227,7 @@ class StableDiffusionTrainer(BaseStableDiffusionTrainer):
         train_states["unet_state"] = unet_state
         train_states["vae_state"] = vae_state
         train_states["text_encoder"] = text_encoder_state
-        self.save_checkpoint(step, pipeline, params, train_states, data_iterator)
+        last_step_completion = self.save_checkpoint(step, pipeline, params, train_states, data_iterator)
 
       if self.checkpoint_manager.reached_preemption(step):
         self.checkpoint_manager.wait_until_finished()
@@ -247,7 +249,7 @@ class StableDiffusionTrainer(BaseStableDiffusionTrainer):
     self.checkpoint_manager.wait_until_finished()
 
 
-def _train_step(unet_state, vae_state, text_encoder_state, batch, train_rng, pipeline, params, config):
+def _train_step(unet_state, vae_state, text_encoder_state, batch, train_rng, pipeline, params, config, state_shardings):
   _, gen_dummy_rng = jax.random.split(train_rng)
   sample_rng, timestep_bias_rng, new_train_rng = jax.random.split(gen_dummy_rng, 3)
 
@@ -343,6 +345,8 @@ def _train_step(unet_state, vae_state, text_encoder_state, batch, train_rng, pip
   if config.max_grad_norm > 0:
     grad, _ = optax.clip_by_global_norm(config.max_grad_norm).update(grad, unet_state, None)
 
+  if config.offload_opt_state_to_host:
+    unet_state = max_utils.opt_state_to_device(unet_state, state_shardings["unet_state_shardings"])
   new_state = unet_state.apply_gradients(grads=grad["unet"])
 
   if config.train_text_encoder: